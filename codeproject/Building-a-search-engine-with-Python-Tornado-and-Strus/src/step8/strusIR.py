@@ -2,6 +2,92 @@ import strus
 import itertools
 import heapq
 import re
+import collections
+
+# Map with a bounded size evicting the least recently used entries.
+# Every entry has a cost (default 1) counted against the maximum size
+# (the same as strusCache.LruCache of the distributed search index):
+class LruCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get( self, key, default=None):
+        entry = self.map.get( key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.map.move_to_end( key)
+        self.hits += 1
+        return entry[0]
+
+    def put( self, key, value, cost=1):
+        if cost > self.maxsize:
+            return
+        entry = self.map.pop( key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        self.map[ key] = (value, cost)
+        self.size += cost
+        while self.size > self.maxsize:
+            key,entry = self.map.popitem( last=False)
+            self.size -= entry[1]
+
+    def hitRate( self):
+        return float( self.hits) / max( 1, self.hits + self.misses)
+
+# Cache of the query analysis results: maps the query string to the list of
+# analyzed terms, evicting the least recently used entries when the
+# estimated memory used exceeds 'maxbytes'. With 'pertoken' the terms of
+# single words are cached too, so that a new query composed of known words
+# is analyzed without calling the analyzer. Only queries consisting of
+# words (letters and digits) separated by spaces are analyzed word by word,
+# because the analyzer might tokenize other characters differently:
+class QueryAnalysisCache:
+    tokenQueryPattern = re.compile( r"\s*[^\W_]+(\s+[^\W_]+)*\s*")
+
+    def __init__(self, analyzer, maxbytes, pertoken):
+        self.analyzer = analyzer
+        self.queries = LruCache( maxbytes)
+        self.tokens = LruCache( maxbytes) if pertoken else None
+
+    # Estimated memory used by an entry in bytes:
+    def cost( self, key, terms):
+        return 120 + len( key) + sum( 160 + len( term['type']) + len( term['value']) for term in terms)
+
+    def analyzeTokens( self, querystr):
+        rt = []
+        for token in querystr.split():
+            terms = self.tokens.get( token)
+            if terms is None:
+                terms = self.analyzer.analyzeTermExpression( [ "text", token ] )
+                self.tokens.put( token, terms, self.cost( token, terms))
+            rt.extend( terms)
+        return rt
+
+    # Get the analyzed terms of a query, the list returned must not be changed:
+    def analyze( self, querystr):
+        if self.queries.maxsize <= 0:
+            return self.analyzer.analyzeTermExpression( [ "text", querystr ] )
+        terms = self.queries.get( querystr)
+        if terms is None:
+            if self.tokens is not None and self.tokenQueryPattern.fullmatch( querystr):
+                terms = self.analyzeTokens( querystr)
+            else:
+                terms = self.analyzer.analyzeTermExpression( [ "text", querystr ] )
+            self.queries.put( querystr, terms, self.cost( querystr, terms))
+        return terms
+
+    def statistics( self):
+        return {
+            'hits': self.queries.hits, 'misses': self.queries.misses,
+            'hitrate': self.queries.hitRate(),
+            'tokenhits': self.tokens.hits if self.tokens else 0,
+            'tokenmisses': self.tokens.misses if self.tokens else 0,
+            'bytes': self.queries.size }
 
 class Backend:
     # Create the document analyzer for our test collection:
@@ -75,8 +161,10 @@ class Backend:
         rt.addSummarizer( "accuvar", { "match": {'feature':"sumfeat"}, "var": "CONTINENT", "type": "continent", "result":"ENTITY" } )
         return rt
 
-    # Constructor. Initializes the query evaluation schemes and the query and document analyzers:
-    def __init__(self, config):
+    # Constructor. Initializes the query evaluation schemes and the query and document analyzers.
+    # The results of the query analyzer are cached up to 'analysiscache' bytes, with 'pertoken'
+    # also for the single words of the queries:
+    def __init__(self, config, analysiscache=16777216, pertoken=False):
         if isinstance( config, ( int ) ):
             self.context = strus.Context( "localhost:%u" % config)
             self.storage = self.context.createStorageClient()
@@ -85,6 +173,7 @@ class Backend:
             self.context.addResourcePath("./resources")
             self.storage = self.context.createStorageClient( config )
         self.queryAnalyzer = self.createQueryAnalyzer()
+        self.analysisCache = QueryAnalysisCache( self.queryAnalyzer, analysiscache, pertoken)
         self.documentAnalyzer = self.createDocumentAnalyzer()
         self.queryeval = {}
         self.queryeval["BM25"] = self.createQueryEvalBM25()
@@ -105,7 +194,7 @@ class Backend:
     def evaluateQueryText( self, querystr, firstrank, nofranks):
         queryeval = self.queryeval[ "BM25"]
         query = queryeval.createQuery( self.storage)
-        terms = self.queryAnalyzer.analyzeTermExpression( [ "text", querystr ] )
+        terms = self.analysisCache.analyze( querystr)
         if len( terms) == 0:
             # Return empty result for empty query:
             return []
@@ -228,7 +317,7 @@ class Backend:
     def evaluateQueryEntities( self, querystr, firstrank, nofranks):
         queryeval = self.queryeval[ "NBLNK"]
         query = queryeval.createQuery( self.storage)
-        terms = self.queryAnalyzer.analyzeTermExpression( [ "text", querystr ] )
+        terms = self.analysisCache.analyze( querystr)
         if len( terms) == 0:
              # Return empty result for empty query:
              return []
@@ -50,12 +50,19 @@ class QueryHandler(tornado.web.RequestHandler):
                          message=e, scheme=scheme, querystr=querystr,
                          firstrank=firstrank, nofranks=nofranks)
 
+# Declare the handler reporting the hit rate of the query analysis cache:
+class CacheStatisticsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write( backend.analysisCache.statistics())
+
 # [2] Dispatcher:
 application = tornado.web.Application([
     # /insert in the URL triggers the handler for inserting documents:
     (r"/insert", InsertHandler),
     # /query in the URL triggers the handler for answering queries:
     (r"/query", QueryHandler),
+    # /cachestats in the URL returns the statistics of the query analysis cache as JSON:
+    (r"/cachestats", CacheStatisticsHandler),
     # /static in the URL triggers the handler for accessing static 
     # files like images referenced in tornado templates:
     (r"/static/(.*)",tornado.web.StaticFileHandler,
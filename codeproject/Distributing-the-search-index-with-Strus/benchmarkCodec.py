@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+import optparse
+import time
+import strusCodec
+
+# Microbenchmark of the encoding and decoding of query result rows and
+# of queries as exchanged between the HTTP server and the storage servers.
+
+def createResults( nofrows):
+    rt = []
+    for ii in range( nofrows):
+        rt.append( {
+            'docno': ii + 1,
+            'docid': "%u" % (1000000 + ii),
+            'title': "Title of the release number %u" % ii,
+            'weight': 10.0 / (ii + 1),
+            'abstract': "some <b>matching</b> words of the note of release %u ..." % ii })
+    return rt
+
+def createTerms( nofterms):
+    return [ strusCodec.QueryTerm( "word", "term%u" % ii, 1000 + ii) for ii in range( nofterms) ]
+
+def measure( name, unit, nofitems, repeat, function):
+    start = time.time()
+    for ii in range( repeat):
+        function()
+    duration = time.time() - start
+    print( "%-24s %12.0f %s/second" % (name, nofitems * repeat / duration, unit))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--rows", dest="rows", default=1000,
+                      help="Number of result rows per message as NUM (default %u)" % 1000,
+                      metavar="NUM")
+    parser.add_option("-r", "--repeat", dest="repeat", default=200,
+                      help="Number of messages encoded and decoded as NUM (default %u)" % 200,
+                      metavar="NUM")
+    (options, args) = parser.parse_args()
+    nofrows = int( options.rows)
+    repeat = int( options.repeat)
+
+    results = createResults( nofrows)
+    reply = bytes( strusCodec.encodeQueryResults( results))
+    measure( "encode result rows", "rows", nofrows, repeat,
+             lambda: strusCodec.encodeQueryResults( results))
+    measure( "decode result rows", "rows", nofrows, repeat,
+             lambda: strusCodec.decodeQueryResults( reply))
+
+    terms = createTerms( 8)
+    query = bytes( strusCodec.encodeQuery( 1000000, 0, 20, terms))
+    measure( "encode query (8 terms)", "queries", 1, repeat * 100,
+             lambda: strusCodec.encodeQuery( 1000000, 0, 20, terms))
+    measure( "decode query (8 terms)", "queries", 1, repeat * 100,
+             lambda: strusCodec.decodeQuery( query))
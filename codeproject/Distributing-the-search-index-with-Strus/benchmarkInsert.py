@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+import os
+import re
+import json
+import time
+import optparse
+import subprocess
+import strusStandIn
+
+# Ingestion benchmark: inserts the files of a collection (e.g. written by
+# generateCorpus.py) with strusIR.Backend into a storage and measures the
+# throughput of the document analysis and of the transaction commits
+# separately and the size of the storage per million documents. The
+# configuration "backend=memory" measures the in-memory backend of
+# strusMemIR as baseline instead.
+
+itemPattern = re.compile( rb"<item\b[^>]*>.*?</item>", re.S)
+
+# Split a multipart document file into multipart documents of at most
+# 'nofitems' items:
+def splitDocuments( content, nofitems):
+    items = itemPattern.findall( content)
+    for start in range( 0, len( items), nofitems):
+        yield b'<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<list>' \
+              + b"\n".join( items[ start:start + nofitems]) + b"</list>\n"
+
+def directorySize( path):
+    rt = 0
+    for dirpath,dirnames,filenames in os.walk( path):
+        for filename in filenames:
+            rt += os.path.getsize( os.path.join( dirpath, filename))
+    return rt
+
+def fileIndex( filename):
+    return int( filename.split( '.')[0])
+
+if __name__ == "__main__":
+    defaultconfig = "path=storage_benchmark; metadata=doclen UINT16, date UINT32"
+    parser = optparse.OptionParser()
+    parser.add_option("-d", "--documents", dest="documents", default="data/doc",
+                      help="Insert the files <NUM>.xml in directory DIR (default %s)" % "data/doc",
+                      metavar="DIR")
+    parser.add_option("-c", "--config", dest="config", default=defaultconfig,
+                      help="Configuration of the storage as CONF, created if the path does "
+                           "not exist, 'backend=memory' for the in-memory backend "
+                           "(default '%s')" % defaultconfig,
+                      metavar="CONF")
+    parser.add_option("-b", "--transaction-size", dest="transactionsize", default=1000,
+                      help="Insert NUM documents per transaction (default %u)" % 1000,
+                      metavar="NUM")
+    parser.add_option("-n", "--files", dest="files", default=None,
+                      help="Insert only the first NUM files",
+                      metavar="NUM")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Append the result as one line of JSON to FILE "
+                           "(default print it to stdout)",
+                      metavar="FILE")
+    (options, args) = parser.parse_args()
+
+    params = strusStandIn.parseConfig( options.config)
+    path = params.get( "path")
+    if (params.get( "backend") == "memory"):
+        import strusMemIR
+        backend = strusMemIR.Backend( options.config)
+        path = None
+    else:
+        import strusIR
+        if (path and not os.path.exists( path)):
+            subprocess.check_call( [ "strusCreate", "-s", options.config ])
+        backend = strusIR.Backend( options.config)
+    files = sorted( [ name for name in os.listdir( options.documents) if name.endswith( ".xml") ],
+                    key=fileIndex)
+    if (options.files is not None):
+        files = files[ :int( options.files)]
+
+    nofdocs = 0
+    nofbytes = 0
+    analysistime = 0.0
+    committime = 0.0
+    start = time.time()
+    for filename in files:
+        with open( os.path.join( options.documents, filename), "rb") as f:
+            content = f.read()
+        nofbytes += len( content)
+        for multipart in splitDocuments( content, int( options.transactionsize)):
+            analysisstart = time.time()
+            docs = backend.analyzeDocuments( multipart)
+            commitstart = time.time()
+            nofdocs += backend.insertAnalyzedDocuments( docs)
+            analysistime += commitstart - analysisstart
+            committime += time.time() - commitstart
+        print( "inserted %s (%u documents)" % (filename, nofdocs))
+    duration = time.time() - start
+    storagesize = directorySize( path) if path else 0
+    report = {
+        "timestamp": time.strftime( "%Y-%m-%dT%H:%M:%S"),
+        "documents": nofdocs,
+        "input_bytes": nofbytes,
+        "transaction_size": int( options.transactionsize),
+        "duration": round( duration, 3),
+        "docs_per_second": round( nofdocs / max( duration, 1e-6), 1),
+        "analysis_docs_per_second": round( nofdocs / max( analysistime, 1e-6), 1),
+        "commit_docs_per_second": round( nofdocs / max( committime, 1e-6), 1),
+        "storage_bytes": storagesize,
+        "storage_bytes_per_million_docs": int( storagesize * 1000000.0 / max( nofdocs, 1))
+    }
+    if (options.output):
+        with open( options.output, "a") as f:
+            f.write( json.dumps( report, sort_keys=True) + "\n")
+    else:
+        print( json.dumps( report, indent=2, sort_keys=True))
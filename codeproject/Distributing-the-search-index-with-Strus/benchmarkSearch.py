@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+import tornado.ioloop
+import tornado.gen
+import tornado.httpclient
+import os
+import sys
+import json
+import time
+import random
+import socket
+import optparse
+import subprocess
+import urllib.parse
+import strusMessage
+import strusCodec
+import strusStandIn
+
+# Load generator and latency benchmark of the distributed search stack.
+# Starts a statistics server, storage servers (by default with the
+# stand-in backend, so that no strus storage is needed) and an HTTP
+# server on this machine, issues queries in a closed loop (a fixed number
+# of clients issuing the next query when they got the answer of the last)
+# or in an open loop (queries issued at a fixed rate independent of the
+# answers) and reports throughput, latencies, the time spent in the stages
+# of the query evaluation (from the Server-Timing header of the HTTP server)
+# and the CPU time and memory of the server processes as JSON.
+
+scriptdir = os.path.dirname( os.path.realpath( __file__))
+
+# [1] Server processes:
+class ServerProcess( object):
+    def __init__(self, name, args, logdir):
+        self.name = name
+        output = subprocess.DEVNULL
+        if (logdir):
+            output = open( os.path.join( logdir, name + ".log"), "w")
+        self.process = subprocess.Popen( [ sys.executable ] + args, cwd=scriptdir,
+                                         stdout=output, stderr=subprocess.STDOUT)
+        self.pid = self.process.pid
+        self.startcpu = 0.0
+
+    # CPU time (user and system) of the process in seconds:
+    def cpuTime( self):
+        with open( "/proc/%u/stat" % self.pid) as f:
+            fields = f.read().rsplit( ')', 1)[1].split()
+        return float( int( fields[11]) + int( fields[12])) / os.sysconf( "SC_CLK_TCK")
+
+    # Resident memory and peak resident memory of the process in bytes:
+    def memory( self):
+        rt = {}
+        with open( "/proc/%u/status" % self.pid) as f:
+            for line in f:
+                if (line.startswith( "VmRSS:") or line.startswith( "VmHWM:")):
+                    rt[ line[:5]] = int( line.split()[1]) * 1024
+        return rt.get( "VmRSS", 0), rt.get( "VmHWM", 0)
+
+    def startMeasure( self):
+        self.startcpu = self.cpuTime()
+
+    def report( self, duration):
+        cputime = self.cpuTime() - self.startcpu
+        rss,maxrss = self.memory()
+        return { "name": self.name, "pid": self.pid,
+                 "cpu_seconds": round( cputime, 3),
+                 "cpu_percent": round( 100.0 * cputime / duration, 1),
+                 "rss_bytes": rss, "max_rss_bytes": maxrss }
+
+    def stop( self):
+        self.process.terminate()
+        try:
+            self.process.wait( 10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def waitForPort( port, timeout=60.0):
+    end = time.time() + timeout
+    while (True):
+        try:
+            socket.create_connection( ("localhost", port), 1.0).close()
+            return
+        except IOError:
+            if (time.time() > end):
+                raise Exception( "server on port %u did not start" % port)
+            time.sleep( 0.1)
+
+# Wait until the storage servers published their statistics (the collection
+# size seen by the statistics server does not change anymore):
+def waitForStatistics( statport, timeout=600.0):
+    msgclient = strusMessage.RequestClient()
+    ioloop = tornado.ioloop.IOLoop.current()
+    query = strusCodec.encodeStatisticsQuery( [], True, False)
+    end = time.time() + timeout
+    last = -1
+    while (time.time() < end):
+        reply = ioloop.run_sync( lambda: msgclient.issueRequest( "localhost:%u" % statport, query))
+        (collectionsize,) = strusCodec.decodeStatisticsReply( reply, 1)
+        if (collectionsize > 0 and collectionsize == last):
+            break
+        last = collectionsize
+        time.sleep( 1.0)
+    msgclient.close()
+    return last
+
+# Start the statistics server on 'baseport', the storage servers on the
+# following ports and the HTTP server on 'httpport':
+def startStack( options, logdir):
+    baseport = int( options.baseport)
+    httpport = int( options.httpport)
+    processes = []
+    try:
+        processes.append( ServerProcess( "statserver",
+                            [ "strusStatisticsServer.py", "-p", str( baseport) ], logdir))
+        waitForPort( baseport)
+        storageports = [ baseport + 1 + si for si in range( int( options.servers)) ]
+        for si,port in enumerate( storageports):
+            config = options.config.format( index=si, docs=int( options.docs))
+            processes.append( ServerProcess( "storage%u" % si,
+                                [ "strusStorageServer.py", "-p", str( port), "-s", str( baseport),
+                                  "-P", "-c", config ], logdir))
+        for port in storageports:
+            waitForPort( port)
+        waitForStatistics( baseport)
+        processes.append( ServerProcess( "httpserver",
+                            [ "strusHttpServer.py", "-p", str( httpport), "-s", str( baseport) ]
+                            + options.httpargs.split() + [ str( port) for port in storageports ],
+                            logdir))
+        waitForPort( httpport)
+    except:
+        for process in reversed( processes):
+            process.stop()
+        raise
+    return processes
+
+# [2] Query set:
+# Queries of 1 to 3 terms drawn from the Zipf distributed vocabulary of
+# the stand-in backend, so that the terms are as frequent in the queries
+# as in the documents:
+def createQueries( nofqueries, vocabularysize, seed):
+    vocabulary = strusStandIn.ZipfVocabulary( vocabularysize)
+    rnd = random.Random( seed)
+    return [ " ".join( vocabulary.sample( rnd, rnd.choice( [1,1,1,1,1,2,2,2,3,3]) ))
+             for qi in range( nofqueries) ]
+
+def loadQueries( path):
+    with open( path) as f:
+        return [ line.strip() for line in f if line.strip() ]
+
+# [3] Load generation:
+class LoadStatistics( object):
+    def __init__(self):
+        self.latencies = []
+        self.stages = {}
+        self.errors = 0
+        self.partial = 0
+        self.measuring = False
+
+    def add( self, latency, response):
+        if (not self.measuring):
+            return
+        if (response.code != 200):
+            self.errors += 1
+            return
+        if (b'<font color="red">Error:' in response.body):
+            self.partial += 1
+        self.latencies.append( latency)
+        for entry in response.headers.get( "Server-Timing", "").split( ','):
+            if (";dur=" in entry):
+                stage,duration = entry.strip().split( ";dur=")
+                self.stages.setdefault( stage, []).append( float( duration))
+
+class LoadGenerator( object):
+    def __init__(self, url, queries, nofranks, seed):
+        self.url = url
+        self.queries = queries
+        self.nofranks = nofranks
+        self.rnd = random.Random( seed)
+        self.statistics = LoadStatistics()
+        self.client = tornado.httpclient.AsyncHTTPClient()
+
+    def queryUrl( self):
+        query = self.rnd.choice( self.queries)
+        return "%s?%s" % (self.url, urllib.parse.urlencode( {"q": query, "n": self.nofranks}))
+
+    # Issue a query and count the latency from 'start' (the time the query
+    # was due in the open loop, so that queueing delays are included):
+    @tornado.gen.coroutine
+    def issue( self, start):
+        response = yield self.client.fetch( self.queryUrl(), raise_error=False, request_timeout=60)
+        self.statistics.add( (time.time() - start) * 1000.0, response)
+
+    @tornado.gen.coroutine
+    def closedLoopClient( self, end):
+        while (time.time() < end):
+            yield self.issue( time.time())
+
+    @tornado.gen.coroutine
+    def closedLoop( self, concurrency, duration):
+        end = time.time() + duration
+        yield [ self.closedLoopClient( end) for ci in range( concurrency) ]
+
+    # Issue queries with exponentially distributed gaps ('rate' queries
+    # per second on average):
+    @tornado.gen.coroutine
+    def openLoop( self, rate, duration):
+        now = time.time()
+        end = now + duration
+        due = now
+        pending = []
+        while (due < end):
+            due += self.rnd.expovariate( rate)
+            wait = due - time.time()
+            if (wait > 0):
+                yield tornado.gen.sleep( wait)
+            pending.append( self.issue( due))
+        yield pending
+
+    @tornado.gen.coroutine
+    def run( self, mode, load, warmup, duration, processes):
+        if (warmup > 0):
+            yield self.generate( mode, load, warmup)
+        self.statistics.measuring = True
+        for process in processes:
+            process.startMeasure()
+        start = time.time()
+        yield self.generate( mode, load, duration)
+        raise tornado.gen.Return( time.time() - start)
+
+    def generate( self, mode, load, duration):
+        if (mode == "closed"):
+            return self.closedLoop( int( load), duration)
+        return self.openLoop( float( load), duration)
+
+# [4] Report:
+def percentile( ordered, fraction):
+    if (not ordered):
+        return 0.0
+    return ordered[ min( len( ordered) - 1, int( len( ordered) * fraction))]
+
+def summarize( values, percentiles):
+    ordered = sorted( values)
+    rt = { "mean": round( sum( ordered) / max( 1, len( ordered)), 3) }
+    for name,fraction in percentiles:
+        rt[ name] = round( percentile( ordered, fraction), 3)
+    rt[ "max"] = round( ordered[ -1] if ordered else 0.0, 3)
+    return rt
+
+def createReport( options, statistics, duration, processes):
+    percentiles = [ ("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999) ]
+    return {
+        "timestamp": time.strftime( "%Y-%m-%dT%H:%M:%S"),
+        "mode": options.mode,
+        "load": float( options.load),
+        "servers": int( options.servers),
+        "documents_per_server": int( options.docs),
+        "httpargs": options.httpargs,
+        "duration": round( duration, 3),
+        "requests": len( statistics.latencies) + statistics.errors,
+        "errors": statistics.errors,
+        "partial": statistics.partial,
+        "qps": round( len( statistics.latencies) / duration, 1),
+        "latency_ms": summarize( statistics.latencies, percentiles),
+        "stages_ms": dict( (stage, summarize( values, percentiles[:3]))
+                           for stage,values in statistics.stages.items()),
+        "processes": [ process.report( duration) for process in processes ]
+    }
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-m", "--mode", dest="mode", default="closed",
+                      help="Generate load in a 'closed' or 'open' loop as MODE (default %s)" % "closed",
+                      metavar="MODE")
+    parser.add_option("-l", "--load", dest="load", default=8,
+                      help="Number of clients (closed loop) or queries per second (open loop) "
+                           "as NUM (default %u)" % 8,
+                      metavar="NUM")
+    parser.add_option("-t", "--duration", dest="duration", default=30,
+                      help="Measure for SEC seconds (default %u)" % 30,
+                      metavar="SEC")
+    parser.add_option("-w", "--warmup", dest="warmup", default=5,
+                      help="Issue queries for SEC seconds before measuring (default %u)" % 5,
+                      metavar="SEC")
+    parser.add_option("-n", "--servers", dest="servers", default=2,
+                      help="Number of storage servers started as NUM (default %u)" % 2,
+                      metavar="NUM")
+    parser.add_option("-d", "--docs", dest="docs", default=100000,
+                      help="Number of documents per storage server of the stand-in "
+                           "backend as NUM (default %u)" % 100000,
+                      metavar="NUM")
+    parser.add_option("-c", "--config", dest="config",
+                      default="backend=standin; docs={docs}; seed={index}",
+                      help="Configuration of the storage servers as CONF, '{index}' is "
+                           "replaced by the index of the server (default '%s')"
+                           % "backend=standin; docs={docs}; seed={index}",
+                      metavar="CONF")
+    parser.add_option("-a", "--http-args", dest="httpargs", default="",
+                      help="Additional options of the HTTP server as ARGS",
+                      metavar="ARGS")
+    parser.add_option("-p", "--port", dest="baseport", default=17183,
+                      help="Port of the statistics server as PORT, the storage servers "
+                           "listen on the following ports (default %u)" % 17183,
+                      metavar="PORT")
+    parser.add_option("-P", "--http-port", dest="httpport", default=18080,
+                      help="Port of the HTTP server as PORT (default %u)" % 18080,
+                      metavar="PORT")
+    parser.add_option("-u", "--url", dest="url", default=None,
+                      help="Do not start servers, query the HTTP server at URL "
+                           "(e.g. http://localhost:80/query)",
+                      metavar="URL")
+    parser.add_option("-q", "--queries", dest="queries", default=10000,
+                      help="Number of different queries generated as NUM (default %u)" % 10000,
+                      metavar="NUM")
+    parser.add_option("-f", "--query-file", dest="queryfile", default=None,
+                      help="Read the queries from FILE (one query per line) "
+                           "instead of generating them",
+                      metavar="FILE")
+    parser.add_option("-r", "--ranks", dest="ranks", default=20,
+                      help="Number of ranks per query as NUM (default %u)" % 20,
+                      metavar="NUM")
+    parser.add_option("-L", "--logdir", dest="logdir", default=None,
+                      help="Write the output of the servers to files in DIR",
+                      metavar="DIR")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Append the result as one line of JSON to FILE "
+                           "(default print it to stdout)",
+                      metavar="FILE")
+    (options, args) = parser.parse_args()
+    if (options.mode not in ["closed", "open"]):
+        parser.error( "unknown load mode '%s'" % options.mode)
+
+    if (options.queryfile):
+        queries = loadQueries( options.queryfile)
+    else:
+        queries = createQueries( int( options.queries),
+                                 int( strusStandIn.parseConfig( options.config).get( "vocabulary", 50000)), 1)
+    processes = []
+    url = options.url
+    if (url is None):
+        processes = startStack( options, options.logdir)
+        url = "http://localhost:%u/query" % int( options.httpport)
+    try:
+        tornado.httpclient.AsyncHTTPClient.configure( None, max_clients=1000)
+        generator = LoadGenerator( url, queries, int( options.ranks), 2)
+        duration = tornado.ioloop.IOLoop.current().run_sync(
+                        lambda: generator.run( options.mode, options.load, float( options.warmup),
+                                               float( options.duration), processes))
+        report = createReport( options, generator.statistics, duration, processes)
+    finally:
+        for process in reversed( processes):
+            process.stop()
+    if (options.output):
+        with open( options.output, "a") as f:
+            f.write( json.dumps( report, sort_keys=True) + "\n")
+    else:
+        print( json.dumps( report, indent=2, sort_keys=True))
@@ -0,0 +1,19 @@
+#!/bin/sh
+
+if [ "$#" -lt 2 ]; then
+    echo "Usage: $0 <server-port> <start-range> [<end-range>]" >&2
+    exit 1
+fi
+
+port=`expr 0 \+ $1`
+start=`expr 0 \+ $2`
+if [ "$#" -lt 3 ]; then
+    end=$start
+else
+    end=`expr 0 \+ $3`
+fi
+# Stream all documents of the range in one request:
+for i in $(seq $start $end)
+do
+    cat data/doc/$i.xml
+done | curl -X POST -T - -H "Content-Type: application/xml; charset=UTF-8" localhost:80/bulkinsert/$port
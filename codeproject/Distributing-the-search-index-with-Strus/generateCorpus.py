@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+import os
+import random
+import itertools
+import optparse
+
+# Generator of a synthetic collection in the format of the musicbrainz
+# release documents built by prepare.sh ('/list/item' elements with the
+# fields id, title, artist, date, upc and note). The words of titles,
+# artists and notes are drawn from vocabularies of generated words with
+# Zipf distributed frequencies. The items are written to files of
+# 'itemsPerFile' items named <file index>.xml as expected by insert_docs.sh.
+
+syllables = [ c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou" ] + [ "an", "el", "in", "or", "us" ]
+
+# Vocabulary of 'size' distinct generated words, the word with rank r
+# has a frequency proportional to 1/r^exponent:
+class Vocabulary( object):
+    def __init__(self, rnd, size, exponent):
+        words = set()
+        while (len( words) < size):
+            words.add( "".join( rnd.choice( syllables) for si in range( rnd.randint( 1, 4))))
+        self.words = sorted( words)
+        rnd.shuffle( self.words)
+        self.cumweights = list( itertools.accumulate(
+                                    1.0 / (ri ** exponent) for ri in range( 1, size + 1)))
+
+    def sample( self, rnd, nofwords):
+        return rnd.choices( self.words, cum_weights=self.cumweights, k=nofwords)
+
+class CorpusGenerator( object):
+    def __init__(self, seed, vocabularysize, exponent):
+        self.rnd = random.Random( seed)
+        self.words = Vocabulary( self.rnd, vocabularysize, exponent)
+        self.names = Vocabulary( self.rnd, max( 1000, vocabularysize // 10), exponent)
+
+    def text( self, vocabulary, minwords, maxwords):
+        words = vocabulary.sample( self.rnd, self.rnd.randint( minwords, maxwords))
+        return " ".join( words).capitalize()
+
+    def item( self, docid):
+        rnd = self.rnd
+        date = "%04u-%02u-%02u %02u:%02u:%02u" % (
+                    rnd.randint( 1950, 2017), rnd.randint( 1, 12), rnd.randint( 1, 28),
+                    rnd.randint( 0, 23), rnd.randint( 0, 59), rnd.randint( 0, 59))
+        upc = "%012u" % rnd.randrange( 10**12) if rnd.random() < 0.6 else ""
+        note = self.text( self.words, 3, 30) if rnd.random() < 0.3 else ""
+        return "<item><id>%u</id><title>%s</title><artist>%s</artist><date>%s</date>" \
+               "<upc>%s</upc><note>%s</note></item>\n" % (
+                    docid, self.text( self.words, 1, 6), self.text( self.names, 1, 3),
+                    date, upc, note)
+
+    # Write 'nofitems' items to files in 'directory':
+    def write( self, directory, nofitems, itemsPerFile):
+        if (not os.path.isdir( directory)):
+            os.makedirs( directory)
+        nofFiles = (nofitems + itemsPerFile - 1) // itemsPerFile
+        for fi in range( nofFiles):
+            with open( os.path.join( directory, "%u.xml" % fi), "w") as f:
+                f.write( '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<list>\n')
+                for docid in range( fi * itemsPerFile, min( nofitems, (fi + 1) * itemsPerFile)):
+                    f.write( self.item( docid + 1))
+                f.write( "</list>\n")
+        return nofFiles
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--items", dest="items", default=10000,
+                      help="Number of items generated as NUM (default %u)" % 10000,
+                      metavar="NUM")
+    parser.add_option("-o", "--output", dest="output", default="data/doc",
+                      help="Write the files to directory DIR (default %s)" % "data/doc",
+                      metavar="DIR")
+    parser.add_option("-f", "--items-per-file", dest="itemsPerFile", default=10000,
+                      help="Number of items per file as NUM (default %u)" % 10000,
+                      metavar="NUM")
+    parser.add_option("-v", "--vocabulary", dest="vocabulary", default=100000,
+                      help="Number of distinct words as NUM (default %u)" % 100000,
+                      metavar="NUM")
+    parser.add_option("-e", "--exponent", dest="exponent", default=1.0,
+                      help="Exponent of the Zipf distribution of the words as NUM (default %.1f)" % 1.0,
+                      metavar="NUM")
+    parser.add_option("-s", "--seed", dest="seed", default=0,
+                      help="Seed of the random generator as NUM (default %u)" % 0,
+                      metavar="NUM")
+    (options, args) = parser.parse_args()
+
+    generator = CorpusGenerator( int( options.seed), int( options.vocabulary), float( options.exponent))
+    nofFiles = generator.write( options.output, int( options.items), int( options.itemsPerFile))
+    print( "Generated %u items in %u files" % (int( options.items), nofFiles))
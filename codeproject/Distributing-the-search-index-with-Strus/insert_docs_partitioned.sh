@@ -0,0 +1,18 @@
+#!/bin/sh
+
+if [ "$#" -lt 1 ]; then
+    echo "Usage: $0 <start-range> [<end-range>]" >&2
+    exit 1
+fi
+
+start=`expr 0 \+ $1`
+if [ "$#" -lt 2 ]; then
+    end=$start
+else
+    end=`expr 0 \+ $2`
+fi
+# Insert the documents into the storage servers chosen by the HTTP server:
+for i in $(seq $start $end)
+do
+    curl -X POST -H "Content-Type: application/xml; charset=UTF-8" --data-binary @data/doc/$i.xml localhost:80/insert
+done
@@ -0,0 +1,88 @@
+import hashlib
+import math
+import struct
+
+# Bloom filter of the terms of a storage, used by the HTTP server to skip
+# the storage servers that cannot contain all terms of a query. A term is
+# represented by 'nofhashes' bits of a bit array, the positions derived
+# from one 128 bit hash of the term (double hashing). A term that was not
+# added is reported as contained with the false positive rate of the
+# filter, a term added is always reported as contained. Terms cannot be
+# removed, the filter is rebuilt when it gets too full.
+
+# Bits per term and number of hashes for a false positive rate of about 1%:
+BITS_PER_TERM = 10
+NOF_HASHES = 7
+# Minimum number of terms a filter is sized for:
+MIN_CAPACITY = 1024
+
+FilterHeader = struct.Struct( ">BI")
+
+# Pair of 64 bit hashes of a term (type and value as bytes), the bit
+# positions for a filter are derived from them by termPositions:
+def termHash( type, value):
+    digest = hashlib.blake2b( type + b"\0" + value, digest_size=16).digest()
+    return struct.unpack( ">QQ", digest)
+
+class BloomFilter( object):
+    def __init__(self, capacity=MIN_CAPACITY, nofhashes=NOF_HASHES, bits=None):
+        if (bits is None):
+            nofbytes = (max( capacity, MIN_CAPACITY) * BITS_PER_TERM + 7) // 8
+            bits = bytearray( nofbytes)
+        self.bits = bits
+        self.nofbits = len( bits) * 8
+        self.nofhashes = nofhashes
+        # Number of terms the filter is sized for and number of terms added:
+        self.capacity = self.nofbits // BITS_PER_TERM
+        self.nofterms = 0
+
+    def positions( self, termhash):
+        h1,h2 = termhash
+        return [ (h1 + hi * h2) % self.nofbits for hi in range( self.nofhashes) ]
+
+    # Add a term, returns the list of the positions of the bytes changed,
+    # empty if the filter did not change. Terms (or false positives) already
+    # contained are not counted:
+    def add( self, type, value):
+        changed = []
+        for pos in self.positions( termHash( type, value)):
+            mask = 1 << (pos & 7)
+            if (not self.bits[ pos >> 3] & mask):
+                self.bits[ pos >> 3] |= mask
+                changed.append( pos >> 3)
+        if (changed):
+            self.nofterms += 1
+        return changed
+
+    # Apply changes of another filter given as pairs (byte position,byte):
+    def update( self, changes):
+        for pos,byte in changes:
+            self.bits[ pos] = byte
+
+    # Test a term by its hash (see termHash), False if definitely not added:
+    def mayContainHash( self, termhash):
+        for pos in self.positions( termhash):
+            if (not self.bits[ pos >> 3] & (1 << (pos & 7))):
+                return False
+        return True
+
+    def mayContain( self, type, value):
+        return self.mayContainHash( termHash( type, value))
+
+    def isFull( self):
+        return self.nofterms > self.capacity
+
+    # Estimated false positive rate with the current number of terms:
+    def falsePositiveRate( self):
+        return (1.0 - math.exp( -float( self.nofhashes * self.nofterms) / self.nofbits)) ** self.nofhashes
+
+    def encode( self):
+        return FilterHeader.pack( self.nofhashes, self.nofbits) + bytes( self.bits)
+
+# Decode a filter encoded with BloomFilter.encode from 'view' at offset 'ofs':
+def decode( view, ofs=0):
+    (nofhashes,nofbits) = FilterHeader.unpack_from( view, ofs)
+    ofs += FilterHeader.size
+    if (len( view) - ofs != nofbits // 8):
+        raise Exception( "term filter size mismatch")
+    return BloomFilter( nofhashes=nofhashes, bits=bytearray( view[ ofs:]))
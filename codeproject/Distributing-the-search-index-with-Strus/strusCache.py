@@ -0,0 +1,42 @@
+import collections
+
+# Map with a bounded size evicting the least recently used entries.
+# Every entry has a cost (default 1) counted against the maximum size:
+class LruCache( object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get( self, key, default=None):
+        entry = self.map.get( key)
+        if (entry is None):
+            self.misses += 1
+            return default
+        self.map.move_to_end( key)
+        self.hits += 1
+        return entry[0]
+
+    def put( self, key, value, cost=1):
+        if (cost > self.maxsize):
+            return
+        entry = self.map.pop( key, None)
+        if (entry is not None):
+            self.size -= entry[1]
+        self.map[ key] = (value, cost)
+        self.size += cost
+        while (self.size > self.maxsize):
+            key,entry = self.map.popitem( last=False)
+            self.size -= entry[1]
+
+    def clear( self):
+        self.map.clear()
+        self.size = 0
+
+    def __len__( self):
+        return len( self.map)
+
+    def hitRate( self):
+        return float( self.hits) / max( 1, self.hits + self.misses)
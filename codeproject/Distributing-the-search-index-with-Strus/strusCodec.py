@@ -0,0 +1,608 @@
+import collections
+import struct
+import zlib
+import tornado.gen
+import strusBloom
+import strusDates
+import strusMessage
+
+# Encoding and decoding of the messages exchanged between the servers.
+# Messages start with a command or reply character ('Y' = ok, 'E' = error)
+# followed by fields tagged with a character. All integers are big endian.
+#
+# Protocol version negotiation:
+#   [V][highest version of client:16]  ->  [Y][version agreed:16]
+# Query of the statistics server:
+#   [Q] {[T][typesize:16][valuesize:16][type][value] | [N] | [V]}
+#       -> [Y] {[value:64]} one value per sub command (df, collection size, version)
+# Query of a storage server:
+#   [Q] {[S][collectionsize:64] | [I][firstrank:16] | [N][nofranks:16]
+#        | [T][df:64][typesize:16][valuesize:16][type][value] | [L]
+#        | [M][from:32][to:32]}
+#       -> [Y] {[_][D][docno:32][W][weight:float][I][size:16][docid]
+#               [T][size:16][title][A][size:16][abstract]}
+#   With [L] (version 2) the storage server takes the df and the collection
+#   size from its local replica of the global statistics, the reply starts
+#   with the version of the statistics used (the versions of all partitions):
+#   [Y][V][nofpartitions:16] {[version:64]} {rows}
+#   [M] (version 2) restricts the results to documents with the date meta
+#   data in the range [from,to] (days since 1877-01-01, 0 and 0xFFFFFFFF
+#   if open)
+# Ranking query of a storage server (first phase of a two phase query):
+#   [R] {same fields as [Q]}  ->  [Y] {[docno:32][weight:float]}
+# Summarization of documents by a storage server (second phase):
+#   [D] {[S][collectionsize:64] | [T]... as in [Q] | [D][docno:32]}
+#       -> [Y] {result rows as for [Q]}
+# Insert of documents into a storage server:
+#   [I][multipart document]  ->  [Y][nofdocuments:32]
+# Publishing statistics to the statistics server:
+#   [P][strus statistics blob]  ->  [Y]
+# Publishing statistics changes merged by the storage server:
+#   [U][nofdocs:64] {[increment:64][typesize:16][valuesize:16][type][value]}  ->  [Y]
+# Number of documents in a storage server:
+#   [N]  ->  [Y][nofdocuments:64]
+# Changes of the global statistics since a version (version 2), the statistics
+# server waits at most 'wait' milliseconds for a change. The reply contains
+# all statistics if the changes since the version are not known anymore:
+#   [C][version:64][wait:32]
+#       -> [Y][version:64][F|D][nofdocs:64] {[df:64][typesize:16][valuesize:16][type][value]}
+#          with F = all statistics (absolute values), D = changes (increments)
+# Bloom filter of the terms of a storage server (version 2), the filter is
+# only sent if its version differs from the version of the request, as the
+# bytes changed since then [D] if the server still knows them, else whole [F]:
+#   [F][version:64]
+#       ->  [Y][version:64] {[F][nofhashes:8][nofbits:32][bits] | [D] {[pos:32][byte:8]}}
+# Histogram of the dates of the documents of a storage server (version 2),
+# [N] if not known, the counts of the buckets from 'firstbucket' on:
+#   [M]  ->  [Y][N] | [Y][D][bucketdays:16][mindate:32][maxdate:32][firstbucket:32] {[count:32]}
+
+# Highest version of the protocol implemented:
+PROTOCOL_VERSION = 2
+
+QueryTerm = collections.namedtuple( 'QueryTerm', ['type', 'value', 'df'])
+Query = collections.namedtuple( 'Query', ['collectionsize', 'firstrank', 'nofranks', 'terms', 'docnos',
+                                          'localstats', 'daterange'])
+ResultRow = collections.namedtuple(
+              'ResultRow', ['docno', 'docid', 'weight', 'title', 'abstract'])
+# Result row of a ranking query without summary, 'server' is the address
+# of the storage server the docno belongs to:
+RankRow = collections.namedtuple( 'RankRow', ['docno', 'weight', 'server'])
+
+UInt16 = struct.Struct( ">H")
+UInt32 = struct.Struct( ">I")
+Int64 = struct.Struct( ">q")
+Float = struct.Struct( ">f")
+TermHeader = struct.Struct( ">cHH")
+QueryTermHeader = struct.Struct( ">cqHH")
+QueryHeader = struct.Struct( ">cqcHcH")
+RowHeader = struct.Struct( ">2sIcfcH")
+RankRowLayout = struct.Struct( ">If")
+DocnoField = struct.Struct( ">cI")
+CollectionSizeField = struct.Struct( ">cq")
+StringHeader = struct.Struct( ">cH")
+DfChangeHeader = struct.Struct( ">qHH")
+VersionField = struct.Struct( ">cq")
+VersionsHeader = struct.Struct( ">cH")
+ChangesRequest = struct.Struct( ">cqI")
+ChangesHeader = struct.Struct( ">qcq")
+DateRangeField = struct.Struct( ">cII")
+DateHistogramHeader = struct.Struct( ">cHIII")
+FilterChange = struct.Struct( ">IB")
+
+class ProtocolError( Exception):
+    pass
+
+def _bytes( obj):
+    if (isinstance( obj, str)):
+        return obj.encode('utf-8')
+    return obj
+
+# Check the reply header and return the offset of its content:
+def checkReply( reply, what):
+    if (reply[0] == ord('E')):
+        raise Exception( "%s failed: %s" % (what, bytes( reply[1:]).decode('utf-8')))
+    elif (reply[0] != ord('Y')):
+        raise ProtocolError( "protocol error %s: unknown reply header %c" % (what, reply[0]))
+    return 1
+
+# [1] Version negotiation:
+def encodeVersionRequest( version=PROTOCOL_VERSION):
+    return b"V" + UInt16.pack( version)
+
+def decodeVersionRequest( message):
+    (version,) = UInt16.unpack_from( message, 1)
+    return version
+
+def encodeVersionReply( clientversion):
+    if (clientversion < 1):
+        raise ProtocolError( "no common protocol version")
+    return b"Y" + UInt16.pack( min( clientversion, PROTOCOL_VERSION))
+
+# Map of server addresses ("host:port") to the protocol version agreed with
+# them. An entry is dropped when a connection to the server is closed, the
+# server may be restarted with another version:
+negotiatedVersions = {}
+
+def forgetVersion( address):
+    negotiatedVersions.pop( address, None)
+
+# Agree on the protocol version to use with a server. Servers not
+# knowing the command 'V' only implement the first version:
+@tornado.gen.coroutine
+def negotiateVersion( msgclient, address, deadline=None):
+    address = strusMessage.addressKey( address)
+    version = negotiatedVersions.get( address)
+    if (version is None):
+        if (forgetVersion not in msgclient.closeCallbacks):
+            msgclient.closeCallbacks.append( forgetVersion)
+        reply = yield msgclient.issueRequest( address, encodeVersionRequest(), deadline)
+        if (reply[0] == ord('Y')):
+            (version,) = UInt16.unpack_from( reply, 1)
+        else:
+            version = 1
+        negotiatedVersions[ address] = version
+    raise tornado.gen.Return( version)
+
+# [2] Statistics server query, 'termkeys' is a list of pairs (type,value) as bytes:
+def encodeStatisticsQuery( termkeys, collectionsize=True, version=True):
+    rt = bytearray( b"Q")
+    for ttype,tvalue in termkeys:
+        rt += TermHeader.pack( b'T', len( ttype), len( tvalue))
+        rt += ttype
+        rt += tvalue
+    if (collectionsize):
+        rt += b'N'
+    if (version):
+        rt += b'V'
+    return rt
+
+# Iterate on the sub commands of a statistics server query as triples
+# (command,type,value), type and value are None for 'N' and 'V':
+def decodeStatisticsQuery( message):
+    view = memoryview( message)
+    ofs = 1
+    size = len( view)
+    while (ofs < size):
+        cmd = view[ ofs]
+        if (cmd == ord('T')):
+            (tag,typesize,valuesize) = TermHeader.unpack_from( view, ofs)
+            ofs += TermHeader.size
+            typeend = ofs + typesize
+            valueend = typeend + valuesize
+            yield ('T', view[ ofs:typeend].tobytes(), view[ typeend:valueend].tobytes())
+            ofs = valueend
+        elif (cmd == ord('N') or cmd == ord('V')):
+            ofs += 1
+            yield (chr( cmd), None, None)
+        else:
+            raise ProtocolError( "unknown statistics server sub command")
+
+def encodeStatisticsReply( values):
+    return b"Y" + struct.pack( ">%dq" % len( values), *values)
+
+def decodeStatisticsReply( reply, nofvalues):
+    ofs = checkReply( reply, "query of global statistics")
+    if (len( reply) != ofs + nofvalues * Int64.size):
+        raise ProtocolError( "statistics result does not match query")
+    return struct.unpack_from( ">%dq" % nofvalues, reply, ofs)
+
+# [3] Storage server query, 'terms' is a list of QueryTerm, 'command' is
+# b"Q" for a query with summaries and b"R" for a ranking query. With
+# 'localstats' the df of the terms and the collection size passed are
+# ignored, the storage server uses its replica of the global statistics.
+# 'daterange' is a pair of day numbers (None if open) restricting the date
+# of the documents or None:
+def encodeQuery( collectionsize, firstrank, nofranks, terms, command=b"Q", localstats=False,
+                 daterange=None):
+    rt = bytearray( command)
+    rt += QueryHeader.pack( b'S', collectionsize, b'I', firstrank, b'N', nofranks)
+    _encodeTerms( rt, terms)
+    if (localstats):
+        rt += b'L'
+    if (daterange is not None):
+        rt += DateRangeField.pack( b'M', daterange[0] or 0,
+                                   0xFFFFFFFF if daterange[1] is None else daterange[1])
+    return rt
+
+# Summarization query for a list of docnos:
+def encodeSummarizeQuery( collectionsize, terms, docnos, localstats=False):
+    rt = bytearray( b"D")
+    rt += CollectionSizeField.pack( b'S', collectionsize)
+    _encodeTerms( rt, terms)
+    if (localstats):
+        rt += b'L'
+    for docno in docnos:
+        rt += DocnoField.pack( b'D', docno)
+    return rt
+
+def _encodeTerms( rt, terms):
+    for term in terms:
+        ttype = _bytes( term.type)
+        tvalue = _bytes( term.value)
+        rt += QueryTermHeader.pack( b'T', term.df, len( ttype), len( tvalue))
+        rt += ttype
+        rt += tvalue
+
+# Decode a query message ([Q], [R] or [D]):
+def decodeQuery( message):
+    view = memoryview( message)
+    collectionsize = 0
+    firstrank = 0
+    nofranks = 20
+    terms = []
+    docnos = []
+    localstats = False
+    daterange = None
+    ofs = 1
+    size = len( view)
+    while (ofs < size):
+        tag = view[ ofs]
+        if (tag == ord('I')):
+            (firstrank,) = UInt16.unpack_from( view, ofs+1)
+            ofs += UInt16.size + 1
+        elif (tag == ord('N')):
+            (nofranks,) = UInt16.unpack_from( view, ofs+1)
+            ofs += UInt16.size + 1
+        elif (tag == ord('S')):
+            (collectionsize,) = Int64.unpack_from( view, ofs+1)
+            ofs += Int64.size + 1
+        elif (tag == ord('T')):
+            (tag,df,typesize,valuesize) = QueryTermHeader.unpack_from( view, ofs)
+            ofs += QueryTermHeader.size
+            typeend = ofs + typesize
+            valueend = typeend + valuesize
+            terms.append( QueryTerm( view[ ofs:typeend].tobytes(),
+                                     view[ typeend:valueend].tobytes(), df))
+            ofs = valueend
+        elif (tag == ord('D')):
+            (tag,docno) = DocnoField.unpack_from( view, ofs)
+            ofs += DocnoField.size
+            docnos.append( docno)
+        elif (tag == ord('L')):
+            localstats = True
+            ofs += 1
+        elif (tag == ord('M')):
+            (tag,mindate,maxdate) = DateRangeField.unpack_from( view, ofs)
+            ofs += DateRangeField.size
+            daterange = (mindate or None, None if maxdate == 0xFFFFFFFF else maxdate)
+        else:
+            raise ProtocolError( "unknown parameter")
+    return Query( collectionsize, firstrank, nofranks, terms, docnos, localstats, daterange)
+
+# [4] Query results, 'results' is a list of dictionaries as returned
+# by strusIR.Backend.evaluateQuery, 'version' the version of the local
+# statistics used for a query with [L] (tuple of the partition versions):
+def encodeQueryResults( results, version=None):
+    rt = bytearray( b"Y")
+    if (version is not None):
+        rt += _encodeStatisticsVersion( version)
+    for result in results:
+        docid = _bytes( result['docid'])
+        title = _bytes( result['title'])
+        abstract = _bytes( result['abstract'])
+        rt += RowHeader.pack( b'_D', result['docno'], b'W', result['weight'], b'I', len( docid))
+        rt += docid
+        rt += StringHeader.pack( b'T', len( title))
+        rt += title
+        rt += StringHeader.pack( b'A', len( abstract))
+        rt += abstract
+    return rt
+
+def _encodeStatisticsVersion( version):
+    return VersionsHeader.pack( b'V', len( version)) + struct.pack( ">%uq" % len( version), *version)
+
+# Version of the statistics at the start of the reply to a query with
+# [L] as pair (version,offset of the rows):
+def decodeStatisticsVersion( reply, ofs):
+    (tag,nofpartitions) = VersionsHeader.unpack_from( reply, ofs)
+    if (tag != b'V'):
+        raise ProtocolError( "statistics version missing in reply")
+    ofs += VersionsHeader.size
+    version = struct.unpack_from( ">%uq" % nofpartitions, reply, ofs)
+    return (version, ofs + nofpartitions * Int64.size)
+
+# Decode the reply of a storage server query into a list of ResultRow,
+# with 'versioned' (reply to a query with [L]) into a pair (version,rows):
+def decodeQueryResults( reply, versioned=False):
+    view = memoryview( reply)
+    ofs = checkReply( view, "query")
+    if (versioned):
+        version,ofs = decodeStatisticsVersion( view, ofs)
+        return (version, _decodeQueryRows( view, ofs))
+    return _decodeQueryRows( view, ofs)
+
+def _decodeQueryRows( view, ofs):
+    size = len( view)
+    rt = []
+    docno = 0
+    docid = None
+    weight = 0.0
+    title = ""
+    abstract = ""
+    while (ofs < size):
+        tag = view[ ofs]
+        if (tag == ord('_')):
+            if (docid is not None):
+                rt.append( ResultRow( docno, docid, weight, title, abstract))
+            docno = 0
+            docid = None
+            weight = 0.0
+            title = ""
+            abstract = ""
+            if (ofs + RowHeader.size <= size):
+                # Fast path for rows in the layout written by encodeQueryResults:
+                (tag,docno,wtag,weight,itag,strsize) = RowHeader.unpack_from( view, ofs)
+                if (tag == b'_D' and wtag == b'W' and itag == b'I'):
+                    ofs += RowHeader.size
+                    docid = str( view[ ofs:ofs+strsize], 'utf-8')
+                    ofs += strsize
+                    continue
+                docno = 0
+                weight = 0.0
+            ofs += 1
+        elif (tag == ord('D')):
+            (docno,) = UInt32.unpack_from( view, ofs+1)
+            ofs += UInt32.size + 1
+        elif (tag == ord('W')):
+            (weight,) = Float.unpack_from( view, ofs+1)
+            ofs += Float.size + 1
+        elif (tag == ord('I') or tag == ord('T') or tag == ord('A')):
+            (tag,strsize) = StringHeader.unpack_from( view, ofs)
+            ofs += StringHeader.size
+            value = str( view[ ofs:ofs+strsize], 'utf-8')
+            ofs += strsize
+            if (tag == b'I'):
+                docid = value
+            elif (tag == b'T'):
+                title = value
+            else:
+                abstract = value
+        else:
+            raise ProtocolError( "unknown result column name")
+    if (docid is not None):
+        rt.append( ResultRow( docno, docid, weight, title, abstract))
+    return rt
+
+# Ranking query results, 'results' is a list of dictionaries as returned
+# by strusIR.Backend.rankQuery:
+def encodeRankResults( results, version=None):
+    rt = bytearray( b"Y")
+    if (version is not None):
+        rt += _encodeStatisticsVersion( version)
+    for result in results:
+        rt += RankRowLayout.pack( result['docno'], result['weight'])
+    return rt
+
+# Decode the reply of a ranking query of the storage server with address
+# 'server' into a list of RankRow, with 'versioned' into a pair (version,rows):
+def decodeRankResults( reply, server, versioned=False):
+    ofs = checkReply( reply, "query")
+    version = None
+    if (versioned):
+        version,ofs = decodeStatisticsVersion( reply, ofs)
+    if ((len( reply) - ofs) % RankRowLayout.size != 0):
+        raise ProtocolError( "ranking query result size mismatch")
+    rows = [ RankRow( docno, weight, server)
+             for docno,weight in RankRowLayout.iter_unpack( memoryview( reply)[ ofs:]) ]
+    if (versioned):
+        return (version, rows)
+    return rows
+
+# [5] Insert of documents:
+def encodeInsert( content):
+    return b"I" + content
+
+def encodeInsertReply( nofdocuments):
+    return b"Y" + UInt32.pack( nofdocuments)
+
+def decodeInsertReply( reply):
+    ofs = checkReply( reply, "insert")
+    (nofdocuments,) = UInt32.unpack_from( reply, ofs)
+    return nofdocuments
+
+# [6] Publishing statistics:
+def encodePublish( blob):
+    return b"P" + blob
+
+# Statistics changes, 'dfchanges' is a list of triples (type,value,increment)
+# with type and value as bytes:
+def encodeStatisticsUpdate( nofdocs, dfchanges):
+    rt = bytearray( b"U")
+    rt += Int64.pack( nofdocs)
+    for type,value,increment in dfchanges:
+        rt += DfChangeHeader.pack( increment, len( type), len( value))
+        rt += type
+        rt += value
+    return rt
+
+# Decode a statistics update message into a pair (nofdocs,dfchanges):
+def decodeStatisticsUpdate( message):
+    view = memoryview( message)
+    (nofdocs,) = Int64.unpack_from( view, 1)
+    return (nofdocs, _decodeDfChanges( view, 1 + Int64.size))
+
+def _decodeDfChanges( view, ofs):
+    size = len( view)
+    dfchanges = []
+    while (ofs < size):
+        (increment,typesize,valuesize) = DfChangeHeader.unpack_from( view, ofs)
+        ofs += DfChangeHeader.size
+        typeend = ofs + typesize
+        valueend = typeend + valuesize
+        if (valueend > size):
+            raise ProtocolError( "statistics update message truncated")
+        dfchanges.append( (view[ ofs:typeend].tobytes(), view[ typeend:valueend].tobytes(), increment))
+        ofs = valueend
+    return dfchanges
+
+# Request of the changes of the statistics since 'version' (None for all
+# statistics), waiting at most 'wait' seconds for a change:
+def encodeStatisticsChangesRequest( version, wait):
+    return ChangesRequest.pack( b'C', -1 if version is None else version, int( wait * 1000))
+
+# Decode a statistics changes request into a pair (version,wait in seconds):
+def decodeStatisticsChangesRequest( message):
+    (cmd,version,wait) = ChangesRequest.unpack_from( message)
+    return (None if version < 0 else version, wait / 1000.0)
+
+# Reply to a statistics changes request, with 'full' the collection size
+# and the df of all terms, otherwise the changes as in the [U] message:
+def encodeStatisticsChanges( version, full, nofdocs, dfchanges):
+    rt = bytearray( b"Y")
+    rt += ChangesHeader.pack( version, b'F' if full else b'D', nofdocs)
+    for type,value,df in dfchanges:
+        rt += DfChangeHeader.pack( df, len( type), len( value))
+        rt += type
+        rt += value
+    return rt
+
+# Decode a statistics changes reply into a tuple (version,full,nofdocs,dfchanges):
+def decodeStatisticsChanges( reply):
+    view = memoryview( reply)
+    ofs = checkReply( view, "get statistics changes")
+    (version,kind,nofdocs) = ChangesHeader.unpack_from( view, ofs)
+    return (version, kind == b'F', nofdocs, _decodeDfChanges( view, ofs + ChangesHeader.size))
+
+# [7] Number of documents of a storage server:
+def encodeNofDocumentsRequest():
+    return b"N"
+
+def encodeNofDocumentsReply( nofdocuments):
+    return b"Y" + Int64.pack( nofdocuments)
+
+def decodeNofDocumentsReply( reply):
+    ofs = checkReply( reply, "get number of documents")
+    (nofdocuments,) = Int64.unpack_from( reply, ofs)
+    return nofdocuments
+
+# [8] Statistics partitioned by term over several statistics servers. All
+# partitions get the changes of the collection size, so every partition
+# knows the collection size, it is taken from the first partition. The
+# partitions are updated independently, so the version of the statistics
+# is the tuple of the versions of all partitions:
+def statisticsPartition( type, value, nofpartitions):
+    if (nofpartitions == 1):
+        return 0
+    return zlib.crc32( value, zlib.crc32( type)) % nofpartitions
+
+# Test if the statistics version 'version' is not older than 'other', that
+# is if no partition has an older version:
+def versionNotOlder( version, other):
+    return all( pv >= po for pv,po in zip( version, other))
+
+# Query the df of the terms 'termkeys' (pairs (type,value) as bytes), the
+# collection size and the version from the statistics servers 'servers'
+# (one per partition). All partitions are queried in parallel, for the
+# df of their terms and their version. The version is None if one of the
+# servers implements only the first version of the protocol (without the
+# version in statistics queries). The requests fail if not answered until
+# 'deadline' (IOLoop time). Returns a triple (dflist,collectionsize,version):
+@tornado.gen.coroutine
+def queryStatistics( msgclient, servers, termkeys, deadline=None):
+    nofpartitions = len( servers)
+    partkeys = [ [] for server in servers ]
+    for ki,(type,value) in enumerate( termkeys):
+        partkeys[ statisticsPartition( type, value, nofpartitions)].append( ki)
+    protocols = yield [ negotiateVersion( msgclient, server, deadline) for server in servers ]
+    versioned = min( protocols) >= 2
+    # Without versions only the first partition (collection size) and the ones of the terms are queried:
+    parts = [ pi for pi in range( nofpartitions) if pi == 0 or partkeys[ pi] or versioned ]
+    replies = yield [ msgclient.issueRequest( servers[ pi], encodeStatisticsQuery(
+                                [ termkeys[ ki] for ki in partkeys[ pi] ], pi == 0, versioned), deadline)
+                      for pi in parts ]
+    dflist = [ 0 ] * len( termkeys)
+    collectionsize = 0
+    version = []
+    for pi,reply in zip( parts, replies):
+        nofkeys = len( partkeys[ pi])
+        nofvalues = nofkeys + (1 if pi == 0 else 0) + (1 if versioned else 0)
+        values = decodeStatisticsReply( reply, nofvalues)
+        for ki,df in zip( partkeys[ pi], values):
+            dflist[ ki] = df
+        if (pi == 0):
+            collectionsize = values[ nofkeys]
+        if (versioned):
+            version.append( values[ -1])
+    raise tornado.gen.Return( (dflist, collectionsize, tuple( version) if versioned else None))
+
+# [9] Term filters of the storage servers:
+# Request of the term filter if its version differs from 'version' (None
+# if no filter is known):
+def encodeTermFilterRequest( version):
+    return VersionField.pack( b'F', -1 if version is None else version)
+
+def decodeTermFilterRequest( message):
+    (cmd,version) = VersionField.unpack_from( message)
+    return None if version < 0 else version
+
+# Reply with the version and the term filter 'termfilter' (a BloomFilter)
+# or its 'changes' since the version of the request as pairs (byte
+# position,byte), with none of them if it did not change:
+def encodeTermFilterReply( version, termfilter=None, changes=None):
+    rt = bytearray( b"Y" + Int64.pack( version))
+    if (termfilter is not None):
+        rt += b'F'
+        rt += termfilter.encode()
+    elif (changes is not None):
+        rt += b'D'
+        for pos,byte in changes:
+            rt += FilterChange.pack( pos, byte)
+    return rt
+
+# Decode a term filter reply into a triple (version,filter,changes), the
+# filter is None if it did not change since the version of the request
+# or if only the changes (pairs (byte position,byte)) were sent:
+def decodeTermFilterReply( reply):
+    view = memoryview( reply)
+    ofs = checkReply( view, "get term filter")
+    (version,) = Int64.unpack_from( view, ofs)
+    ofs += Int64.size
+    if (ofs == len( view)):
+        return (version, None, None)
+    if (view[ ofs] == ord('F')):
+        return (version, strusBloom.decode( view, ofs + 1), None)
+    elif (view[ ofs] == ord('D')):
+        if ((len( view) - ofs - 1) % FilterChange.size != 0):
+            raise ProtocolError( "term filter changes size mismatch")
+        return (version, None, list( FilterChange.iter_unpack( view[ ofs + 1:])))
+    raise ProtocolError( "unknown term filter reply")
+
+# [10] Date histograms of the storage servers:
+def encodeDateHistogramRequest():
+    return b"M"
+
+# Reply with the date histogram 'histogram' (a strusDates.DateHistogram,
+# None if not known):
+def encodeDateHistogramReply( histogram):
+    if (histogram is None):
+        return b"YN"
+    rt = bytearray( b"Y")
+    if (histogram.mindate is None):
+        rt += DateHistogramHeader.pack( b'D', histogram.bucketdays, 0xFFFFFFFF, 0, 0)
+        return rt
+    firstbucket = histogram.mindate // histogram.bucketdays
+    lastbucket = histogram.maxdate // histogram.bucketdays
+    rt += DateHistogramHeader.pack( b'D', histogram.bucketdays, histogram.mindate, histogram.maxdate,
+                                    firstbucket)
+    rt += struct.pack( ">%dI" % (lastbucket - firstbucket + 1),
+                       *[ histogram.counts.get( bucket, 0) for bucket in range( firstbucket, lastbucket + 1) ])
+    return rt
+
+# Decode a date histogram reply, returns None if the histogram is not known:
+def decodeDateHistogramReply( reply):
+    view = memoryview( reply)
+    ofs = checkReply( view, "get date histogram")
+    if (view[ ofs] == ord('N')):
+        return None
+    (tag,bucketdays,mindate,maxdate,firstbucket) = DateHistogramHeader.unpack_from( view, ofs)
+    ofs += DateHistogramHeader.size
+    if ((len( view) - ofs) % UInt32.size != 0):
+        raise ProtocolError( "date histogram size mismatch")
+    rt = strusDates.DateHistogram( bucketdays)
+    for bi,(count,) in enumerate( UInt32.iter_unpack( view[ ofs:])):
+        if (count):
+            rt.counts[ firstbucket + bi] = count
+    if (rt.counts):
+        rt.mindate = mindate
+        rt.maxdate = maxdate
+    return rt
@@ -0,0 +1,127 @@
+import datetime
+import os
+import struct
+
+# Dates of the documents as stored in the "date" meta data element: days
+# since 1877-01-01 as with the "date2int" normalizer of the analyzer. The
+# storage servers summarize the dates of their documents in a histogram,
+# so that the HTTP server can skip storage servers without documents in
+# the date range of a query.
+
+dateBase = datetime.date( 1877, 1, 1)
+# Number of days per bucket of the date histogram of a storage:
+BUCKET_DAYS = 365
+
+def dayNumber( date):
+    return max( 0, (date - dateBase).days)
+
+# Date of the format "YYYY-MM-DD hh:mm:ss" as day number, 0 if not parseable:
+def dateToInt( value):
+    try:
+        return dayNumber( datetime.datetime.strptime( value.strip()[:10], "%Y-%m-%d").date())
+    except ValueError:
+        return 0
+
+# Bound of a date range of a query given as YYYY-MM-DD or YYYY (the first
+# day of the year, the last day with 'upper') as day number, None if empty:
+def parseDateBound( value, upper=False):
+    if (not value):
+        return None
+    try:
+        if (len( value) == 4):
+            date = datetime.date( int( value), 12, 31) if upper else datetime.date( int( value), 1, 1)
+        else:
+            date = datetime.datetime.strptime( value, "%Y-%m-%d").date()
+    except ValueError:
+        raise Exception( "invalid date '%s' (expected YYYY-MM-DD or YYYY)" % value)
+    return dayNumber( date)
+
+# Test if a day number is in a date range (pair of day numbers, None if open):
+def inRange( date, daterange):
+    return (daterange[0] is None or date >= daterange[0]) and (daterange[1] is None or date <= daterange[1])
+
+# Summary of the dates of the documents of a storage: the smallest and
+# the biggest date and the number of documents per bucket of 'bucketdays'
+# days (bucket i counts the days from i*bucketdays to (i+1)*bucketdays-1):
+class DateHistogram( object):
+    def __init__(self, bucketdays=BUCKET_DAYS):
+        self.bucketdays = bucketdays
+        self.counts = {}
+        self.mindate = None
+        self.maxdate = None
+
+    def add( self, date, count=1):
+        bucket = date // self.bucketdays
+        self.counts[ bucket] = self.counts.get( bucket, 0) + count
+        if (self.mindate is None or date < self.mindate):
+            self.mindate = date
+        if (self.maxdate is None or date > self.maxdate):
+            self.maxdate = date
+
+    def nofDocuments( self):
+        return sum( self.counts.values())
+
+    def copy( self):
+        rt = DateHistogram( self.bucketdays)
+        rt.counts = dict( self.counts)
+        rt.mindate = self.mindate
+        rt.maxdate = self.maxdate
+        return rt
+
+    # Buckets overlapping with the date range (pair of day numbers, None if
+    # open) restricted to the dates of the documents, empty if disjoint:
+    def buckets( self, daterange):
+        if (self.mindate is None):
+            return range( 0)
+        start = self.mindate if daterange[0] is None else max( daterange[0], self.mindate)
+        end = self.maxdate if daterange[1] is None else min( daterange[1], self.maxdate)
+        if (start > end):
+            return range( 0)
+        return range( start // self.bucketdays, end // self.bucketdays + 1)
+
+    # Test if documents may have a date in the range 'daterange':
+    def mayMatch( self, daterange):
+        return any( self.counts.get( bucket) for bucket in self.buckets( daterange))
+
+# File of the date histogram of a storage (all integers little endian):
+#   [magic:8] [nof documents of the storage:64] [bucketdays:16]
+#   [mindate:32] [maxdate:32] [nof buckets:32] {[bucket:32] [count:64]}
+# The number of documents of the storage when the file was written tells
+# if the histogram is up to date with the storage.
+HistogramMagic = b"STRUSDH1"
+HistogramHeader = struct.Struct( "<8sqHIII")
+HistogramBucket = struct.Struct( "<Iq")
+
+# Write the histogram of a storage with 'nofdocs' documents to a file. The
+# file is written under a temporary name and renamed. It is not flushed to
+# disk, a file lost or not up to date after a crash is detected by
+# readHistogram with the number of documents:
+def writeHistogram( histogram, nofdocs, path):
+    tmppath = path + ".tmp"
+    with open( tmppath, "wb") as f:
+        f.write( HistogramHeader.pack( HistogramMagic, nofdocs, histogram.bucketdays,
+                                       histogram.mindate or 0, histogram.maxdate or 0,
+                                       len( histogram.counts)))
+        for bucket,count in sorted( histogram.counts.items()):
+            f.write( HistogramBucket.pack( bucket, count))
+    os.rename( tmppath, path)
+
+# Read a histogram written with writeHistogram, None if the file is not
+# valid or if the histogram is not the one of a storage with 'nofdocs'
+# documents:
+def readHistogram( path, nofdocs):
+    with open( path, "rb") as f:
+        content = f.read()
+    if (len( content) < HistogramHeader.size):
+        return None
+    (magic,filedocs,bucketdays,mindate,maxdate,nofbuckets) = HistogramHeader.unpack_from( content, 0)
+    if (magic != HistogramMagic or filedocs != nofdocs
+        or len( content) != HistogramHeader.size + nofbuckets * HistogramBucket.size):
+        return None
+    rt = DateHistogram( bucketdays)
+    if (nofbuckets > 0):
+        rt.counts = dict( HistogramBucket.iter_unpack( content[ HistogramHeader.size:]))
+        rt.mindate = mindate
+        rt.maxdate = maxdate
+    return rt
+
@@ -3,161 +3,691 @@ import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import tornado.gen
+import tornado.iostream
+import tornado.concurrent
+import abc
 import os
 import sys
+import re
+import zlib
+import bisect
 import struct
 import binascii
 import collections
 import heapq
 import optparse
 import signal
+import time
 import strus
 import strusMessage
+import strusCache
+import strusCodec
+import strusMetrics
+import strusTrace
+import strusBloom
+import strusDates
 
 # [0] Globals and helper classes:
-# The address of the global statistics server:
-statserver = "localhost:7183"
-# Strus storage server addresses:
+# The addresses of the global statistics servers, one per partition of the terms:
+statservers = [ "localhost:7183" ]
+# Strus storage server groups, one list of replica addresses per group:
 storageservers = []
-# Strus client connection factory:
-msgclient = strusMessage.RequestClient()
+# Evaluate queries in two phases (ranking on all storage servers, then
+# summarization of the final result page only):
+twophase = False
+# Evaluate queries with the replicas of the global statistics on the storage
+# servers instead of querying the statistics server first:
+localstats = False
+# Strus client connection pool (created in main with the configured limits):
+msgclient = None
+
+# Cache of the global statistics (document frequencies of terms and
+# collection size). Entries belong to a version of the statistics; the
+# version is revalidated with the statistics server when it was last
+# checked more than 'maxstale' seconds ago:
+class StatisticsCache( object):
+    def __init__(self, maxsize, maxstale):
+        self.dfmap = strusCache.LruCache( maxsize)
+        self.maxstale = maxstale
+        self.version = None
+        self.collectionsize = 0
+        self.validated = 0.0
+
+    def isFresh( self, now):
+        return self.version is not None and now - self.validated <= self.maxstale
+
+    def get( self, key):
+        if (self.version is None):
+            return None
+        return self.dfmap.get( key)
+
+    def put( self, key, df):
+        self.dfmap.put( key, df)
+
+    # Update the cache with the current version of the statistics, all
+    # entries of an older version are dropped:
+    def validate( self, version, collectionsize, now):
+        if (version != self.version):
+            self.dfmap.clear()
+            self.version = version
+        self.collectionsize = collectionsize
+        self.validated = now
+
+# Cache of the global statistics (configured in main):
+statscache = StatisticsCache( 0, 0.0)
+
+# Cache of merged query results keyed by the analyzed query terms, the
+# date range and the number of results fetched. The number of results fetched is rounded up
+# to a multiple of 'window', so that the following pages of a query are
+# served from the same entry. Entries belong to a version of the global
+# statistics, that is increased by the storage servers on every insert:
+class ResultCache( object):
+    def __init__(self, maxrows, window):
+        self.map = strusCache.LruCache( maxrows)
+        self.window = window
+        self.hits = 0
+        self.misses = 0
+
+    # Normalized key of the analyzed query terms and the date range:
+    def queryKey( self, terms, daterange):
+        return (tuple( sorted( (term['type'], term['value']) for term in terms)), daterange)
+
+    def depth( self, maxnofresults):
+        if (self.map.maxsize <= 0 or self.window <= 0):
+            return maxnofresults
+        return ((maxnofresults + self.window - 1) // self.window) * self.window
+
+    # Results are only cached for a known version of the statistics:
+    def get( self, querykey, maxnofresults, version):
+        if (version is None):
+            return None
+        entry = self.map.get( (querykey, self.depth( maxnofresults)))
+        if (entry is None or entry[0] != version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put( self, querykey, maxnofresults, version, merged):
+        if (version is None):
+            return
+        self.map.put( (querykey, self.depth( maxnofresults)), (version, merged), len( merged) + 1)
+
+# Cache of merged query results (configured in main):
+resultcache = ResultCache( 0, 0)
+strusMetrics.registry.gauge( "resultcache_hits", "Number of queries served from the result cache",
+                             lambda: resultcache.hits)
+strusMetrics.registry.gauge( "resultcache_misses", "Number of queries not found in the result cache",
+                             lambda: resultcache.misses)
+strusMetrics.registry.gauge( "resultcache_rows", "Number of result rows in the result cache",
+                             lambda: resultcache.map.size)
+
+# Minimum number of results fetched from a storage server in one batch,
+# 0 to fetch all results of a query from every server in one request:
+fetchbatch = 10
+rowsFetchedCounter = strusMetrics.registry.counter(
+                        "query_rows_fetched", "Result rows fetched from the storage servers")
+rowsUsedCounter = strusMetrics.registry.counter(
+                        "query_rows_used", "Result rows fetched used in merged results")
+
+# Maximum time in seconds for answering a query and maximum time
+# for the answer of one storage server group:
+querydeadline = 2.0
+shardtimeout = 1.0
+hedgedCounter = strusMetrics.registry.counter(
+                        "query_hedged_requests", "Requests issued to a replica after the p95 was exceeded")
+shardTimeoutCounter = strusMetrics.registry.counter(
+                        "query_shard_timeouts", "Storage server groups not answering within the deadline")
+
+# Histograms of the time spent in the stages of the query evaluation, of
+# the whole query and the number of queries in process:
+stageHistograms = {}
+def stageHistogram( stage):
+    rt = stageHistograms.get( stage)
+    if (rt is None):
+        rt = strusMetrics.registry.histogram( "query_%s_seconds" % stage,
+                        "Time spent in the query stage '%s' in seconds" % stage)
+        stageHistograms[ stage] = rt
+    return rt
+queryHistogram = strusMetrics.registry.histogram(
+                        "query_seconds", "Time to answer a query in seconds")
+queriesInflight = strusMetrics.registry.gauge(
+                        "queries_inflight", "Number of queries in process")
+localstatsFallbackCounter = strusMetrics.registry.counter(
+                        "query_localstats_fallbacks",
+                        "Queries evaluated again with the statistics server because the "
+                        "storage servers answered with different statistics versions")
+
+# Sliding window of the latest response times of a storage server. The
+# 95th percentile decides when a request to the server is hedged:
+class LatencyWindow( object):
+    def __init__(self, size=200, minsamples=20):
+        self.samples = collections.deque( maxlen=size)
+        self.minsamples = minsamples
+        self.p95 = None
+        self.modified = False
+
+    def add( self, latency):
+        self.samples.append( latency)
+        self.modified = True
+
+    # Return the 95th percentile or None if there are too few samples:
+    def percentile95( self):
+        if (self.modified and len( self.samples) >= self.minsamples):
+            ordered = sorted( self.samples)
+            self.p95 = ordered[ (len( ordered) * 95) // 100]
+            self.modified = False
+        return self.p95
+
+# Routing of queries to the replicas of a storage server group:
+# 'outstanding' prefers the replica with the least requests in flight,
+# 'ewma' the one with the lowest moving average of response times:
+routing = "outstanding"
+# Number of failures in a row after that a replica is ejected and the
+# number of seconds it is ejected before it is used again:
+maxfailures = 3
+ejecttime = 10.0
+
+# State of a storage server used for routing queries to it:
+class ReplicaState( object):
+    def __init__(self, address):
+        self.address = address
+        self.latency = LatencyWindow()
+        self.ewma = 0.0
+        self.outstanding = 0
+        # Number of ejections, requests issued before the last ejection
+        # are not counted as outstanding anymore:
+        self.ejections = 0
+        self.failures = 0
+        self.ejectedUntil = 0.0
+
+    # Count a request issued, returns the value to pass to 'finished':
+    def issued( self):
+        self.outstanding += 1
+        return self.ejections
+
+    def finished( self, ejections):
+        if (ejections == self.ejections):
+            self.outstanding -= 1
+
+    def succeeded( self, latency):
+        self.latency.add( latency)
+        if (self.ewma == 0.0):
+            self.ewma = latency
+        else:
+            self.ewma += 0.2 * (latency - self.ewma)
+        self.failures = 0
+
+    # Count a failure, the replica is ejected after too many failures in
+    # a row. A replica readmitted is ejected again on its first failure.
+    # The requests outstanding are forgotten on ejection, so a replica
+    # readmitted is routed to by its new requests only:
+    def failed( self, now):
+        self.failures += 1
+        if (self.failures >= maxfailures):
+            if (not self.isEjected( now)):
+                self.ejections += 1
+                self.outstanding = 0
+            self.ejectedUntil = now + ejecttime
+
+    def isEjected( self, now):
+        return self.ejectedUntil > now
+
+    def load( self):
+        if (routing == "ewma"):
+            return (self.ewma, self.outstanding)
+        return (self.outstanding, self.ewma)
+
+# Map of storage server addresses to their ReplicaState:
+replicastates = {}
+
+def replicaState( address):
+    rt = replicastates.get( address)
+    if (rt is None):
+        rt = ReplicaState( address)
+        replicastates[ address] = rt
+    return rt
+
+# Order the replicas of a group by preference, the ejected ones last:
+def routeReplicas( replicas):
+    if (len( replicas) == 1):
+        return replicas
+    now = time.time()
+    states = [ replicaState( address) for address in replicas ]
+    states.sort( key=lambda state: (state.isEjected( now), state.load()))
+    return [ state.address for state in states ]
+
+strusMetrics.registry.gauge( "replicas_ejected", "Number of storage servers currently ejected",
+                             lambda: sum( 1 for state in list( replicastates.values())
+                                          if state.isEjected( time.time())))
+strusMetrics.registry.gauge( "storage_requests_inflight", "Number of requests to storage servers in flight",
+                             lambda: sum( state.outstanding for state in list( replicastates.values())))
+
+# Return a future resolved with the first one of 'futures' done:
+def firstDone( futures):
+    rt = tornado.concurrent.Future()
+    def done( future):
+        if (not rt.done()):
+            rt.set_result( future)
+    for future in futures:
+        tornado.concurrent.future_add_done_callback( future, done)
+    return rt
+
+# Summaries of the storage server groups (term filters, date histograms)
+# used to skip the groups that cannot contain results of a query. The
+# summary of a group is fetched from one of its replicas. A storage server
+# updates its summaries before the version of the global statistics changes
+# with an insert, so summaries fetched after the HTTP server saw a version
+# are valid for that version. Summaries older than the version of a query
+# are not used, they are refreshed in the background meanwhile, so queries
+# never wait for them. A group without summary (not fetched or failed) is
+# never skipped. Subclasses implement fetchSummary and match:
+class ShardSummaries( abc.ABC):
+    def __init__(self, groups, name, help):
+        self.groups = groups
+        self.summaries = [ None for group in groups ]
+        # Version of the global statistics the summaries are valid for:
+        self.statsversion = None
+        self.refreshing = False
+        self.errors = strusMetrics.registry.counter( name + "_errors", help)
+
+    # Fetch the summary of the group 'gi' from the replica 'address' (coroutine):
+    @abc.abstractmethod
+    def fetchSummary( self, gi, address):
+        pass
+
+    # Test if a summary may match 'condition':
+    @abc.abstractmethod
+    def match( self, summary, condition):
+        pass
+
+    @tornado.gen.coroutine
+    def fetch( self, gi):
+        address = routeReplicas( self.groups[ gi])[0]
+        try:
+            version = yield strusCodec.negotiateVersion( msgclient, address)
+            if (version < 2):
+                raise Exception( "shard summaries not supported")
+            self.summaries[ gi] = yield self.fetchSummary( gi, address)
+        except Exception:
+            self.errors.inc()
+            self.summaries[ gi] = None
+
+    # Refresh the summaries of all groups for the statistics version 'statsversion':
+    @tornado.gen.coroutine
+    def refresh( self, statsversion):
+        self.refreshing = True
+        try:
+            yield [ self.fetch( gi) for gi in range( len( self.groups)) ]
+            self.statsversion = statsversion
+        finally:
+            self.refreshing = False
+
+    # Indices of the groups among 'selected' that may match 'condition' with
+    # the statistics version 'statsversion' (the versions of the partitions
+    # increase with every change). All of them if the summaries are not
+    # known to be valid for this version:
+    def select( self, selected, condition, statsversion):
+        if (statsversion is None):
+            return selected
+        if (self.statsversion is None or not strusCodec.versionNotOlder( self.statsversion, statsversion)):
+            if (not self.refreshing):
+                tornado.ioloop.IOLoop.current().spawn_callback( self.refresh, statsversion)
+            return selected
+        return [ gi for gi in selected
+                 if self.summaries[ gi] is None or self.match( self.summaries[ gi], condition) ]
+
+# Bloom filters of the terms of the storage server groups, the condition
+# is the list of the hashes of the query terms:
+class TermFilters( ShardSummaries):
+    def __init__(self, groups):
+        ShardSummaries.__init__( self, groups, "term_filter",
+                                 "Failed requests for term filters of storage servers")
+        # Pair (address,version) of the filter of every group:
+        self.sources = [ None for group in groups ]
+
+    # The filter is only transferred if it changed, as the changes to the
+    # filter known if the storage server still has them:
+    @tornado.gen.coroutine
+    def fetchSummary( self, gi, address):
+        source = self.sources[ gi]
+        known = source[1] if source is not None and source[0] == address else None
+        self.sources[ gi] = None
+        reply = yield msgclient.issueRequest( address, strusCodec.encodeTermFilterRequest( known))
+        version,filter,changes = strusCodec.decodeTermFilterReply( reply)
+        if (filter is None):
+            filter = self.summaries[ gi]
+            if (changes is not None):
+                filter.update( changes)
+        self.sources[ gi] = (address, version)
+        raise tornado.gen.Return( filter)
+
+    def match( self, filter, termhashes):
+        return all( filter.mayContainHash( termhash) for termhash in termhashes)
+
+    # Condition of the terms 'termkeys' (pairs (type,value) as bytes):
+    def condition( self, termkeys):
+        return [ strusBloom.termHash( type, value) for type,value in termkeys ]
+
+# Histograms of the dates of the documents of the storage server groups,
+# the condition is a date range:
+class DateHistograms( ShardSummaries):
+    def __init__(self, groups):
+        ShardSummaries.__init__( self, groups, "date_histogram",
+                                 "Failed requests for date histograms of storage servers")
+
+    @tornado.gen.coroutine
+    def fetchSummary( self, gi, address):
+        reply = yield msgclient.issueRequest( address, strusCodec.encodeDateHistogramRequest())
+        raise tornado.gen.Return( strusCodec.decodeDateHistogramReply( reply))
+
+    def match( self, histogram, daterange):
+        return histogram.mayMatch( daterange)
+
+# Term filters of the storage server groups (None if not used, created in main):
+termfilters = None
+shardsPrunedCounter = strusMetrics.registry.counter(
+                        "query_shards_pruned",
+                        "Storage server groups not queried because a query term is not in their term filter")
+# Date histograms of the storage server groups (None if not used, created in main):
+datehistograms = None
+shardsPrunedDatesCounter = strusMetrics.registry.counter(
+                        "query_shards_pruned_daterange",
+                        "Storage server groups not queried because they have no documents in the date range")
 
 # Query analyzer structures (parallel to document analyzer definition in strusIR):
 strusctx = strus.Context()
 analyzer = strusctx.createQueryAnalyzer()
 analyzer.addElement( "word", "text", "word", ["lc", ["stem", "en"], ["convdia", "en"]])
 
+# Cache of the query analysis results: maps the query string to the list
+# of analyzed terms. The size is accounted as estimated memory use in
+# bytes. With 'pertoken' the terms of single tokens are cached too, so that
+# a new query composed of known words is analyzed without the analyzer.
+# Only queries consisting of words (letters and digits) separated by spaces
+# are analyzed word by word, others as a whole, because the "word" tokenizer
+# of the analyzer might split or join them differently (e.g. at hyphens,
+# apostrophes or underscores). The term lists returned are shared and must
+# not be changed:
+class QueryAnalysisCache( object):
+    tokenQueryPattern = re.compile( r"\s*[^\W_]+(\s+[^\W_]+)*\s*")
+
+    def __init__(self, maxbytes, pertoken):
+        self.queries = strusCache.LruCache( maxbytes)
+        self.tokens = strusCache.LruCache( maxbytes) if pertoken else None
+
+    # Estimated memory used by an entry in bytes:
+    def cost( self, key, terms):
+        return 120 + len( key) + sum( 160 + len( term['type']) + len( term['value']) for term in terms)
+
+    def analyzeTokens( self, querystr):
+        rt = []
+        for token in querystr.split():
+            terms = self.tokens.get( token)
+            if (terms is None):
+                terms = analyzer.analyzeTermExpression( ["text", token])
+                self.tokens.put( token, terms, self.cost( token, terms))
+            rt.extend( terms)
+        return rt
+
+    def analyze( self, querystr):
+        if (self.queries.maxsize <= 0):
+            return analyzer.analyzeTermExpression( ["text", querystr])
+        rt = self.queries.get( querystr)
+        if (rt is None):
+            if (self.tokens is not None and self.tokenQueryPattern.fullmatch( querystr)):
+                rt = self.analyzeTokens( querystr)
+            else:
+                rt = analyzer.analyzeTermExpression( ["text", querystr])
+            self.queries.put( querystr, rt, self.cost( querystr, rt))
+        return rt
+
+# Cache of the query analysis results (configured in main):
+analysiscache = QueryAnalysisCache( 0, False)
+strusMetrics.registry.gauge( "analysiscache_hits", "Number of queries found in the analysis cache",
+                             lambda: analysiscache.queries.hits)
+strusMetrics.registry.gauge( "analysiscache_misses", "Number of queries not found in the analysis cache",
+                             lambda: analysiscache.queries.misses)
+strusMetrics.registry.gauge( "analysiscache_bytes", "Estimated memory used by the analysis cache",
+                             lambda: analysiscache.queries.size)
+strusMetrics.registry.gauge( "analysiscache_token_hits", "Number of words found in the token cache",
+                             lambda: analysiscache.tokens.hits if analysiscache.tokens else 0)
+strusMetrics.registry.gauge( "analysiscache_token_misses", "Number of words not found in the token cache",
+                             lambda: analysiscache.tokens.misses if analysiscache.tokens else 0)
+
 # Query evaluation structures:
-ResultRow = collections.namedtuple(
-              'ResultRow', ['docno', 'docid', 'weight', 'title', 'abstract'])
+ResultRow = strusCodec.ResultRow
 
 
 # [1] HTTP handlers:
 # Answer a query (issue a query to all storage servers and merge it to one result):
 class QueryHandler( tornado.web.RequestHandler ):
+    def initialize( self):
+        # Result rows fetched from the storage servers for this query and the ones used:
+        self.rowsFetched = 0
+        self.rowsUsed = 0
+        # Time (of the IO loop) the answer of the query is due:
+        self.deadline = tornado.ioloop.IOLoop.current().time() + querydeadline
+        # Time spent in the stages of the query evaluation in seconds:
+        self.timing = collections.OrderedDict()
+        # Root span of the trace of this query if it is traced:
+        self.trace = None
+        # Versions of the statistics replicas used by the storage servers:
+        self.versions = set()
+
+    # Add the time elapsed since 'start' to the time spent in a stage:
+    def addTiming( self, stage, start):
+        end = time.time()
+        self.timing[ stage] = self.timing.get( stage, 0.0) + end - start
+        stageHistogram( stage).observe( end - start)
+        strusTrace.record( stage, start, end)
+
+    # Stage times as value of a Server-Timing header (in milliseconds):
+    def serverTiming( self):
+        return ", ".join( "%s;dur=%.3f" % (stage, duration * 1000.0)
+                          for stage,duration in self.timing.items())
+
     @tornado.gen.coroutine
     def queryStats( self, terms):
         rt = ([],0,None)
         try:
-            statquery = b"Q"
-            for term in terms:
-                ttype = term['type'].encode('utf-8')
-                tvalue = term['value'].encode('utf-8')
-                statquery += b'T'
-                typesize = len( ttype)
-                valuesize = len( tvalue)
-                statquery += struct.pack( ">HH", typesize, valuesize)
-                statquery += struct.pack( "%ds%ds" % (typesize,valuesize), ttype, tvalue)
-            statquery += b'N'
-            ri = statserver.rindex(':')
-            host,port = statserver[:ri],int( statserver[ri+1:])
-            conn = yield msgclient.connect( host, port)
-            statreply = yield msgclient.issueRequest( conn, statquery)
-
-            if (statreply[0] == ord('E')):
-                raise Exception( "failed to query global statistics: %s" % statreply[1:])
-            elif (statreply[0] != ord('Y')):
-                raise Exception( "protocol error loading global statistics")
-            dflist = []
-            collsize = 0
-            statsofs = 1
-            statslen = len(statreply)
-            while (statsofs < statslen):
-                (statsval,) = struct.unpack_from( ">q", statreply, statsofs)
-                statsofs += struct.calcsize( ">q")
-                if (len(dflist) < len(terms)):
-                    dflist.append( statsval)
-                elif (len(dflist) == len(terms)):
-                    collsize = statsval
-                else:
-                    break
-            if (statsofs != statslen):
-                raise Exception("result does not match query")
-            rt = (dflist, collsize, None)
+            keys = [ (term['type'].encode('utf-8'), term['value'].encode('utf-8'))
+                     for term in terms ]
+            now = time.time()
+            fresh = statscache.isFresh( now)
+            dflist = [ statscache.get( key) for key in keys ]
+            if (fresh and not None in dflist):
+                # All statistics cached and validated within the staleness bound:
+                rt = (dflist, statscache.collectionsize, None)
+            else:
+                # Fetch the df of the terms missing or of all terms if the cache
+                # has to be revalidated, the collection size and the version:
+                fetchidx = [ ii for ii in range( len( keys)) if not fresh or dflist[ ii] is None ]
+                while (True):
+                    values,collsize,version = yield tornado.gen.with_timeout(
+                                        self.deadline, strusCodec.queryStatistics(
+                                            msgclient, statservers, [ keys[ ii] for ii in fetchidx ],
+                                            self.deadline))
+                    if (len( fetchidx) == len( keys) or version == statscache.version):
+                        break
+                    # The statistics changed since the cache was validated, the
+                    # df of the cached terms do not match the ones fetched:
+                    fetchidx = list( range( len( keys)))
+                statscache.validate( version, collsize, now)
+                for ii,df in zip( fetchidx, values):
+                    dflist[ ii] = df
+                    statscache.put( keys[ ii], df)
+                rt = (dflist, collsize, None)
+        except tornado.gen.TimeoutError:
+            rt = ([],0,"query statistic server did not answer within the deadline")
         except Exception as e:
             rt = ([],0,"query statistic server failed: %s" % e)
         raise tornado.gen.Return( rt)
 
+    # Issue a query to a storage server, with 'versioned' a query evaluated
+    # with the local statistics of the server, the version of the statistics
+    # of the reply is added to 'self.versions'. The request is given up if
+    # not answered until 'deadline' (IOLoop time):
     @tornado.gen.coroutine
-    def issueQuery( self, serveraddr, qryblob):
+    def issueQuery( self, serveraddr, qryblob, versioned, deadline):
         rt = (None,None)
-        ri = serveraddr.rindex(':')
-        host,port = serveraddr[:ri],int( serveraddr[ri+1:])
-        result = None
-        conn = None
+        host,port = strusMessage.parseAddress( serveraddr)
+        state = replicaState( serveraddr)
+        ejections = state.issued()
         try:
-            conn = yield msgclient.connect( host, port)
-            reply = yield msgclient.issueRequest( conn, qryblob)
-            if (reply[0] == ord('E')):
-                rt = (None, "storage server %s:%d returned error: %s"
-                              % (host, port, reply[1:]))
-            elif (reply[0] == ord('Y')):
-                result = []
-                row_docno = 0
-                row_docid = None
-                row_weight = 0.0
-                row_title = ""
-                row_abstract = ""
-                replyofs = 1
-                replysize = len(reply)-1
-                while (replyofs < replysize):
-                    if (reply[ replyofs] == ord('_')):
-                        if (row_docid != None):
-                            result.append( ResultRow(
-                                 row_docno, row_docid, row_weight, row_title, row_abstract))
-                        row_docno = 0
-                        row_docid = None
-                        row_weight = 0.0
-                        row_title = ""
-                        row_abstract = ""
-                        replyofs += 1
-                    elif (reply[ replyofs] == ord('D')):
-                        (row_docno,) = struct.unpack_from( ">I", reply, replyofs+1)
-                        replyofs += struct.calcsize( ">I") + 1
-                    elif (reply[ replyofs] == ord('W')):
-                        (row_weight,) = struct.unpack_from( ">f", reply, replyofs+1)
-                        replyofs += struct.calcsize( ">f") + 1
-                    elif (reply[ replyofs] == ord('I')):
-                        (docidlen,) = struct.unpack_from( ">H", reply, replyofs+1)
-                        replyofs += struct.calcsize( ">H") + 1
-                        (row_docid,) = struct.unpack_from( "%us" % docidlen, reply, replyofs)
-                        replyofs += docidlen
-                    elif (reply[ replyofs] == ord('T')):
-                        (titlelen,) = struct.unpack_from( ">H", reply, replyofs+1)
-                        replyofs += struct.calcsize( ">H") + 1
-                        (row_title,) = struct.unpack_from( "%us" % titlelen, reply, replyofs)
-                        replyofs += titlelen
-                    elif (reply[ replyofs] == ord('A')):
-                        (abstractlen,) = struct.unpack_from( ">H", reply, replyofs+1)
-                        replyofs += struct.calcsize( ">H") + 1
-                        (row_abstract,) = struct.unpack_from( "%us" % abstractlen, reply, replyofs)
-                        replyofs += abstractlen
-                    else:
-                        rt = (None, "storage server %s:%u protocol error: "
-                                    "unknown result column name" % (host,port))
-                        row_docid = None
-                        break
-                if (row_docid != None):
-                    result.append( ResultRow(
-                              row_docno, row_docid, row_weight, row_title, row_abstract))
-                rt = (result, None)
+            start = time.time()
+            if (versioned):
+                version = yield strusCodec.negotiateVersion( msgclient, serveraddr, deadline)
+                if (version < 2):
+                    raise Exception( "local statistics not supported")
+            reply = yield msgclient.issueRequest( serveraddr, qryblob, deadline)
+            state.succeeded( time.time() - start)
+            start = time.time()
+            if (qryblob[0] == ord('R')):
+                rows = strusCodec.decodeRankResults( reply, serveraddr, versioned)
             else:
-                rt = (None, "protocol error storage %s:%u query: "
-                            "unknown header %c" % (host,port,reply[0]))
-        except Exception as e:
+                rows = strusCodec.decodeQueryResults( reply, versioned)
+            if (versioned):
+                version,rows = rows
+                self.versions.add( version)
+            rt = (rows, None)
+            self.addTiming( "parse", start)
+        except strusCodec.ProtocolError as e:
+            rt = (None, "storage server %s:%u %s" % (host, port, str(e)))
+        except tornado.iostream.StreamClosedError as e:
             rt = (None, "storage server %s:%u connection error: %s"
                                % (host, port, str(e)))
+        except tornado.gen.TimeoutError:
+            rt = (None, "storage server %s:%u did not answer within the deadline" % (host, port))
+        except Exception as e:
+            rt = (None, "storage server %s:%u returned error: %s"
+                               % (host, port, str(e)))
+        finally:
+            state.finished( ejections)
+        if (rt[0] == None):
+            state.failed( time.time())
         raise tornado.gen.Return( rt)
 
+    # Issue a query to a storage server group (the replicas of a shard) and
+    # wait for the answer at most until the shard timeout or the deadline of
+    # the query. The replicas are tried in the order of routeReplicas. If a
+    # replica does not answer within its 95th percentile of response times
+    # or fails, the query is issued to the next replica and the first answer
+    # is taken. All requests are given up at the timeout, so the ones of the
+    # replicas not answered or losing the race do not stay in flight.
+    # Returns a pair (result list,error):
+    @tornado.gen.coroutine
+    def issueShardQuery( self, replicas, qryblob, versioned=False):
+        ioloop = tornado.ioloop.IOLoop.current()
+        timeout = min( ioloop.time() + shardtimeout, self.deadline)
+        replicas = routeReplicas( replicas)
+        # Map of the requests in flight to the replica addresses:
+        pending = {}
+        error = None
+        ri = 0
+        while (True):
+            if (not pending):
+                if (ri == len( replicas)):
+                    break
+                pending[ self.issueQuery( replicas[ ri], qryblob, versioned, timeout)] = replicas[ ri]
+                issued = ioloop.time()
+                ri += 1
+            waitend = timeout
+            if (ri < len( replicas)):
+                # Hedge after half of the shard timeout as long as too few
+                # response times of the replica are known:
+                p95 = replicaState( replicas[ ri-1]).latency.percentile95()
+                if (p95 is None):
+                    p95 = shardtimeout / 2
+                waitend = min( timeout, issued + p95)
+            try:
+                future = yield tornado.gen.with_timeout( waitend, firstDone( list( pending)))
+            except tornado.gen.TimeoutError:
+                if (waitend >= timeout):
+                    # The requests pending fail at the same time and count
+                    # as failures of their replicas:
+                    shardTimeoutCounter.inc()
+                    error = "storage server %s did not answer within the deadline, " \
+                            "results are incomplete" % ",".join( replicas)
+                    break
+                # Hedge, issue the same query to the next replica:
+                hedgedCounter.inc()
+                pending[ self.issueQuery( replicas[ ri], qryblob, versioned, timeout)] = replicas[ ri]
+                issued = ioloop.time()
+                ri += 1
+                continue
+            del pending[ future]
+            result = future.result()
+            if (result[0] != None):
+                raise tornado.gen.Return( result)
+            error = result[1]
+        raise tornado.gen.Return( (None, error))
+
     @tornado.gen.coroutine
-    def issueQueries( self, servers, qryblob):
+    def issueQueries( self, servers, qryblob, versioned=False):
         results = None
         try:
-            results = yield [ self.issueQuery( addr, qryblob) for addr in servers ]
+            results = yield [ self.issueShardQuery( replicas, qryblob, versioned) for replicas in servers ]
         except Exception as e:
             raise tornado.gen.Return( [], ["error issueing query: %s" % str(e)])
         raise tornado.gen.Return( results)
 
+    # Fetch the best 'nofranks' results of a query from all storage servers
+    # in batches (threshold algorithm): every server is asked for a small
+    # batch first. More results are only requested from servers whose
+    # lowest weight returned is still above the weight of the 'nofranks'-th
+    # best result seen so far, so only they can still contribute to the
+    # merged result. Returns a list of pairs (result list,error) per server
+    # group of 'servers':
+    @tornado.gen.coroutine
+    def fetchTopResults( self, servers, command, collectionsize, qryterms, nofranks, localstats=False,
+                         daterange=None):
+        nofservers = len( servers)
+        # First batch: the share of a server plus a quarter as reserve for uneven distributions:
+        batchsize = min( nofranks, max( fetchbatch, (5 * nofranks + 4 * nofservers - 1) // (4 * nofservers)))
+        rows = [ [] for server in servers ]
+        errors = [ None for server in servers ]
+        active = list( range( nofservers))
+        requested = [ batchsize ] * nofservers
+        while (active):
+            replies = yield [ self.issueShardQuery( servers[ si], strusCodec.encodeQuery(
+                                    collectionsize, len( rows[ si]), requested[ si], qryterms, command,
+                                    localstats, daterange), localstats)
+                              for si in active ]
+            for si,reply in zip( active, replies):
+                if (reply[0] == None):
+                    errors[ si] = reply[1]
+                    requested[ si] = 0
+                else:
+                    rows[ si].extend( reply[0])
+                    if (len( reply[0]) < requested[ si]):
+                        # No more results on this server:
+                        requested[ si] = 0
+            # Weight of the 'nofranks'-th best result fetched:
+            weights = [ row.weight for si in range( nofservers) for row in rows[ si] ]
+            threshold = None
+            if (len( weights) >= nofranks):
+                threshold = heapq.nlargest( nofranks, weights)[ -1]
+            active = []
+            for si in range( nofservers):
+                fetched = len( rows[ si])
+                if (requested[ si] == 0 or fetched >= nofranks):
+                    continue
+                if (threshold is not None and rows[ si][ -1].weight <= threshold):
+                    continue
+                requested[ si] = min( 2 * requested[ si], nofranks - fetched)
+                active.append( si)
+        raise tornado.gen.Return( [ (None, errors[ si]) if errors[ si] else (rows[ si], None)
+                                    for si in range( nofservers) ])
+
+    # Count the result rows fetched from the storage servers and the ones used:
+    def countFetchedRows( self, results, merged):
+        fetched = sum( len( result[0]) for result in results if result[0] != None)
+        self.rowsFetched += fetched
+        self.rowsUsed += len( merged)
+        rowsFetchedCounter.inc( fetched)
+        rowsUsedCounter.inc( len( merged))
+
     # Merge code derived from Python Cookbook (Sebastien Keim, Raymond Hettinger and Danny Yoo)
     # referenced in from http://wordaligned.org/articles/merging-sorted-streams-in-python:
     def mergeResultIter( self, resultlists):
@@ -202,42 +732,199 @@ class QueryHandler( tornado.web.RequestHandler ):
             ri += 1
         return (merged[ firstrank:maxnofresults], errors)
 
+    # Evaluate a query, 'daterange' is a pair of day numbers (None if open)
+    # restricting the date of the documents or None:
     @tornado.gen.coroutine
-    def evaluateQueryText( self, querystr, firstrank, nofranks):
+    def evaluateQueryText( self, querystr, daterange, firstrank, nofranks):
         rt = None
         try:
             maxnofresults = firstrank + nofranks
-            terms = analyzer.analyzeTermExpression( ["text", querystr])
+            start = time.time()
+            terms = analysiscache.analyze( querystr)
+            self.addTiming( "analyze", start)
             if len( terms) > 0:
-                # Get the global statistics:
-                dflist,collectionsize,error = yield self.queryStats( terms)
-                if (error != None):
-                    raise Exception( error)
-                # Assemble the query:
-                qry = b"Q"
-                qry += b"S"
-                qry += struct.pack( ">q", collectionsize)
-                qry += b"I"
-                qry += struct.pack( ">H", 0)
-                qry += b"N"
-                qry += struct.pack( ">H", maxnofresults)
-                for ii in range( 0, len( terms)):
-                    qry += b"T"
-                    type = terms[ii]['type'].encode('utf-8')
-                    typesize = len( type)
-                    value = terms[ii]['value'].encode('utf-8')
-                    valuesize = len( value)
-                    qry += struct.pack( ">qHH", dflist[ii], typesize, valuesize)
-                    qry += struct.pack( "%ds%ds" % (typesize,valuesize), type, value)
-                # Query all storage servers and merge the results:
-                results = yield self.issueQueries( storageservers, qry)
-                rt = self.mergeQueryResults( results, firstrank, nofranks)
+                querykey = resultcache.queryKey( terms, daterange)
+                merged = None
+                errors = []
+                # Serve the query from the result cache if the version of the
+                # statistics is known without asking the statistics server:
+                checkedversion = None
+                if (statscache.isFresh( time.time())):
+                    checkedversion = statscache.version
+                    merged = resultcache.get( querykey, maxnofresults, checkedversion)
+                if (merged is None):
+                    merged,errors = yield self.evaluateQueryTerms(
+                                            terms, daterange, querykey, maxnofresults, checkedversion)
+                page = merged[ firstrank:maxnofresults]
+                if (twophase):
+                    start = time.time()
+                    page,sumerrors = yield self.summarizeResults( terms, page)
+                    self.addTiming( "summarize", start)
+                    errors = errors + sumerrors
+                    if (not sumerrors):
+                        # Keep the summaries in the (possibly cached) merged result:
+                        merged[ firstrank:firstrank+len(page)] = page
+                rt = (page, errors)
         except Exception as e:
             rt = ([], ["error evaluation query: %s" % str(e)])
         raise tornado.gen.Return( rt)
 
+    # Storage server groups that may contain all query terms and documents
+    # in the date range with the statistics version 'version' according to
+    # their summaries, all groups without summaries:
+    def selectServers( self, terms, daterange, version):
+        selected = list( range( len( storageservers)))
+        if (termfilters is not None):
+            termkeys = [ (term['type'].encode('utf-8'), term['value'].encode('utf-8')) for term in terms ]
+            nofselected = len( selected)
+            selected = termfilters.select( selected, termfilters.condition( termkeys), version)
+            shardsPrunedCounter.inc( nofselected - len( selected))
+        if (datehistograms is not None and daterange is not None):
+            nofselected = len( selected)
+            selected = datehistograms.select( selected, daterange, version)
+            shardsPrunedDatesCounter.inc( nofselected - len( selected))
+        return [ storageservers[ gi] for gi in selected ]
+
+    # Evaluate a query on all storage servers, returns the merged list of
+    # the best results (as many as cached for the query) and the errors.
+    # The result cache is checked again if the statistics version changed
+    # since 'checkedversion':
+    @tornado.gen.coroutine
+    def evaluateQueryTerms( self, terms, daterange, querykey, maxnofresults, checkedversion):
+        if (localstats):
+            rt = yield self.evaluateQueryTermsLocal( terms, daterange, querykey, maxnofresults)
+            if (rt is not None):
+                raise tornado.gen.Return( rt)
+            localstatsFallbackCounter.inc()
+        # Get the global statistics:
+        start = time.time()
+        dflist,collectionsize,error = yield self.queryStats( terms)
+        self.addTiming( "stats", start)
+        if (error != None):
+            raise Exception( error)
+        version = statscache.version
+        if (version != checkedversion):
+            merged = resultcache.get( querykey, maxnofresults, version)
+            if (merged is not None):
+                raise tornado.gen.Return( (merged, []))
+        depth = resultcache.depth( maxnofresults)
+        qryterms = [ strusCodec.QueryTerm( term['type'], term['value'], df)
+                     for term,df in zip( terms, dflist) ]
+        # Query the storage servers that may contain results (ranking only
+        # in two phase mode) and merge the results:
+        servers = self.selectServers( terms, daterange, version)
+        command = b"R" if twophase else b"Q"
+        start = time.time()
+        if (not servers):
+            results = []
+        elif (fetchbatch > 0):
+            results = yield self.fetchTopResults( servers, command, collectionsize, qryterms, depth,
+                                                  False, daterange)
+        else:
+            qry = strusCodec.encodeQuery( collectionsize, 0, depth, qryterms, command, False, daterange)
+            results = yield self.issueQueries( servers, qry)
+        self.addTiming( "fanout", start)
+        start = time.time()
+        merged,errors = self.mergeQueryResults( results, 0, depth)
+        self.addTiming( "merge", start)
+        self.countFetchedRows( results, merged)
+        if (not errors):
+            resultcache.put( querykey, maxnofresults, version, merged)
+        raise tornado.gen.Return( (merged, errors))
+
+    # Evaluate a query on all storage servers with their replicas of the
+    # global statistics in one round trip. Returns None if the servers did
+    # not answer with the same version of the statistics or failed, the
+    # query has to be evaluated with the statistics server then. The shard
+    # summaries are used with the version of the statistics seen last within
+    # the staleness bound of the statistics cache. If the servers answer
+    # with another version, the servers skipped might have results:
+    @tornado.gen.coroutine
+    def evaluateQueryTermsLocal( self, terms, daterange, querykey, maxnofresults):
+        self.versions = set()
+        depth = resultcache.depth( maxnofresults)
+        qryterms = [ strusCodec.QueryTerm( term['type'], term['value'], 0) for term in terms ]
+        checkedversion = statscache.version if statscache.isFresh( time.time()) else None
+        servers = self.selectServers( terms, daterange, checkedversion)
+        pruned = len( servers) < len( storageservers)
+        if (not servers):
+            raise tornado.gen.Return( ([], []))
+        command = b"R" if twophase else b"Q"
+        start = time.time()
+        if (fetchbatch > 0):
+            results = yield self.fetchTopResults( servers, command, 0, qryterms, depth, True, daterange)
+        else:
+            qry = strusCodec.encodeQuery( 0, 0, depth, qryterms, command, True, daterange)
+            results = yield self.issueQueries( servers, qry, True)
+        self.addTiming( "fanout", start)
+        if (len( self.versions) != 1 or any( result[0] == None for result in results)):
+            raise tornado.gen.Return( None)
+        if (pruned and checkedversion not in self.versions):
+            raise tornado.gen.Return( None)
+        version = self.versions.pop()
+        start = time.time()
+        merged,errors = self.mergeQueryResults( results, 0, depth)
+        self.addTiming( "merge", start)
+        self.countFetchedRows( results, merged)
+        # The version of the statistics is known from the storage servers:
+        statscache.validate( version, statscache.collectionsize, time.time())
+        resultcache.put( querykey, maxnofresults, version, merged)
+        raise tornado.gen.Return( (merged, errors))
+
+    # Get the summaries of the result rows of a ranking query (second phase
+    # of a two phase query) from the storage servers the rows belong to:
+    @tornado.gen.coroutine
+    def summarizeResults( self, terms, rows):
+        servers = collections.OrderedDict()
+        for row in rows:
+            if (isinstance( row, strusCodec.RankRow)):
+                servers.setdefault( row.server, []).append( row.docno)
+        if (not servers):
+            raise tornado.gen.Return( (rows, []))
+        if (localstats):
+            # The weights of the summaries are not used, the version of the
+            # local statistics does not matter:
+            qryterms = [ strusCodec.QueryTerm( term['type'], term['value'], 0) for term in terms ]
+            collectionsize = 0
+        else:
+            dflist,collectionsize,error = yield self.queryStats( terms)
+            if (error != None):
+                raise Exception( error)
+            qryterms = [ strusCodec.QueryTerm( term['type'], term['value'], df)
+                         for term,df in zip( terms, dflist) ]
+        # The docnos are only valid on the replica that ranked them:
+        results = yield [ self.issueShardQuery( [server], strusCodec.encodeSummarizeQuery(
+                                                    collectionsize, qryterms, docnos, localstats),
+                                                localstats)
+                          for server,docnos in servers.items() ]
+        summaries = {}
+        errors = []
+        for server,result in zip( servers.keys(), results):
+            if (result[0] == None):
+                errors.append( result[1])
+            else:
+                for summary in result[0]:
+                    summaries[ (server, summary.docno)] = summary
+        rt = []
+        for row in rows:
+            if (isinstance( row, strusCodec.RankRow)):
+                summary = summaries.get( (row.server, row.docno))
+                if (summary is None):
+                    # Keep the rank without summary, reported in 'errors':
+                    rt.append( ResultRow( row.docno, "", row.weight, "", ""))
+                    continue
+                # The weight of the ranking is the one used for the merge:
+                row = summary._replace( weight=row.weight)
+            rt.append( row)
+        raise tornado.gen.Return( (rt, errors))
+
     @tornado.gen.coroutine
     def get(self):
+        start = time.time()
+        queriesInflight.inc()
+        self.trace = strusTrace.startTrace( "query")
+        if (self.trace is not None):
+            self.set_header( "X-Trace-Id", "%016x" % self.trace.traceid)
         try:
             # q = query terms:
             querystr = self.get_argument( "q", None)
@@ -245,12 +932,36 @@ class QueryHandler( tornado.web.RequestHandler ):
             firstrank = int( self.get_argument( "i", 0))
             # n = nofranks:
             nofranks = int( self.get_argument( "n", 20))
+            # from, to = date range (YYYY-MM-DD or YYYY, inclusive):
+            daterange = (strusDates.parseDateBound( self.get_argument( "from", None)),
+                         strusDates.parseDateBound( self.get_argument( "to", None), True))
+            if (daterange == (None, None)):
+                daterange = None
             # Evaluate query with BM25 (Okapi):
-            result = yield self.evaluateQueryText( querystr, firstrank, nofranks)
+            result = yield self.evaluateQueryText( querystr, daterange, firstrank, nofranks)
+            self.set_header( "X-Rows-Fetched", str( self.rowsFetched))
+            self.set_header( "X-Rows-Used", str( self.rowsUsed))
             # Render the results:
-            self.render( "search_bm25_html.tpl", results=result[0], messages=result[1])
+            renderstart = time.time()
+            html = self.render_string( "search_bm25_html.tpl", results=result[0], messages=result[1])
+            self.addTiming( "render", renderstart)
+            self.set_header( "Server-Timing", self.serverTiming())
+            self.finish( html)
         except Exception as e:
             self.render( "search_error_html.tpl", message=e)
+        finally:
+            queriesInflight.dec()
+            queryHistogram.observe( time.time() - start)
+            if (self.trace is not None):
+                self.trace.tags.update( {"query": self.get_argument( "q", ""), "rows.fetched": self.rowsFetched,
+                                         "rows.used": self.rowsUsed})
+                self.trace.finish()
+
+# Metrics of the server in text format:
+class MetricsHandler( tornado.web.RequestHandler ):
+    def get(self):
+        self.set_header( "Content-Type", "text/plain; version=0.0.4")
+        self.write( strusMetrics.registry.formatText())
 
 # Insert a multipart document (POST request):
 class InsertHandler( tornado.web.RequestHandler ):
@@ -258,26 +969,250 @@ class InsertHandler( tornado.web.RequestHandler ):
     def post(self, port):
         try:
             # Insert documents:
-            conn = yield msgclient.connect( 'localhost', int(port))
+            cmd = strusCodec.encodeInsert( self.request.body)
+            reply = yield msgclient.issueRequest( ('localhost', int(port)), cmd)
+            nofDocuments = strusCodec.decodeInsertReply( reply)
+            self.write( "OK %u\n" % (nofDocuments))
+        except Exception as e:
+            self.write( "ERR " + str(e) + "\n")
 
-            cmd = b"I" + self.request.body
-            reply = yield msgclient.issueRequest( conn, cmd)
-            if (reply[0] == ord('E')):
-                raise Exception( reply[1:].decode('UTF-8'))
-            elif (reply[0] != ord('Y')):
-                raise Exception( "protocol error server reply on insert: %c" % reply[0])
+# Split a stream of XML data into the '<item>' elements of the documents
+# (start tags with attributes included), the rest of the data (XML headers
+# and the '<list>' tags of concatenated multipart documents) is skipped:
+itemStartPattern = re.compile( rb"<item\b[^>]*>")
 
-            (nofDocuments,) = struct.unpack( ">I", reply[1:])
-            self.write( "OK %u\n" % (nofDocuments))
+class ItemSplitter( object):
+    def __init__(self):
+        self.buffer = bytearray()
+
+    # Return the list of complete elements in the data fed so far:
+    def feed( self, chunk):
+        self.buffer += chunk
+        rt = []
+        ofs = 0
+        while (True):
+            match = itemStartPattern.search( self.buffer, ofs)
+            if (match is None):
+                # Keep a possibly incomplete start tag at the end:
+                tagstart = self.buffer.rfind( b"<", ofs)
+                ofs = len( self.buffer) if tagstart < 0 else tagstart
+                break
+            end = self.buffer.find( b"</item>", match.end())
+            if (end < 0):
+                ofs = match.start()
+                break
+            ofs = end + len( b"</item>")
+            rt.append( bytes( self.buffer[ match.start():ofs]))
+        del self.buffer[ :ofs]
+        return rt
+
+# Multipart document containing the '<item>' elements in 'items':
+def multipartDocument( items):
+    return b'<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<list>' \
+           + b"\n".join( items) + b"</list>\n"
+
+# Docid of a document element, the element itself if it has none:
+docidPattern = re.compile( rb"<id>([^<]*)</id>")
+
+def documentId( item):
+    match = docidPattern.search( item)
+    if (match is None):
+        return item
+    return match.group( 1)
+
+# [2] Partitioning of the documents inserted to the storage server groups.
+# A partitioner assigns a list of docids to the indices of the groups:
+# Assignment by a hash of the docid:
+class HashPartitioner( object):
+    def __init__(self, groups):
+        self.nofgroups = len( groups)
+
+    @tornado.gen.coroutine
+    def assign( self, docids):
+        raise tornado.gen.Return( [ zlib.crc32( docid) % self.nofgroups for docid in docids ])
+
+# Assignment by consistent hashing: every group owns 'nofpoints' points on a
+# ring of hash values, a document belongs to the group of the first point
+# following the hash of its docid. Adding a group only moves documents to it:
+class ConsistentHashPartitioner( object):
+    def __init__(self, groups, nofpoints=100):
+        ring = sorted( (zlib.crc32( ("%s#%u" % (group[0], pi)).encode('utf-8')), gi)
+                       for gi,group in enumerate( groups) for pi in range( nofpoints))
+        self.points = [ point for point,gi in ring ]
+        self.groups = [ gi for point,gi in ring ]
+
+    @tornado.gen.coroutine
+    def assign( self, docids):
+        nofpoints = len( self.points)
+        raise tornado.gen.Return( [ self.groups[ bisect.bisect( self.points, zlib.crc32( docid)) % nofpoints]
+                                    for docid in docids ])
+
+# Assignment to the groups with the least documents. The number of documents
+# of the groups is fetched from the storage servers (refreshed after
+# 'refresh' seconds, so that inserts not done by us are considered) and
+# counted for the documents assigned in between:
+class LeastDocumentsPartitioner( object):
+    def __init__(self, groups, refresh=60.0):
+        self.groups = groups
+        self.refresh = refresh
+        self.counts = None
+        self.fetched = 0.0
+
+    @tornado.gen.coroutine
+    def assign( self, docids):
+        now = time.time()
+        if (self.counts is None or now - self.fetched > self.refresh):
+            self.fetched = now
+            request = strusCodec.encodeNofDocumentsRequest()
+            replies = yield [ msgclient.issueRequest( group[0], request) for group in self.groups ]
+            self.counts = [ strusCodec.decodeNofDocumentsReply( reply) for reply in replies ]
+        heap = [ (count, gi) for gi,count in enumerate( self.counts) ]
+        heapq.heapify( heap)
+        rt = []
+        for docid in docids:
+            count,gi = heap[0]
+            rt.append( gi)
+            heapq.heapreplace( heap, (count + 1, gi))
+            self.counts[ gi] += 1
+        raise tornado.gen.Return( rt)
+
+partitioners = {
+    "hash": HashPartitioner,
+    "consistent": ConsistentHashPartitioner,
+    "leastdocs": LeastDocumentsPartitioner
+}
+# Partitioner used for inserts (created in main):
+partitioner = None
+
+# Insert a multipart document with the documents distributed to the storage
+# server groups by the partitioner (POST request). The documents of a group
+# are inserted into all its replicas. Failed replicas and replicas that
+# did not insert the same number of documents are reported, the documents
+# can be inserted again (an insert replaces documents with the same docid):
+class PartitionedInsertHandler( tornado.web.RequestHandler ):
+    # Insert into one replica, returns a pair (nofdocs,error):
+    @tornado.gen.coroutine
+    def insertReplica( self, address, cmd):
+        rt = (0, None)
+        try:
+            reply = yield msgclient.issueRequest( address, cmd)
+            rt = (strusCodec.decodeInsertReply( reply), None)
+        except Exception as e:
+            rt = (0, "storage server %s: %s" % (address, str(e)))
+        raise tornado.gen.Return( rt)
+
+    # Insert into all replicas of a group in parallel, returns a pair
+    # (nofdocs,errors) with the number of documents of the first replica
+    # that succeeded:
+    @tornado.gen.coroutine
+    def insertDocuments( self, replicas, items):
+        cmd = strusCodec.encodeInsert( multipartDocument( items))
+        results = yield [ self.insertReplica( address, cmd) for address in replicas ]
+        errors = [ error for nofdocs,error in results if error is not None ]
+        counts = [ (address, nofdocs) for address,(nofdocs,error) in zip( replicas, results)
+                   if error is None ]
+        if (len( set( nofdocs for address,nofdocs in counts)) > 1):
+            errors.append( "replicas inserted different numbers of documents: %s"
+                           % ", ".join( "%s: %u" % (address, nofdocs) for address,nofdocs in counts))
+        raise tornado.gen.Return( (counts[0][1] if counts else 0, errors))
+
+    @tornado.gen.coroutine
+    def post(self):
+        try:
+            items = ItemSplitter().feed( self.request.body)
+            assignment = yield partitioner.assign( [ documentId( item) for item in items ])
+            batches = [ [] for group in storageservers ]
+            for item,gi in zip( items, assignment):
+                batches[ gi].append( item)
+            # Insert the documents of all groups in parallel:
+            results = yield [ self.insertDocuments( storageservers[ gi], batch)
+                              for gi,batch in enumerate( batches) if batch ]
+            nofdocs = sum( result[0] for result in results)
+            errors = [ error for result in results for error in result[1] ]
+            if (errors):
+                self.write( "ERR %s (%u documents inserted)\n" % ("; ".join( errors), nofdocs))
+            else:
+                self.write( "OK %u\n" % nofdocs)
         except Exception as e:
             self.write( "ERR " + str(e) + "\n")
 
+# Number of documents sent to the storage server in one insert (inserted
+# in one transaction) and maximum number of inserts in flight per bulk insert:
+bulkbatch = 1000
+bulkinflight = 4
+bulkDocumentsCounter = strusMetrics.registry.counter(
+                        "bulkinsert_documents", "Documents inserted with bulk inserts")
+
+# Insert a stream of multipart documents (POST request with a body of any
+# size, e.g. the concatenated XML files of the collection). The documents
+# are sent to the storage server in batches of 'bulkbatch' documents, with
+# at most 'bulkinflight' batches in flight, so that the documents are
+# analyzed in parallel on the storage server. Reading the request body is
+# suspended while the maximum number of batches is in flight:
+@tornado.web.stream_request_body
+class BulkInsertHandler( tornado.web.RequestHandler ):
+    def prepare(self):
+        self.request.connection.set_max_body_size( 1 << 40)
+        self.address = ('localhost', int( self.path_args[0]))
+        self.splitter = ItemSplitter()
+        self.batch = []
+        self.inflight = []
+        self.nofDocuments = 0
+        self.error = None
+        self.start = time.time()
+
+    @tornado.gen.coroutine
+    def insertBatch( self, items):
+        try:
+            content = multipartDocument( items)
+            reply = yield msgclient.issueRequest( self.address, strusCodec.encodeInsert( content))
+            nofdocs = strusCodec.decodeInsertReply( reply)
+            self.nofDocuments += nofdocs
+            bulkDocumentsCounter.inc( nofdocs)
+        except Exception as e:
+            if (self.error is None):
+                self.error = str(e)
+
+    # Send the documents collected, waits while too many batches are in flight:
+    @tornado.gen.coroutine
+    def sendBatch( self):
+        while (len( self.inflight) >= bulkinflight):
+            future = yield firstDone( self.inflight)
+            self.inflight.remove( future)
+        if (self.error is None):
+            self.inflight.append( self.insertBatch( self.batch))
+        self.batch = []
+
+    @tornado.gen.coroutine
+    def data_received( self, chunk):
+        for item in self.splitter.feed( chunk):
+            self.batch.append( item)
+            if (len( self.batch) >= bulkbatch):
+                yield self.sendBatch()
+
+    @tornado.gen.coroutine
+    def post(self, port):
+        if (self.batch):
+            yield self.sendBatch()
+        yield self.inflight
+        duration = max( time.time() - self.start, 1e-6)
+        if (self.error is None):
+            self.write( "OK %u %.1f docs/s\n" % (self.nofDocuments, self.nofDocuments / duration))
+        else:
+            self.write( "ERR %s (%u documents inserted)\n" % (self.error, self.nofDocuments))
+
 # [3] Dispatcher:
 application = tornado.web.Application([
     # /query in the URL triggers the handler for answering queries:
     (r"/query", QueryHandler),
     # /insert in the URL triggers the post handler for insert requests:
     (r"/insert/([0-9]+)", InsertHandler),
+    # /insert without port inserts the documents into the storage servers chosen by the partitioner:
+    (r"/insert", PartitionedInsertHandler),
+    # /bulkinsert in the URL triggers the streaming insert of any number of documents:
+    (r"/bulkinsert/([0-9]+)", BulkInsertHandler),
+    # /metrics in the URL returns the metrics of the HTTP server:
+    (r"/metrics", MetricsHandler),
     # /static in the URL triggers the handler for accessing static 
     # files like images referenced in tornado templates:
     (r"/static/(.*)",tornado.web.StaticFileHandler,
@@ -292,31 +1227,158 @@ def on_shutdown():
 if __name__ == "__main__":
     try:
         # Parse arguments:
-        usage = "usage: %prog [options] {<storage server port>}"
+        usage = "usage: %prog [options] {<storage server port>{,<replica port>}}"
         parser = optparse.OptionParser( usage=usage)
         parser.add_option("-p", "--port", dest="port", default=80,
                           help="Specify the port of this server as PORT (default %u)" % 80,
                           metavar="PORT")
-        parser.add_option("-s", "--statserver", dest="statserver", default=statserver,
-                          help="Specify the address of the statistics server "
-                               "as ADDR (default %s" % statserver,
+        parser.add_option("-s", "--statserver", dest="statserver", default=statservers[0],
+                          help="Specify the address of the statistics server as ADDR, the "
+                               "addresses of the partitions separated by commas if the "
+                               "statistics are partitioned (default %s)" % statservers[0],
                           metavar="ADDR")
+        parser.add_option("-m", "--max-connections", dest="maxconnections", default=16,
+                          help="Specify the maximum number of connections kept "
+                               "per server as NUM (default %u)" % 16,
+                          metavar="NUM")
+        parser.add_option("-t", "--idle-timeout", dest="idletimeout", default=60,
+                          help="Close connections unused for more than SEC "
+                               "seconds (default %u)" % 60,
+                          metavar="SEC")
+        parser.add_option("-c", "--dfcache-size", dest="dfcachesize", default=100000,
+                          help="Specify the maximum number of term df values cached "
+                               "as NUM, 0 to disable the cache (default %u)" % 100000,
+                          metavar="NUM")
+        parser.add_option("-S", "--dfcache-staleness", dest="dfcachestale", default=5,
+                          help="Use cached term df values for at most SEC seconds "
+                               "without checking the statistics version (default %u)" % 5,
+                          metavar="SEC")
+        parser.add_option("-r", "--resultcache-size", dest="resultcachesize", default=100000,
+                          help="Specify the maximum number of merged result rows cached "
+                               "as NUM, 0 to disable the cache (default %u)" % 100000,
+                          metavar="NUM")
+        parser.add_option("-w", "--resultcache-window", dest="resultcachewindow", default=60,
+                          help="Fetch and cache results of a query in multiples of NUM ranks "
+                               "(default %u)" % 60,
+                          metavar="NUM")
+
+        parser.add_option("-A", "--analysiscache-size", dest="analysiscachesize", default=16777216,
+                          help="Specify the maximum memory used by cached query analysis results "
+                               "in bytes as NUM, 0 to disable the cache (default %u)" % 16777216,
+                          metavar="NUM")
+        parser.add_option("-K", "--token-cache", action="store_true", dest="tokencache", default=False,
+                          help="Cache the analysis of single words too and analyze new queries "
+                               "word by word (only queries of letters, digits and spaces, "
+                               "other queries are analyzed as a whole)")
+        parser.add_option("-2", "--two-phase", action="store_true", dest="twophase", default=False,
+                          help="Evaluate queries in two phases, rank on all storage servers "
+                               "first and get the summaries of the final result page only")
+
+        parser.add_option("-L", "--local-stats", action="store_true", dest="localstats", default=False,
+                          help="Evaluate queries with the replicas of the global statistics on "
+                               "the storage servers (started with --replicate-stats) without "
+                               "querying the statistics server first")
+        parser.add_option("-f", "--term-filter", action="store_true", dest="termfilter", default=False,
+                          help="Skip storage server groups that do not contain all query terms "
+                               "according to their term filters (storage servers started with "
+                               "--term-filter)")
+        parser.add_option("-D", "--date-histograms", action="store_true", dest="datehistograms",
+                          default=False,
+                          help="Skip storage server groups without documents in the date range "
+                               "of a query according to the histograms of their document dates")
+        parser.add_option("-b", "--fetch-batch", dest="fetchbatch", default=fetchbatch,
+                          help="Fetch results from the storage servers in batches of at least "
+                               "NUM rows, 0 to fetch all results at once (default %u)" % fetchbatch,
+                          metavar="NUM")
+        parser.add_option("-d", "--deadline", dest="deadline", default=querydeadline,
+                          help="Answer queries within SEC seconds, with the results of the "
+                               "storage servers answering in time (default %.1f)" % querydeadline,
+                          metavar="SEC")
+        parser.add_option("-T", "--shard-timeout", dest="shardtimeout", default=shardtimeout,
+                          help="Wait at most SEC seconds for the answer of a storage server "
+                               "group (default %.1f)" % shardtimeout,
+                          metavar="SEC")
+        parser.add_option("-R", "--routing", dest="routing", default=routing,
+                          help="Route queries to the replica with the least requests in flight "
+                               "('outstanding') or with the lowest average response time "
+                               "('ewma') (default %s)" % routing,
+                          metavar="POLICY")
+        parser.add_option("-P", "--partition", dest="partition", default="hash",
+                          help="Distribute the documents inserted with /insert by the "
+                               "hash of the docid ('hash'), consistent hashing ('consistent') "
+                               "or to the storage servers with the least documents ('leastdocs') "
+                               "(default %s)" % "hash",
+                          metavar="POLICY")
+        parser.add_option("-B", "--bulk-batch", dest="bulkbatch", default=bulkbatch,
+                          help="Insert documents of a bulk insert in transactions of NUM "
+                               "documents (default %u)" % bulkbatch,
+                          metavar="NUM")
+        parser.add_option("-I", "--bulk-inflight", dest="bulkinflight", default=bulkinflight,
+                          help="Keep at most NUM transactions of a bulk insert in flight "
+                               "(default %u)" % bulkinflight,
+                          metavar="NUM")
+        parser.add_option("-x", "--trace-file", dest="tracefile", default=None,
+                          help="Trace a sample of the queries across the servers, write the "
+                               "spans to FILE (one span per line in Zipkin JSON format)",
+                          metavar="FILE")
+        parser.add_option("-X", "--trace-sample", dest="tracesample", default=0.01,
+                          help="Trace the fraction RATE of the queries (default %.2f)" % 0.01,
+                          metavar="RATE")
+        parser.add_option("-F", "--max-failures", dest="maxfailures", default=maxfailures,
+                          help="Eject a replica after NUM failures in a row (default %u)" % maxfailures,
+                          metavar="NUM")
+        parser.add_option("-E", "--eject-time", dest="ejecttime", default=ejecttime,
+                          help="Readmit an ejected replica after SEC seconds (default %.0f)" % ejecttime,
+                          metavar="SEC")
 
         (options, args) = parser.parse_args()
         myport = int(options.port)
-        statserver = options.statserver
-        if (statserver[0:].isdigit()):
-            statserver = '{}:{}'.format( 'localhost', statserver)
+        fetchbatch = int( options.fetchbatch)
+        querydeadline = float( options.deadline)
+        shardtimeout = float( options.shardtimeout)
+        routing = options.routing
+        if (routing not in ["outstanding", "ewma"]):
+            raise Exception( "unknown routing policy '%s'" % routing)
+        maxfailures = int( options.maxfailures)
+        ejecttime = float( options.ejecttime)
+        bulkbatch = int( options.bulkbatch)
+        bulkinflight = int( options.bulkinflight)
+        twophase = options.twophase
+        localstats = options.localstats
+        if (options.tracefile):
+            strusTrace.tracer = strusTrace.Tracer( "http:%u" % myport, options.tracefile,
+                                                   float( options.tracesample))
+        msgclient = strusMessage.RequestClient( int( options.maxconnections),
+                                                float( options.idletimeout))
+        statscache = StatisticsCache( int( options.dfcachesize), float( options.dfcachestale))
+        resultcache = ResultCache( int( options.resultcachesize), int( options.resultcachewindow))
+        analysiscache = QueryAnalysisCache( int( options.analysiscachesize), options.tokencache)
+        statservers = []
+        for addr in options.statserver.split(','):
+            if (addr[0:].isdigit()):
+                statservers.append( '{}:{}'.format( 'localhost', addr))
+            else:
+                statservers.append( addr)
 
-        # Positional arguments are storage server addresses,
-        # if empty use default at localhost:7184
+        # Positional arguments are storage server addresses, replicas of
+        # the same data separated by commas, if empty use default at localhost:7184
         for arg in args:
-            if (arg[0:].isdigit()):
-                storageservers.append( '{}:{}'.format( 'localhost', arg))
-            else:
-                storageservers.append( arg)
+            replicas = []
+            for addr in arg.split(','):
+                if (addr[0:].isdigit()):
+                    replicas.append( '{}:{}'.format( 'localhost', addr))
+                else:
+                    replicas.append( addr)
+            storageservers.append( replicas)
         if (len( storageservers) == 0):
-            storageservers.append( "localhost:7184")
+            storageservers.append( ["localhost:7184"])
+        if (options.partition not in partitioners):
+            raise Exception( "unknown partitioning policy '%s'" % options.partition)
+        partitioner = partitioners[ options.partition]( storageservers)
+        if (options.termfilter):
+            termfilters = TermFilters( storageservers)
+        if (options.datehistograms):
+            datehistograms = DateHistograms( storageservers)
 
         # Start server:
         print( "Starting server ...\n")
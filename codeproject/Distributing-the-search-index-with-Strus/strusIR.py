@@ -1,48 +1,89 @@
 import strus
 import itertools
 import heapq
+import os
 import re
+import threading
+import strusDates
+
+# Create the document analyzer for our test collection:
+def createDocumentAnalyzer( context):
+    rt = context.createDocumentAnalyzer( {"mimetype":"xml"} )
+    # Define the sections that define a document (for multipart documents):
+    rt.defineDocument( "doc", "/list/item")
+
+    # Define the terms to search for (inverted index or search index):
+    rt.addSearchIndexFeature( "word", "/list/item/title()",
+                              "word", ("lc",("stem","en"),("convdia","en")))
+    rt.addSearchIndexFeature( "word", "/list/item/artist()",
+                              "word", ("lc",("stem","en"),("convdia","en")))
+    rt.addSearchIndexFeature( "word", "/list/item/note()",
+                              "word", ("lc",("stem","en"),("convdia","en")))
+
+    # Define the terms to search for (inverted index or search index):
+    rt.addForwardIndexFeature( "orig", "/list/item/title()", "split", "orig")
+    rt.addForwardIndexFeature( "orig", "/list/item/artist()", "split", "orig")
+    rt.addForwardIndexFeature( "orig", "/list/item/note()", "split", "orig")
+
+    # Define the document attributes:
+    rt.defineAttribute( "docid", "/list/item/id()", "content", "text")
+    rt.defineAttribute( "title", "/list/item/title()", "content", "text")
+    rt.defineAttribute( "upc", "/list/item/upc()", "content", "text")
+    rt.defineAttribute( "note", "/list/item/note()", "content", "text")
+
+    # Define the document meta data:
+    rt.defineMetaData( "date", "/list/item/date()",
+                                      ("regex","[0-9\-]{8,10} [0-9:]{6,8}"),
+                                      [("date2int", "d 1877-01-01", "%Y-%m-%d %H:%M:%s")]);
+
+    # Define the doclen attribute needed by BM25:
+    rt.defineAggregatedMetaData( "doclen",("count", "word"))
+    return rt
+
+# Document analyzer of a worker process analyzing documents for the storage server:
+workerAnalyzer = None
+
+# Initializer of a worker process for document analysis:
+def initAnalyzerWorker():
+    global workerAnalyzer
+    workerAnalyzer = createDocumentAnalyzer( strus.Context())
+
+# Analyze a multipart document in a worker process:
+def analyzeDocumentsWorker( content):
+    return analyzeDocuments( workerAnalyzer, content)
+
+# Analyze a multipart document, returns the list of analyzed documents:
+def analyzeDocuments( analyzer, content):
+    return list( analyzer.analyzeMultiPart( content, {"mimetype":"xml", "encoding":"utf-8"}))
+
+# Value of the date meta data of an analyzed document (0 if not defined):
+def documentDate( doc):
+    metadata = doc.get( 'metadata') or {}
+    if (isinstance( metadata, dict)):
+        return int( metadata.get( 'date', 0))
+    for element in metadata:
+        if (element['name'] == 'date'):
+            return int( element['value'])
+    return 0
+
+# Path of the file with the date histogram of the storage with the
+# configuration 'config' (next to the storage directory), None without path:
+def dateHistogramPath( config):
+    for item in config.split( ';'):
+        key,sep,value = item.partition( '=')
+        if (key.strip() == "path" and value.strip()):
+            return value.strip().rstrip( '/') + ".dates"
+    return None
 
 class Backend:
-    # Create the document analyzer for our test collection:
     # Create the document analyzer for our test collection:
     def createDocumentAnalyzer(self):
-        rt = self.context.createDocumentAnalyzer( {"mimetype":"xml"} )
-        # Define the sections that define a document (for multipart documents):
-        rt.defineDocument( "doc", "/list/item")
-
-        # Define the terms to search for (inverted index or search index):
-        rt.addSearchIndexFeature( "word", "/list/item/title()",
-                                  "word", ("lc",("stem","en"),("convdia","en")))
-        rt.addSearchIndexFeature( "word", "/list/item/artist()",
-                                  "word", ("lc",("stem","en"),("convdia","en")))
-        rt.addSearchIndexFeature( "word", "/list/item/note()",
-                                  "word", ("lc",("stem","en"),("convdia","en")))
-
-        # Define the terms to search for (inverted index or search index):
-        rt.addForwardIndexFeature( "orig", "/list/item/title()", "split", "orig")
-        rt.addForwardIndexFeature( "orig", "/list/item/artist()", "split", "orig")
-        rt.addForwardIndexFeature( "orig", "/list/item/note()", "split", "orig")
-
-        # Define the document attributes:
-        rt.defineAttribute( "docid", "/list/item/id()", "content", "text")
-        rt.defineAttribute( "title", "/list/item/title()", "content", "text")
-        rt.defineAttribute( "upc", "/list/item/upc()", "content", "text")
-        rt.defineAttribute( "note", "/list/item/note()", "content", "text")
-
-        # Define the document meta data:
-        rt.defineMetaData( "date", "/list/item/date()",
-                                          ("regex","[0-9\-]{8,10} [0-9:]{6,8}"),
-                                          [("date2int", "d 1877-01-01", "%Y-%m-%d %H:%M:%s")]);
-
-        # Define the doclen attribute needed by BM25:
-        rt.defineAggregatedMetaData( "doclen",("count", "word"))
-        return rt
+        return createDocumentAnalyzer( self.context)
 
     # Create a simple BM25 query evaluation scheme with fixed
     # a,b,k1 and avg document lenght and title with abstract
-    # as summarization attributes:
-    def createQueryEvalBM25(self):
+    # as summarization attributes (if 'summarize' is set):
+    def createQueryEvalBM25(self, summarize=True):
         rt = self.context.createQueryEval()
         # Declare the sentence marker feature needed for abstracting:
         rt.addTerm( "sentence", "sent", "")
@@ -51,6 +92,8 @@ class Backend:
         # Query evaluation scheme:
         rt.addWeightingFunction( "BM25", {
                      "k1": 1.2, "b": 0.75, "avgdoclen": 20, "match": {"feature":"docfeat"} })
+        if not summarize:
+            return rt
         # Summarizer for getting the document title:
         rt.addSummarizer( "attribute", { "name": "docid" })
         rt.addSummarizer( "attribute", { "name": "title" })
@@ -67,39 +110,77 @@ class Backend:
         self.storage = self.context.createStorageClient( config )
         self.documentAnalyzer = self.createDocumentAnalyzer()
         self.queryeval = self.createQueryEvalBM25()
+        self.rankqueryeval = self.createQueryEvalBM25( False)
+        # Histogram of the dates of the documents, kept in a file next to the
+        # storage. It is only known if the storage was empty or if the file
+        # is up to date with the storage (not after a crash between the commit
+        # of an insert and the write of the file):
+        self.lock = threading.Lock()
+        self.datespath = dateHistogramPath( config)
+        self.dates = None
+        nofdocs = self.storage.nofDocumentsInserted()
+        if (nofdocs == 0):
+            self.dates = strusDates.DateHistogram()
+        elif (self.datespath is not None and os.path.exists( self.datespath)):
+            self.dates = strusDates.readHistogram( self.datespath, nofdocs)
 
     # Insert a multipart document:
     def insertDocuments( self, content):
+        return self.insertAnalyzedDocuments( self.analyzeDocuments( content))
+
+    # Analyze a multipart document, returns the list of analyzed documents:
+    def analyzeDocuments( self, content):
+        return analyzeDocuments( self.documentAnalyzer, content)
+
+    # Insert a list of analyzed documents in one transaction:
+    def insertAnalyzedDocuments( self, docs):
         rt = 0
-        docs = self.documentAnalyzer.analyzeMultiPart( content, {"mimetype":"xml", "encoding":"utf-8"})
         transaction = self.storage.createTransaction()
         for doc in docs:
             docid = doc['attribute']['docid']
             transaction.insertDocument( docid, doc)
             rt += 1
-        transaction.commit()
+        if (self.dates is None):
+            transaction.commit()
+            return rt
+        # The commit and the update of the histogram file are serialized, so
+        # that the number of documents written with it is the one counted:
+        with self.lock:
+            transaction.commit()
+            for doc in docs:
+                self.dates.add( documentDate( doc))
+            if (self.datespath is not None):
+                strusDates.writeHistogram( self.dates, self.storage.nofDocumentsInserted(), self.datespath)
         return rt
 
-    # Query evaluation scheme for a classical information retrieval query with BM25:
-    def evaluateQuery( self, terms, collectionsize, firstrank, nofranks):
-        queryeval = self.queryeval
-        query = queryeval.createQuery( self.storage)
-        if len( terms) == 0:
-            # Return empty result for empty query:
-            return []
+    # Copy of the histogram of the dates of the documents, None if not known:
+    def dateSummary( self):
+        with self.lock:
+            return None if self.dates is None else self.dates.copy()
 
+    # Create a query for a classical information retrieval query with BM25,
+    # 'daterange' restricts the date meta data (pair of bounds, None if open):
+    def createQuery( self, queryeval, terms, collectionsize, daterange=None):
+        query = queryeval.createQuery( self.storage)
         selexpr = ["contains"]
         for term in terms:
             selexpr.append( [term.type, term.value] )
             query.addFeature( "docfeat", [term.type, term.value])
             query.defineTermStatistics( term.type, term.value, {'df' : int(term.df)} )
         query.addFeature( "selfeat", selexpr)
-        query.setMaxNofRanks( nofranks)
-        query.setMinRank( firstrank)
         query.defineGlobalStatistics( {'nofdocs' : int(collectionsize)} )
-        # Evaluate the query:
-        results = query.evaluate()
-        # Rewrite the results:
+        if daterange is not None:
+            # Conditions of the restriction joined with AND:
+            conditions = []
+            if daterange[0] is not None:
+                conditions.append( [">=", "date", daterange[0]])
+            if daterange[1] is not None:
+                conditions.append( ["<=", "date", daterange[1]])
+            query.addMetaDataRestriction( conditions)
+        return query
+
+    # Rewrite the ranks of a query result to a list of dictionaries:
+    def rewriteResults( self, results):
         rt = []
         for result in results['ranks']:
             content = ""
@@ -122,6 +203,43 @@ class Backend:
                    'abstract':content })
         return rt
 
+    # Query evaluation scheme for a classical information retrieval query with BM25:
+    def evaluateQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        if len( terms) == 0:
+            # Return empty result for empty query:
+            return []
+        query = self.createQuery( self.queryeval, terms, collectionsize, daterange)
+        query.setMaxNofRanks( nofranks)
+        query.setMinRank( firstrank)
+        # Evaluate the query:
+        return self.rewriteResults( query.evaluate())
+
+    # Evaluate the ranking of a BM25 query without summarization (first
+    # phase of a distributed query), returns a list of docno and weight:
+    def rankQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        if len( terms) == 0:
+            return []
+        query = self.createQuery( self.rankqueryeval, terms, collectionsize, daterange)
+        query.setMaxNofRanks( nofranks)
+        query.setMinRank( firstrank)
+        results = query.evaluate()
+        return [ {'docno':result['docno'], 'weight':result['weight']}
+                 for result in results['ranks'] ]
+
+    # Evaluate the summaries of a BM25 query for a list of documents
+    # (second phase of a distributed query):
+    def summarizeDocuments( self, terms, collectionsize, docnos):
+        if len( terms) == 0 or len( docnos) == 0:
+            return []
+        query = self.createQuery( self.queryeval, terms, collectionsize)
+        query.addDocumentEvaluationSet( docnos)
+        query.setMaxNofRanks( len( docnos))
+        return self.rewriteResults( query.evaluate())
+
+    # Number of documents in the storage:
+    def nofDocuments( self):
+        return self.storage.nofDocumentsInserted()
+
     # Get an iterator on all absolute statistics of the storage
     def getInitStatisticsIterator( self):
         return self.storage.getAllStatistics( True)
@@ -134,4 +252,9 @@ class Backend:
     def getUpdateStatisticsIterator( self):
         return self.storage.getChangeStatistics()
 
+    # Decode a statistics blob into a dictionary with the change of the
+    # number of documents 'nofdocs' and the list of df changes 'dfchange':
+    def decodeStatistics( self, blob):
+        return self.context.unpackStatisticBlob( blob)
+
 
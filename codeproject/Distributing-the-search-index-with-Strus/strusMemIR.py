@@ -0,0 +1,271 @@
+import array
+import re
+import threading
+import unicodedata
+import xml.etree.ElementTree
+import numpy
+import strusStandIn
+import strusDates
+
+# In-memory BM25 backend of the storage server without the strus bindings,
+# with the same interface as strusIR.Backend. The documents are analyzed
+# like with the document analyzer of strusIR: the words of title, artist
+# and note are the search terms of type "word" (lowercase, diacritics
+# removed, stemmed if the PyStemmer module is installed), docid, title
+# and note are attributes. The posting lists are arrays of docnos and
+# term frequencies, the query evaluation is vectorized with NumPy.
+# Selected with the storage server configuration "backend=memory".
+
+try:
+    import Stemmer
+    stemmer = Stemmer.Stemmer( "english")
+except ImportError:
+    stemmer = None
+
+wordPattern = re.compile( r"\w+")
+
+# Normalize a word like the "word" feature of the strus analyzer:
+def normalizeWord( word):
+    word = unicodedata.normalize( "NFKD", word.lower())
+    word = "".join( ch for ch in word if not unicodedata.combining( ch))
+    if (stemmer is not None):
+        word = stemmer.stemWord( word)
+    return word
+
+def _str( obj):
+    if (isinstance( obj, bytes)):
+        return obj.decode('utf-8')
+    return obj
+
+# Analyze a multipart document, returns a list of documents as
+# dictionaries with the attributes, the date, the terms with their
+# frequency and the original text of the matchable fields:
+def analyzeDocuments( content):
+    rt = []
+    root = xml.etree.ElementTree.fromstring( bytes( content))
+    for item in root.iter( "item"):
+        fields = dict( (child.tag, child.text or "") for child in item)
+        orig = " ".join( fields.get( name, "") for name in ["title", "artist", "note"])
+        words = [ normalizeWord( word) for word in wordPattern.findall( orig) ]
+        terms = {}
+        for word in words:
+            terms[ word] = terms.get( word, 0) + 1
+        rt.append( {
+            'attribute': { 'docid': fields.get( "id", ""), 'title': fields.get( "title", ""),
+                           'upc': fields.get( "upc", ""), 'note': fields.get( "note", "") },
+            'date': strusDates.dateToInt( fields.get( "date", "")),
+            'doclen': len( words),
+            'terms': terms,
+            'orig': orig })
+    return rt
+
+# The analysis needs no initialization, for the process pool of the storage server:
+def initAnalyzerWorker():
+    pass
+
+def analyzeDocumentsWorker( content):
+    return analyzeDocuments( content)
+
+# Posting list of a term, the docnos are ascending:
+class Posting( object):
+    def __init__(self):
+        self.docnos = array.array( 'I')
+        self.tfs = array.array( 'I')
+        self.arrays = None
+
+    def append( self, docno, tf):
+        self.docnos.append( docno)
+        self.tfs.append( tf)
+        self.arrays = None
+
+    # The posting list as pair of NumPy arrays (copied once after changes):
+    def numpyArrays( self):
+        arrays = self.arrays
+        if (arrays is None):
+            arrays = (numpy.array( self.docnos, dtype=numpy.uint32),
+                      numpy.array( self.tfs, dtype=numpy.float64))
+            self.arrays = arrays
+        return arrays
+
+class Backend:
+    def __init__(self, config):
+        params = strusStandIn.parseConfig( config)
+        # BM25 parameters (the defaults of strusIR.Backend.createQueryEvalBM25):
+        self.k1 = float( params.get( "k1", 1.2))
+        self.b = float( params.get( "b", 0.75))
+        self.avgdoclen = float( params.get( "avgdoclen", 20))
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.docids = []
+        self.attributes = []
+        self.doclens = array.array( 'I')
+        self.dates = array.array( 'I')
+        self.dateHistogram = strusDates.DateHistogram()
+        self.doclenArray = None
+        self.dateArray = None
+        # Statistics changes since the last call of getUpdateStatisticsIterator:
+        self.nofdocsChanged = 0
+        self.dfChanged = {}
+
+    def analyzeDocuments( self, content):
+        return analyzeDocuments( content)
+
+    # Insert a multipart document:
+    def insertDocuments( self, content):
+        return self.insertAnalyzedDocuments( self.analyzeDocuments( content))
+
+    # Insert a list of analyzed documents, docnos start with 1 as in strus:
+    def insertAnalyzedDocuments( self, docs):
+        with self.lock:
+            for doc in docs:
+                self.docids.append( doc['attribute']['docid'])
+                self.attributes.append( (doc['attribute']['title'], doc['orig']))
+                self.doclens.append( doc['doclen'])
+                self.dates.append( doc['date'])
+                self.dateHistogram.add( doc['date'])
+                docno = len( self.docids)
+                for value,tf in doc['terms'].items():
+                    key = ("word", value)
+                    posting = self.postings.get( key)
+                    if (posting is None):
+                        posting = Posting()
+                        self.postings[ key] = posting
+                    posting.append( docno, tf)
+                    self.dfChanged[ key] = self.dfChanged.get( key, 0) + 1
+                self.nofdocsChanged += 1
+            self.doclenArray = None
+            self.dateArray = None
+        return len( docs)
+
+    def nofDocuments( self):
+        return len( self.docids)
+
+    # Get the posting lists of the query terms (None if a term does not
+    # occur), the document lengths and the dates as NumPy arrays:
+    def queryArrays( self, terms):
+        with self.lock:
+            postings = []
+            for term in terms:
+                posting = self.postings.get( (_str( term.type), _str( term.value)))
+                postings.append( None if posting is None else posting.numpyArrays())
+            if (self.doclenArray is None):
+                self.doclenArray = numpy.array( self.doclens, dtype=numpy.float64)
+            if (self.dateArray is None):
+                self.dateArray = numpy.array( self.dates, dtype=numpy.uint32)
+            return postings, self.doclenArray, self.dateArray
+
+    # Docnos of the documents containing all terms ('candidates' restricts
+    # them to a set of docnos, 'daterange' to a range of dates) and their
+    # BM25 weights as NumPy arrays:
+    def weightDocuments( self, terms, collectionsize, candidates=None, daterange=None):
+        postings,doclens,dates = self.queryArrays( terms)
+        if (len( terms) == 0 or None in postings):
+            return numpy.zeros( 0, dtype=numpy.uint32), numpy.zeros( 0)
+        # Select the documents containing all terms starting with the shortest posting list:
+        order = sorted( range( len( terms)), key=lambda ti: len( postings[ ti][0]))
+        docnos = postings[ order[0]][0]
+        if (candidates is not None):
+            docnos = numpy.intersect1d( docnos, candidates, assume_unique=True)
+        if (daterange is not None):
+            docdates = dates[ docnos - 1]
+            mask = numpy.ones( len( docnos), dtype=bool)
+            if (daterange[0] is not None):
+                mask &= docdates >= daterange[0]
+            if (daterange[1] is not None):
+                mask &= docdates <= daterange[1]
+            docnos = docnos[ mask]
+        for ti in order[1:]:
+            docnos = numpy.intersect1d( docnos, postings[ ti][0], assume_unique=True)
+        weights = numpy.zeros( len( docnos))
+        norm = self.k1 * (1.0 - self.b + self.b * doclens[ docnos - 1] / self.avgdoclen)
+        for term,(termdocnos,termtfs) in zip( terms, postings):
+            tf = termtfs[ numpy.searchsorted( termdocnos, docnos)]
+            idf = numpy.log10( (collectionsize - term.df + 0.5) / (term.df + 0.5))
+            weights += max( idf, 0.00001) * (tf * (self.k1 + 1.0)) / (tf + norm)
+        return docnos, weights
+
+    # Best 'nofranks' documents starting with 'firstrank' as list of pairs (docno,weight):
+    def rankedDocuments( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        docnos,weights = self.weightDocuments( terms, collectionsize, None, daterange)
+        maxnofranks = firstrank + nofranks
+        if (len( docnos) > maxnofranks):
+            # Select the top documents without sorting all candidates:
+            selected = numpy.argpartition( -weights, maxnofranks - 1)[ :maxnofranks]
+            docnos = docnos[ selected]
+            weights = weights[ selected]
+        order = numpy.lexsort( (docnos, -weights))[ firstrank:maxnofranks]
+        return [ (int( docnos[ ri]), float( weights[ ri])) for ri in order ]
+
+    # Summary of a document: docid, title and the original text around
+    # the first match with the matches marked as abstract:
+    def summary( self, docno, weight, values, windowsize=40):
+        title,orig = self.attributes[ docno - 1]
+        words = orig.split()
+        matches = [ wi for wi,word in enumerate( words)
+                    if any( normalizeWord( token) in values for token in wordPattern.findall( word)) ]
+        start = max( 0, matches[0] - windowsize // 2) if matches else 0
+        window = [ "<b>%s</b>" % word if wi in matches else word
+                   for wi,word in enumerate( words[ start:start + windowsize], start) ]
+        return {
+            'docno':docno,
+            'docid':self.docids[ docno - 1],
+            'title':title,
+            'weight':weight,
+            'abstract':" ".join( window) }
+
+    def evaluateQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        values = set( _str( term.value) for term in terms)
+        return [ self.summary( docno, weight, values)
+                 for docno,weight in self.rankedDocuments( terms, collectionsize, firstrank, nofranks,
+                                                           daterange) ]
+
+    def rankQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        return [ {'docno':docno, 'weight':weight}
+                 for docno,weight in self.rankedDocuments( terms, collectionsize, firstrank, nofranks,
+                                                           daterange) ]
+
+    def summarizeDocuments( self, terms, collectionsize, docnos):
+        if len( terms) == 0 or len( docnos) == 0:
+            return []
+        candidates = numpy.unique( numpy.array( docnos, dtype=numpy.uint32))
+        matching,weights = self.weightDocuments( terms, collectionsize, candidates)
+        weightmap = dict( zip( matching.tolist(), weights.tolist()))
+        values = set( _str( term.value) for term in terms)
+        return [ self.summary( docno, weightmap[ docno], values)
+                 for docno in docnos if docno in weightmap ]
+
+    # Copy of the histogram of the dates of the documents:
+    def dateSummary( self):
+        with self.lock:
+            return self.dateHistogram.copy()
+
+    # The statistics "blobs" of this backend are the dictionaries returned
+    # by decodeStatistics:
+    def statistics( self, nofdocs, dfmap, sign):
+        return [ { 'nofdocs': sign * nofdocs,
+                   'dfchange': [ {'type':type, 'value':value, 'increment':sign * df}
+                                 for (type,value),df in dfmap.items() ] } ]
+
+    def allStatistics( self, sign):
+        with self.lock:
+            return self.statistics( len( self.docids),
+                        dict( (key, len( posting.docnos)) for key,posting in self.postings.items()), sign)
+
+    # Get an iterator on all absolute statistics of the storage
+    def getInitStatisticsIterator( self):
+        return self.allStatistics( 1)
+
+    # Get an iterator on all absolute statistics of the storage
+    def getDoneStatisticsIterator( self):
+        return self.allStatistics( -1)
+
+    # Get an iterator on statistic updates of the storage
+    def getUpdateStatisticsIterator( self):
+        with self.lock:
+            rt = self.statistics( self.nofdocsChanged, self.dfChanged, 1)
+            self.nofdocsChanged = 0
+            self.dfChanged = {}
+        return rt
+
+    def decodeStatistics( self, blob):
+        return blob
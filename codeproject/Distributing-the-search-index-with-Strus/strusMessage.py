@@ -2,44 +2,153 @@ import tornado.ioloop
 import tornado.gen
 import tornado.tcpclient
 import tornado.tcpserver
+import tornado.iostream
+import tornado.concurrent
+import tornado.locks
 import signal
 import os
 import sys
 import struct
 import binascii
+import time
+import strusMetrics
+import strusTrace
+
+# Framing protocol:
+# Version 1: [size:32][message], the server answers the requests of a
+#       connection one after the other in the order they arrived.
+# Version 2: [size:32 | MULTIPLEX_FLAG][request id:32][message], the server
+#       processes the requests of a connection concurrently and answers
+#       them in the order they complete with the request id of the request.
+#       A request of a traced query has the TRACE_FLAG set in the size and
+#       the trace context [trace id:64][span id:64] of the caller following
+#       the request id (strusTrace).
+MULTIPLEX_FLAG = 0x80000000
+TRACE_FLAG = 0x40000000
+FrameHeader = struct.Struct( ">I")
+MultiplexHeader = struct.Struct( ">II")
+TraceHeader = struct.Struct( ">QQ")
+# Commands that do not change the state of the server (queries, version
+# negotiation, status, statistics changes and shard summaries). Only they
+# may be sent again if the connection closed before the reply, because the
+# server might have processed the request already:
+IDEMPOTENT_COMMANDS = frozenset( b"QRDCVSNFM")
 
 class TcpConnection( object):
-    def __init__(self, stream, command_callback):
+    def __init__(self, stream, command_callback, maxpending):
         self.stream = stream
         self.command_callback = command_callback
+        # Limit of requests processed concurrently, reading from the
+        # connection stops when reached:
+        self.pending = tornado.locks.Semaphore( maxpending)
+
+    # Process a multiplexed request, every request gets a reply with its
+    # request id, an error reply if the command callback failed, so that
+    # the client does not wait for it forever:
+    @tornado.gen.coroutine
+    def processMultiplexed( self, reqid, msg, trace):
+        try:
+            try:
+                reply = yield self.command_callback( msg, trace)
+            except Exception as e:
+                reply = b"E" + str( e).encode('utf-8')
+            # Write the whole frame with one call, so that replies of
+            # requests completing concurrently do not interleave:
+            self.stream.write( MultiplexHeader.pack(
+                                   len(reply) | MULTIPLEX_FLAG, reqid) + reply)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.pending.release()
 
     @tornado.gen.coroutine
     def on_connect(self):
         try:
             while (True):
-                msgsizemsg = yield self.stream.read_bytes( struct.calcsize(">I"))
-                (msgsize,) = struct.unpack( ">I", msgsizemsg)
-                msg = yield self.stream.read_bytes( msgsize)
-                reply = yield self.command_callback( msg)
-                yield self.stream.write( struct.pack( ">I", len(reply)) + reply);
+                msgsizemsg = yield self.stream.read_bytes( FrameHeader.size)
+                (msgsize,) = FrameHeader.unpack( msgsizemsg)
+                if (msgsize & MULTIPLEX_FLAG):
+                    reqidmsg = yield self.stream.read_bytes( FrameHeader.size)
+                    (reqid,) = FrameHeader.unpack( reqidmsg)
+                    trace = None
+                    if (msgsize & TRACE_FLAG):
+                        tracemsg = yield self.stream.read_bytes( TraceHeader.size)
+                        trace = TraceHeader.unpack( tracemsg)
+                    msg = yield self.stream.read_bytes( msgsize & ~(MULTIPLEX_FLAG | TRACE_FLAG))
+                    yield self.pending.acquire()
+                    tornado.ioloop.IOLoop.current().spawn_callback(
+                                            self.processMultiplexed, reqid, msg, trace)
+                else:
+                    msg = yield self.stream.read_bytes( msgsize)
+                    reply = yield self.command_callback( msg, None)
+                    yield self.stream.write( FrameHeader.pack( len(reply)) + reply);
         except tornado.iostream.StreamClosedError:
             pass
 
 class RequestServer( tornado.tcpserver.TCPServer):
-    def __init__(self, command_callback, shutdown_callback):
+    def __init__(self, command_callback, shutdown_callback, maxpending=64):
         tornado.tcpserver.TCPServer.__init__(self)
         self.command_callback = command_callback
         self.shutdown_callback = shutdown_callback
+        self.maxpending = maxpending
         self.io_loop = tornado.ioloop.IOLoop.current()
+        # Metrics of the requests processed, histograms per command letter:
+        self.histograms = {}
+        self.inflight = strusMetrics.registry.gauge(
+                            "requests_inflight", "Number of requests in process")
+        self.errors = strusMetrics.registry.counter(
+                            "request_errors", "Number of requests answered with an error")
+
+    def commandHistogram( self, command):
+        histogram = self.histograms.get( command)
+        if (histogram is None):
+            name = chr( command) if chr( command).isalnum() else "%02x" % command
+            histogram = strusMetrics.registry.histogram( "command_%s_seconds" % name,
+                            "Time to process requests with the command '%s' in seconds" % name)
+            self.histograms[ command] = histogram
+        return histogram
+
+    # Process a request with the command callback and measure it, 'trace'
+    # is the trace context of the caller if the request is traced:
+    @tornado.gen.coroutine
+    def processCommand( self, msg, trace):
+        start = time.time()
+        span = None
+        if (trace is not None and msg):
+            span = strusTrace.continueTrace( "command %s" % chr( msg[0]), trace)
+        self.inflight.inc()
+        try:
+            reply = yield self.command_callback( msg)
+        finally:
+            self.inflight.dec()
+        if (msg):
+            self.commandHistogram( msg[0]).observe( time.time() - start)
+        if (reply[0:1] == b"E"):
+            self.errors.inc()
+            if (span is not None):
+                span.tags[ "error"] = reply[1:].decode( 'utf-8', 'replace')
+        if (span is not None):
+            span.finish()
+        raise tornado.gen.Return( reply)
 
     def do_shutdown( self, signum, frame):
+        self.io_loop.add_callback_from_signal( self.shutdown)
+
+    # Run the shutdown callback to completion in the IO loop (it may be a
+    # coroutine) and stop the loop:
+    @tornado.gen.coroutine
+    def shutdown( self):
         print('Shutting down')
-        self.shutdown_callback()
-        self.io_loop.stop()
+        try:
+            result = self.shutdown_callback()
+            if (result is not None):
+                yield result
+        finally:
+            self.io_loop.stop()
 
     @tornado.gen.coroutine
     def handle_stream( self, stream, address):
-        connection = TcpConnection( stream, self.command_callback)
+        connection = TcpConnection( stream, self.processCommand, self.maxpending)
         yield connection.on_connect()
 
     def start( self, port):
@@ -47,18 +156,252 @@ class RequestServer( tornado.tcpserver.TCPServer):
         self.listen( port, host)
         print("Listening on %s:%d..." % (host, port))
         signal.signal( signal.SIGINT, self.do_shutdown)
+        signal.signal( signal.SIGTERM, self.do_shutdown)
         self.io_loop.start()
 
 
+# Parse an address of the form "host:port" or "port" into a pair (host,port):
+def parseAddress( address):
+    if (isinstance( address, tuple)):
+        return address
+    if (address.isdigit()):
+        return ('localhost', int(address))
+    ri = address.rindex(':')
+    return (address[:ri], int( address[ri+1:]))
+
+# Normalized address "host:port" of a server:
+def addressKey( address):
+    return "%s:%d" % parseAddress( address)
+
+# Client side of a connection carrying multiplexed requests (protocol version 2):
+class MultiplexConnection( object):
+    def __init__(self, stream, close_callback=None):
+        self.stream = stream
+        # Called without arguments when the connection is closed:
+        self.close_callback = close_callback
+        # Map of request id to the future of the reply:
+        self.pending = {}
+        self.nextid = 0
+        self.lastused = time.time()
+        self.nofrequests = 0
+        tornado.ioloop.IOLoop.current().spawn_callback( self.readReplies)
+
+    def closed( self):
+        return self.stream.closed()
+
+    def close( self):
+        self.stream.close()
+
+    # Send a request and return the future of its reply, 'trace' is the
+    # trace context passed to the server if the request is traced. The
+    # future fails with a tornado.gen.TimeoutError if no reply arrived
+    # until 'deadline' (IOLoop time), a late reply is dropped:
+    def issueRequest( self, msg, trace=None, deadline=None):
+        reqid = self.nextid
+        self.nextid = (self.nextid + 1) & 0xFFFFFFFF
+        future = tornado.concurrent.Future()
+        self.pending[ reqid] = future
+        if (deadline is not None):
+            ioloop = tornado.ioloop.IOLoop.current()
+            timeout = ioloop.call_at( deadline, self.expire, reqid)
+            tornado.concurrent.future_add_done_callback(
+                    future, lambda future: ioloop.remove_timeout( timeout))
+        self.nofrequests += 1
+        self.lastused = time.time()
+        if (trace is None):
+            self.stream.write( MultiplexHeader.pack( len(msg) | MULTIPLEX_FLAG, reqid) + msg)
+        else:
+            self.stream.write( MultiplexHeader.pack( len(msg) | MULTIPLEX_FLAG | TRACE_FLAG, reqid)
+                               + TraceHeader.pack( *trace) + msg)
+        return future
+
+    # Stop waiting for the reply of the request with id 'reqid':
+    def expire( self, reqid):
+        future = self.pending.pop( reqid, None)
+        if (future is not None and not future.done()):
+            future.set_exception( tornado.gen.TimeoutError( "request timed out"))
+
+    @tornado.gen.coroutine
+    def readReplies( self):
+        error = None
+        try:
+            while (True):
+                header = yield self.stream.read_bytes( MultiplexHeader.size)
+                (replysize,reqid) = MultiplexHeader.unpack( header)
+                if (not replysize & MULTIPLEX_FLAG):
+                    raise Exception( "protocol error: reply without request id")
+                reply = yield self.stream.read_bytes( replysize & ~MULTIPLEX_FLAG)
+                future = self.pending.pop( reqid, None)
+                self.lastused = time.time()
+                if (future is not None and not future.done()):
+                    future.set_result( reply)
+        except tornado.iostream.StreamClosedError as e:
+            error = e
+        except Exception as e:
+            error = e
+            self.stream.close()
+        # Fail all requests waiting for a reply on this connection:
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if (not future.done()):
+                future.set_exception( tornado.iostream.StreamClosedError( error))
+        if (self.close_callback is not None):
+            self.close_callback()
+
+# Pool of persistent connections to one server address, requests are
+# multiplexed over the connections:
+class ConnectionPool( object):
+    def __init__(self, client, host, port):
+        self.client = client
+        self.host = host
+        self.port = port
+        # Open connections:
+        self.connections = []
+        # Number of connections being established:
+        self.nofconnecting = 0
+        # Signalled when a connection attempt finished:
+        self.connected = tornado.locks.Condition()
+
+    def connectionClosed( self):
+        self.client.connectionClosed( "%s:%d" % (self.host, self.port))
+
+    def removeClosed( self):
+        self.connections = [ conn for conn in self.connections if not conn.closed() ]
+
+    # Get the least loaded connection, open a new one if all connections
+    # have more than 'maxpending' requests in flight and the limit of
+    # connections is not reached yet:
+    @tornado.gen.coroutine
+    def acquire( self):
+        while (True):
+            self.removeClosed()
+            best = None
+            for conn in self.connections:
+                if (best is None or len(conn.pending) < len(best.pending)):
+                    best = conn
+            nofconn = len(self.connections) + self.nofconnecting
+            if (best is not None and (len(best.pending) < self.client.maxpending
+                                      or nofconn >= self.client.maxconnections)):
+                raise tornado.gen.Return( best)
+            if (nofconn < self.client.maxconnections):
+                self.nofconnecting += 1
+                try:
+                    stream = yield self.client.connect( self.host, self.port)
+                finally:
+                    self.nofconnecting -= 1
+                    self.connected.notify_all()
+                stream.set_nodelay( True)
+                conn = MultiplexConnection( stream, self.connectionClosed)
+                self.connections.append( conn)
+                raise tornado.gen.Return( conn)
+            # All connections are being established, wait for one of them:
+            yield self.connected.wait()
+
+    # Close connections without requests in flight that have not been
+    # used for longer than 'idletimeout' seconds:
+    def evictIdle( self, idletimeout):
+        now = time.time()
+        keep = []
+        for conn in self.connections:
+            if (conn.closed()):
+                continue
+            if (not conn.pending and now - conn.lastused > idletimeout):
+                conn.close()
+            else:
+                keep.append( conn)
+        self.connections = keep
+
 class RequestClient( tornado.tcpclient.TCPClient):
+    def __init__(self, maxconnections=16, idletimeout=60.0, maxpending=32):
+        tornado.tcpclient.TCPClient.__init__(self)
+        # Maximum number of connections open per server address:
+        self.maxconnections = maxconnections
+        # Seconds an unused connection is kept open:
+        self.idletimeout = idletimeout
+        # Number of requests in flight on a connection before another one is opened:
+        self.maxpending = maxpending
+        # Map of server address to connection pool:
+        self.pools = {}
+        self.evictor = None
+        # Functions called with the address ("host:port") of a server when
+        # a connection to it is closed:
+        self.closeCallbacks = []
+
+    def connectionClosed( self, address):
+        for callback in self.closeCallbacks:
+            callback( address)
+
+    def getPool( self, address):
+        key = addressKey( address)
+        pool = self.pools.get( key)
+        if (pool is None):
+            host,port = parseAddress( address)
+            pool = ConnectionPool( self, host, port)
+            self.pools[ key] = pool
+        if (self.evictor is None and self.idletimeout):
+            self.evictor = tornado.ioloop.PeriodicCallback(
+                                self.evictIdle, self.idletimeout * 1000 / 2)
+            self.evictor.start()
+        return pool
+
+    def evictIdle( self):
+        for pool in self.pools.values():
+            pool.evictIdle( self.idletimeout)
+
+    # Issue a request on a stream with the framing protocol version 1 (no request id):
     @tornado.gen.coroutine
-    def issueRequest( self, stream, msg):
-        blob = struct.pack( ">I", len(msg)) + msg
-        stream.write( blob);
-        replysizemsg = yield stream.read_bytes( struct.calcsize(">I"))
-        (replysize,) = struct.unpack( ">I", replysizemsg)
+    def issueStreamRequest( self, stream, msg):
+        stream.write( FrameHeader.pack( len(msg)) + msg);
+        replysizemsg = yield stream.read_bytes( FrameHeader.size)
+        (replysize,) = FrameHeader.unpack( replysizemsg)
         reply = yield stream.read_bytes( replysize)
         raise tornado.gen.Return( reply)
 
+    # Issue a request to the server with address 'address' ("host:port")
+    # multiplexed over a pooled connection and return the future of the
+    # reply. An idempotent request (IDEMPOTENT_COMMANDS) on a reused
+    # connection that has been closed by the server is retried once on a new
+    # connection. A request not answered until 'deadline' (IOLoop time)
+    # fails with a tornado.gen.TimeoutError and is removed from its
+    # connection. If the caller is traced, the request is recorded as client span:
+    @tornado.gen.coroutine
+    def issueRequest( self, address, msg, deadline=None):
+        pool = self.getPool( address)
+        span = None
+        if (msg):
+            span = strusTrace.startSpan( "request %s" % chr( msg[0]), "CLIENT",
+                                         {"server": "%s:%d" % (pool.host, pool.port)})
+        trace = None if span is None else span.context()
+        retry = len( msg) > 0 and msg[0] in IDEMPOTENT_COMMANDS
+        try:
+            while (True):
+                conn = yield pool.acquire()
+                reused = conn.nofrequests > 0
+                try:
+                    reply = yield conn.issueRequest( msg, trace, deadline)
+                    break
+                except tornado.iostream.StreamClosedError:
+                    if (reused and retry):
+                        retry = False
+                        continue
+                    raise
+        except Exception as e:
+            if (span is not None):
+                span.tags[ "error"] = str( e)
+            raise
+        finally:
+            if (span is not None):
+                span.finish()
+        raise tornado.gen.Return( reply)
 
-
+    # Close all connections:
+    def close( self):
+        if (self.evictor is not None):
+            self.evictor.stop()
+            self.evictor = None
+        for pool in self.pools.values():
+            for conn in pool.connections:
+                conn.close()
+            pool.connections = []
+        tornado.tcpclient.TCPClient.close( self)
@@ -0,0 +1,134 @@
+import bisect
+import collections
+import functools
+import threading
+import time
+
+# Monotonically increasing count of events:
+class Counter( object):
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc( self, incr=1):
+        self.value += incr
+
+    def get( self):
+        return self.value
+
+    def formatText( self):
+        return "%s %s\n" % (self.name, _formatValue( self.get()))
+
+# Value that can go up and down or that is evaluated by a function when read:
+class Gauge( Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        Counter.__init__( self, name, help)
+        self.function = function
+
+    def dec( self, decr=1):
+        self.value -= decr
+
+    def set( self, value):
+        self.value = value
+
+    def get( self):
+        if (self.function is not None):
+            return self.function()
+        return self.value
+
+# Upper bounds of the buckets of latency histograms in seconds:
+latencyBuckets = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0 ]
+
+# Distribution of observed values (e.g. durations in seconds) counted in
+# buckets with fixed upper bounds, formatted as cumulative counts per
+# bucket with the sum and the number of values observed. Observing a value
+# costs a binary search and is safe to call from worker threads:
+class Histogram( object):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        self.buckets = list( buckets or latencyBuckets)
+        # Counts per bucket, the last one for values above the highest bound:
+        self.counts = [0] * (len( self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe( self, value):
+        bi = bisect.bisect_left( self.buckets, value)
+        with self.lock:
+            self.counts[ bi] += 1
+            self.sum += value
+
+    # Function calling 'function' and observing the time of each call:
+    def timed( self, function):
+        @functools.wraps( function)
+        def call( *args):
+            start = time.time()
+            try:
+                return function( *args)
+            finally:
+                self.observe( time.time() - start)
+        return call
+
+    def formatText( self):
+        with self.lock:
+            counts = list( self.counts)
+            total = self.sum
+        rt = ""
+        cumulated = 0
+        for bound,count in zip( self.buckets, counts):
+            cumulated += count
+            rt += '%s_bucket{le="%s"} %d\n' % (self.name, _formatValue( float( bound)), cumulated)
+        cumulated += counts[ -1]
+        rt += '%s_bucket{le="+Inf"} %d\n' % (self.name, cumulated)
+        rt += "%s_sum %s\n" % (self.name, _formatValue( float( total)))
+        rt += "%s_count %d\n" % (self.name, cumulated)
+        return rt
+
+def _formatValue( value):
+    if (isinstance( value, float)):
+        return "%.6g" % value
+    return "%d" % value
+
+# Set of named metrics of a server, formatted in the text exposition
+# format ("# HELP", "# TYPE" and one line per value):
+class Registry( object):
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get( self, cls, name, help, *args):
+        with self.lock:
+            metric = self.metrics.get( name)
+            if (metric is None):
+                metric = cls( name, help, *args)
+                self.metrics[ name] = metric
+            return metric
+
+    def counter( self, name, help=""):
+        return self._get( Counter, name, help)
+
+    def gauge( self, name, help="", function=None):
+        return self._get( Gauge, name, help, function)
+
+    def histogram( self, name, help="", buckets=None):
+        return self._get( Histogram, name, help, buckets)
+
+    def formatText( self):
+        rt = ""
+        for metric in list( self.metrics.values()):
+            if (metric.help):
+                rt += "# HELP %s %s\n" % (metric.name, metric.help)
+            rt += "# TYPE %s %s\n" % (metric.name, metric.kind)
+            rt += metric.formatText()
+        return rt
+
+# Metrics of this process:
+registry = Registry()
@@ -0,0 +1,231 @@
+import array
+import bisect
+import collections
+import itertools
+import math
+import random
+import re
+import threading
+import strusDates
+
+# Stand-in for the strus backend of the storage server for benchmarks and
+# tests without a strus storage. It holds an in-memory inverted index of
+# generated documents with terms drawn from a Zipf distributed vocabulary
+# and evaluates BM25 queries like strusIR.Backend. The generated documents
+# get a random date within the years configured as "dates=FROM-TO".
+# Selected with the storage server configuration "backend=standin;
+# docs=NUM; seed=NUM". The storage server calls it from worker threads, the
+# public methods hold a lock while accessing the index.
+
+# Parse a storage configuration string "key=value; key=value" into a dictionary:
+def parseConfig( config):
+    rt = {}
+    for item in config.split(';'):
+        if '=' in item:
+            key,value = item.split( '=', 1)
+            rt[ key.strip()] = value.strip()
+    return rt
+
+# Vocabulary of 'size' terms with Zipf distributed frequencies, the term
+# with rank r has a frequency proportional to 1/r^exponent:
+class ZipfVocabulary( object):
+    def __init__(self, size, exponent=1.0):
+        self.terms = [ "term%u" % ri for ri in range( 1, size + 1) ]
+        self.cumweights = list( itertools.accumulate(
+                                    1.0 / math.pow( ri, exponent) for ri in range( 1, size + 1)))
+
+    # Draw 'nofterms' terms:
+    def sample( self, rnd, nofterms):
+        total = self.cumweights[ -1]
+        return [ self.terms[ bisect.bisect( self.cumweights, rnd.random() * total)]
+                 for ti in range( nofterms) ]
+
+itemPattern = re.compile( rb"<item\b[^>]*>(.*?)</item>", re.S)
+idPattern = re.compile( rb"<id>([^<]*)</id>")
+titlePattern = re.compile( rb"<title>([^<]*)</title>")
+datePattern = re.compile( rb"<date>([^<]*)</date>")
+tagPattern = re.compile( rb"<[^>]*>")
+wordPattern = re.compile( r"\w+")
+
+class Backend:
+    # BM25 parameters as in strusIR.Backend.createQueryEvalBM25:
+    k1 = 1.2
+    b = 0.75
+    avgdoclen = 20
+
+    def __init__(self, config):
+        params = parseConfig( config)
+        nofdocs = int( params.get( "docs", 10000))
+        seed = int( params.get( "seed", 0))
+        doclen = int( params.get( "doclen", 20))
+        self.vocabulary = ZipfVocabulary( int( params.get( "vocabulary", 50000)))
+        firstyear,lastyear = params.get( "dates", "1950-2017").split( '-')
+        mindate = strusDates.parseDateBound( firstyear)
+        maxdate = strusDates.parseDateBound( lastyear, True)
+        self.lock = threading.Lock()
+        # Inverted index: map of (type,value) to lists of docnos and term frequencies:
+        self.postings = {}
+        self.docids = []
+        self.titles = []
+        self.doclens = array.array( 'I')
+        self.dates = array.array( 'I')
+        self.dateHistogram = strusDates.DateHistogram()
+        # Statistics changes since the last call of getUpdateStatisticsIterator:
+        self.nofdocsChanged = 0
+        self.dfChanged = {}
+        rnd = random.Random( seed)
+        # The dates are drawn separately, so that the terms do not depend on them:
+        daternd = random.Random( -seed - 1)
+        for di in range( nofdocs):
+            terms = self.vocabulary.sample( rnd, doclen)
+            self.addDocument( "%u_%u" % (seed, di), " ".join( terms[:5]), terms,
+                              daternd.randint( mindate, maxdate))
+        self.nofdocsChanged = 0
+        self.dfChanged = {}
+
+    # Add a document, docnos start with 1 as in strus:
+    def addDocument( self, docid, title, terms, date):
+        self.docids.append( docid)
+        self.titles.append( title)
+        self.doclens.append( len( terms))
+        self.dates.append( date)
+        self.dateHistogram.add( date)
+        docno = len( self.docids)
+        for term,tf in sorted( collections.Counter( terms).items()):
+            key = ("word", term)
+            posting = self.postings.get( key)
+            if (posting is None):
+                posting = (array.array( 'I'), array.array( 'I'))
+                self.postings[ key] = posting
+            posting[0].append( docno)
+            posting[1].append( tf)
+            self.dfChanged[ key] = self.dfChanged.get( key, 0) + 1
+        self.nofdocsChanged += 1
+
+    # Insert a multipart document, the words of the elements of an item
+    # are its terms:
+    def insertDocuments( self, content):
+        docs = []
+        for item in itemPattern.findall( bytes( content)):
+            match = idPattern.search( item)
+            docid = match.group( 1).decode('utf-8') if match else None
+            match = titlePattern.search( item)
+            title = match.group( 1).decode('utf-8') if match else ""
+            match = datePattern.search( item)
+            date = strusDates.dateToInt( match.group( 1).decode('utf-8')) if match else 0
+            text = tagPattern.sub( b" ", item).decode('utf-8').lower()
+            docs.append( (docid, title, wordPattern.findall( text), date))
+        with self.lock:
+            for docid,title,terms,date in docs:
+                if (docid is None):
+                    docid = "%u" % (len( self.docids) + 1)
+                self.addDocument( docid, title, terms, date)
+        return len( docs)
+
+    def nofDocuments( self):
+        with self.lock:
+            return len( self.docids)
+
+    # Map of docno to weight of the documents containing all terms (with
+    # a date in 'daterange' if defined):
+    def weightDocuments( self, terms, collectionsize, docnos=None, daterange=None):
+        postings = []
+        for term in terms:
+            key = (_str( term.type), _str( term.value))
+            posting = self.postings.get( key)
+            if (posting is None):
+                return {}
+            idf = math.log10( (collectionsize - term.df + 0.5) / (term.df + 0.5))
+            postings.append( (len( posting[0]), posting, max( idf, 0.00001)))
+        postings.sort( key=lambda posting: posting[0])
+        # Candidates are the documents of the shortest posting list:
+        nofdocs,posting,idf = postings[0]
+        weights = dict( zip( posting[0], [0.0] * nofdocs))
+        if (docnos is not None):
+            weights = dict( (docno, 0.0) for docno in docnos if docno in weights)
+        if (daterange is not None):
+            weights = dict( (docno, 0.0) for docno in weights
+                            if strusDates.inRange( self.dates[ docno - 1], daterange))
+        for nofdocs,(docnolist,tflist),idf in postings:
+            for docno in list( weights):
+                pi = bisect.bisect_left( docnolist, docno)
+                if (pi == nofdocs or docnolist[ pi] != docno):
+                    del weights[ docno]
+                    continue
+                tf = tflist[ pi]
+                rellen = float( self.doclens[ docno - 1]) / self.avgdoclen
+                weights[ docno] += idf * (tf * (self.k1 + 1.0)) \
+                                   / (tf + self.k1 * (1.0 - self.b + self.b * rellen))
+        return weights
+
+    def rankedDocuments( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        if len( terms) == 0:
+            return []
+        weights = self.weightDocuments( terms, collectionsize, None, daterange)
+        ranked = sorted( weights.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[ firstrank:firstrank + nofranks]
+
+    def summary( self, docno, weight, terms):
+        values = set( _str( term.value) for term in terms)
+        return {
+            'docno':docno,
+            'docid':self.docids[ docno - 1],
+            'title':self.titles[ docno - 1],
+            'weight':weight,
+            'abstract':" ... ".join( "<b>%s</b>" % value for value in sorted( values)) }
+
+    def evaluateQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        with self.lock:
+            return [ self.summary( docno, weight, terms)
+                     for docno,weight in self.rankedDocuments( terms, collectionsize, firstrank, nofranks,
+                                                               daterange) ]
+
+    def rankQuery( self, terms, collectionsize, firstrank, nofranks, daterange=None):
+        with self.lock:
+            return [ {'docno':docno, 'weight':weight}
+                     for docno,weight in self.rankedDocuments( terms, collectionsize, firstrank, nofranks,
+                                                               daterange) ]
+
+    def dateSummary( self):
+        with self.lock:
+            return self.dateHistogram.copy()
+
+    def summarizeDocuments( self, terms, collectionsize, docnos):
+        if len( terms) == 0 or len( docnos) == 0:
+            return []
+        with self.lock:
+            weights = self.weightDocuments( terms, collectionsize, docnos)
+            return [ self.summary( docno, weights[ docno], terms) for docno in docnos if docno in weights ]
+
+    # The statistics "blobs" of the stand-in are the dictionaries
+    # returned by decodeStatistics:
+    def statistics( self, nofdocs, dfmap, sign):
+        return [ { 'nofdocs': sign * nofdocs,
+                   'dfchange': [ {'type':type, 'value':value, 'increment':sign * df}
+                                 for (type,value),df in dfmap.items() ] } ]
+
+    def allStatistics( self, sign):
+        with self.lock:
+            return self.statistics( len( self.docids),
+                        dict( (key, len( posting[0])) for key,posting in self.postings.items()), sign)
+
+    def getInitStatisticsIterator( self):
+        return self.allStatistics( 1)
+
+    def getDoneStatisticsIterator( self):
+        return self.allStatistics( -1)
+
+    def getUpdateStatisticsIterator( self):
+        with self.lock:
+            rt = self.statistics( self.nofdocsChanged, self.dfChanged, 1)
+            self.nofdocsChanged = 0
+            self.dfChanged = {}
+        return rt
+
+    def decodeStatistics( self, blob):
+        return blob
+
+def _str( obj):
+    if (isinstance( obj, bytes)):
+        return obj.decode('utf-8')
+    return obj
@@ -0,0 +1,341 @@
+import array
+import itertools
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# Convert a term type or value to bytes (the statistics blobs of strus
+# deliver strings, the query messages bytes):
+def termBytes( obj):
+    if (isinstance( obj, bytes)):
+        return obj
+    elif (isinstance( obj, str)):
+        return obj.encode('utf-8')
+    return bytes( obj)
+
+# Minimum number of entries of the index of a TypeDfTable (a power of 2):
+MIN_INDEX_SIZE = 16
+
+# Convert the 'dfchange' list of a statistics blob unpacked by strus
+# to a list of triples (type,value,increment) as accepted by TermDfTable:
+def dfChangeTriples( dfchange):
+    return [ (termBytes( dfchg['type']), termBytes( dfchg['value']), int( dfchg['increment']))
+             for dfchg in dfchange ]
+
+# Document frequencies of the terms of one type without a Python object
+# per term: the values are concatenated in one byte array, the value of
+# slot i from offsets[i] to offsets[i+1], the df of slot i is dfs[i]. An
+# open addressing hash table (linear probing) maps the hash of a value to
+# its slot + 1 (0 for an empty entry), it has at least twice as many
+# entries as there are terms:
+class TypeDfTable( object):
+    def __init__(self):
+        self.keys = bytearray()
+        self.offsets = array.array( 'Q', [0])
+        self.dfs = array.array( 'q')
+        self.index = array.array( 'I', bytes( 4 * MIN_INDEX_SIZE))
+        self.mask = MIN_INDEX_SIZE - 1
+
+    def __len__( self):
+        return len( self.dfs)
+
+    def value( self, slot):
+        return bytes( self.keys[ self.offsets[ slot]:self.offsets[ slot+1]])
+
+    # Position of a value in the index, an empty position if not contained:
+    def position( self, value):
+        index = self.index
+        keys = self.keys
+        offsets = self.offsets
+        mask = self.mask
+        pos = hash( value) & mask
+        while (True):
+            entry = index[ pos]
+            if (entry == 0):
+                return pos
+            start = offsets[ entry - 1]
+            end = offsets[ entry]
+            if (end - start == len( value) and keys.startswith( value, start)):
+                return pos
+            pos = (pos + 1) & mask
+
+    def df( self, value):
+        entry = self.index[ self.position( value)]
+        if (entry == 0):
+            return 0
+        return self.dfs[ entry - 1]
+
+    def slot( self, value):
+        pos = self.position( value)
+        entry = self.index[ pos]
+        if (entry != 0):
+            return entry - 1
+        slot = len( self.dfs)
+        self.keys += value
+        self.offsets.append( len( self.keys))
+        self.dfs.append( 0)
+        self.index[ pos] = slot + 1
+        if (2 * len( self.dfs) > len( self.index)):
+            self.rehash( 2 * len( self.index))
+        return slot
+
+    # Rebuild the index with 'size' (a power of 2) entries:
+    def rehash( self, size):
+        index = array.array( 'I', bytes( 4 * size))
+        mask = size - 1
+        keys = bytes( self.keys)
+        offsets = self.offsets
+        for slot in range( len( self.dfs)):
+            pos = hash( keys[ offsets[ slot]:offsets[ slot+1]]) & mask
+            while (index[ pos] != 0):
+                pos = (pos + 1) & mask
+            index[ pos] = slot + 1
+        self.index = index
+        self.mask = mask
+
+    # Replace the contents by values given as concatenated 'keys' with
+    # their 'sizes' and the 'dfs' (arrays) in slot order:
+    def assign( self, keys, sizes, dfs):
+        self.keys = bytearray( keys)
+        self.offsets = array.array( 'Q', [0])
+        self.offsets.extend( itertools.accumulate( sizes))
+        self.dfs = dfs
+        size = MIN_INDEX_SIZE
+        while (size < 2 * len( dfs)):
+            size *= 2
+        self.rehash( size)
+
+    def copy( self):
+        rt = TypeDfTable()
+        rt.keys = bytearray( self.keys)
+        rt.offsets = self.offsets[:]
+        rt.dfs = self.dfs[:]
+        rt.index = self.index[:]
+        rt.mask = self.mask
+        return rt
+
+    # Iterate on the terms as pairs (value,df) in slot order:
+    def items( self):
+        keys = bytes( self.keys)
+        offsets = self.offsets
+        for slot,df in enumerate( self.dfs):
+            yield (keys[ offsets[ slot]:offsets[ slot+1]], df)
+
+    def sizes( self):
+        offsets = self.offsets
+        return array.array( 'H', [ offsets[ slot+1] - offsets[ slot] for slot in range( len( self.dfs)) ])
+
+    def memoryUsage( self):
+        return (sys.getsizeof( self.keys) + sum(
+                    arr.buffer_info()[1] * arr.itemsize
+                    for arr in (self.offsets, self.dfs, self.index)))
+
+# Global term statistics: document frequencies of all terms per term type
+# and the collection size:
+class TermDfTable( object):
+    def __init__(self):
+        self.types = {}
+        self.collectionSize = 0
+
+    def typeTable( self, type):
+        table = self.types.get( type)
+        if (table is None):
+            table = TypeDfTable()
+            self.types[ type] = table
+        return table
+
+    def df( self, type, value):
+        table = self.types.get( type)
+        if (table is None):
+            return 0
+        return table.df( value)
+
+    def applyDfChange( self, type, value, increment):
+        table = self.typeTable( termBytes( type))
+        table.dfs[ table.slot( termBytes( value))] += increment
+
+    # Apply a list of df changes as triples (type,value,increment)
+    # with type and value as bytes:
+    def applyDfChanges( self, dfchanges):
+        lasttype = None
+        table = None
+        for type,value,increment in dfchanges:
+            if (type != lasttype):
+                table = self.typeTable( type)
+                lasttype = type
+            table.dfs[ table.slot( value)] += increment
+
+    # Copy of the table, e.g. for writing a snapshot while changes continue:
+    def copy( self):
+        rt = TermDfTable()
+        rt.collectionSize = self.collectionSize
+        for type,table in self.types.items():
+            rt.types[ type] = table.copy()
+        return rt
+
+    def nofTerms( self):
+        return sum( len( table) for table in self.types.values())
+
+    def memoryUsage( self):
+        return sys.getsizeof( self.types) + sum(
+                    sys.getsizeof( type) + table.memoryUsage()
+                    for type,table in self.types.items())
+
+# Snapshot file format (all integers little endian):
+#   [magic:8] [log generation:64] [collection size:64] [nof types:32]
+#   per type: [type size:16] [type] [nof terms:32]
+#             [value sizes: nof terms * 16] [values concatenated] [dfs: nof terms * 64]
+# The value sizes and the dfs are stored as arrays loaded without
+# creating a Python object per element. The log generation is the one of
+# the first log with changes not contained in the snapshot, the logs of
+# the older generations can be deleted when the snapshot is written.
+SnapshotMagic = b"STRUSDF2"
+SnapshotHeader = struct.Struct( "<8sQqI")
+SnapshotTypeSize = struct.Struct( "<H")
+SnapshotNofTerms = struct.Struct( "<I")
+
+# Log record format: [payload size:32] [crc32 of payload:32] [payload], with
+#   payload = [nofdocs increment:64] [nof df changes:32]
+#             per df change: [increment:64] [type size:16] [value size:16] [type] [value]
+LogRecordHeader = struct.Struct( "<II")
+LogDeltaHeader = struct.Struct( "<qI")
+LogDfChange = struct.Struct( "<qHH")
+
+def _littleEndianArray( typecode, blob):
+    rt = array.array( typecode)
+    rt.frombytes( blob)
+    if (sys.byteorder != 'little'):
+        rt.byteswap()
+    return rt
+
+def _littleEndianBytes( arr):
+    if (sys.byteorder != 'little'):
+        arr = array.array( arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+# Flush the entries of a directory to disk (after creating or renaming a file):
+def syncDirectory( path):
+    fd = os.open( path, os.O_RDONLY)
+    try:
+        os.fsync( fd)
+    finally:
+        os.close( fd)
+
+# Write a snapshot of a term df table containing the changes of the logs
+# before 'generation' to a file. The file is written under a temporary name
+# and renamed, so that a crash does not leave a partially written snapshot:
+def writeSnapshot( table, path, generation):
+    tmppath = path + ".tmp"
+    with open( tmppath, "wb") as f:
+        f.write( SnapshotHeader.pack( SnapshotMagic, generation, table.collectionSize, len( table.types)))
+        for type,typetable in table.types.items():
+            f.write( SnapshotTypeSize.pack( len( type)))
+            f.write( type)
+            f.write( SnapshotNofTerms.pack( len( typetable)))
+            f.write( _littleEndianBytes( typetable.sizes()))
+            f.write( typetable.keys)
+            f.write( _littleEndianBytes( typetable.dfs))
+        f.flush()
+        os.fsync( f.fileno())
+    os.rename( tmppath, path)
+    syncDirectory( os.path.dirname( os.path.abspath( path)))
+
+# Load a snapshot written with writeSnapshot into an empty term df table,
+# returns the generation of the first log not contained in it:
+def loadSnapshot( table, path):
+    with open( path, "rb") as f:
+        with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview( mm)
+            try:
+                (magic,generation,collectionSize,noftypes) = SnapshotHeader.unpack_from( view, 0)
+                if (magic != SnapshotMagic):
+                    raise Exception( "file %s is not a statistics snapshot" % path)
+                ofs = SnapshotHeader.size
+                for ti in range( noftypes):
+                    (typesize,) = SnapshotTypeSize.unpack_from( view, ofs)
+                    ofs += SnapshotTypeSize.size
+                    type = view[ ofs:ofs+typesize].tobytes()
+                    ofs += typesize
+                    (nofterms,) = SnapshotNofTerms.unpack_from( view, ofs)
+                    ofs += SnapshotNofTerms.size
+                    sizes = _littleEndianArray( 'H', view[ ofs:ofs + 2*nofterms])
+                    ofs += 2*nofterms
+                    valuesend = ofs + sum( sizes)
+                    keys = view[ ofs:valuesend].tobytes()
+                    ofs = valuesend
+                    dfs = _littleEndianArray( 'q', view[ ofs:ofs + 8*nofterms])
+                    ofs += 8*nofterms
+                    table.typeTable( type).assign( keys, sizes, dfs)
+                table.collectionSize = collectionSize
+            finally:
+                view.release()
+    return generation
+
+def _encodeLogRecord( nofdocs, dfchanges):
+    payload = bytearray( LogDeltaHeader.pack( nofdocs, len( dfchanges)))
+    for type,value,increment in dfchanges:
+        payload += LogDfChange.pack( increment, len( type), len( value))
+        payload += type
+        payload += value
+    return LogRecordHeader.pack( len( payload), zlib.crc32( payload)) + payload
+
+# Append only log of the statistics changes. A new log (the next generation)
+# is started before writing a snapshot, the snapshot replaces the older ones:
+class StatisticsLog( object):
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self.file = open( path, "ab")
+        if (sync):
+            syncDirectory( os.path.dirname( os.path.abspath( path)))
+
+    # Append the change of the collection size and the list of df
+    # changes as triples (type,value,increment) of bytes,bytes,int:
+    def append( self, nofdocs, dfchanges):
+        self.file.write( _encodeLogRecord( nofdocs, dfchanges))
+        self.file.flush()
+        if (self.sync):
+            os.fsync( self.file.fileno())
+
+    def size( self):
+        return self.file.tell()
+
+    def close( self):
+        self.file.close()
+
+# Apply all complete records of a log to a table. A record only partially
+# written (crash while appending) ends the replay and is cut off the log:
+def replayLog( table, path):
+    nofrecords = 0
+    validsize = 0
+    with open( path, "rb") as f:
+        while (True):
+            header = f.read( LogRecordHeader.size)
+            if (len( header) < LogRecordHeader.size):
+                break
+            (payloadsize,crc) = LogRecordHeader.unpack( header)
+            payload = f.read( payloadsize)
+            if (len( payload) < payloadsize or zlib.crc32( payload) != crc):
+                break
+            (nofdocs,nofchanges) = LogDeltaHeader.unpack_from( payload, 0)
+            ofs = LogDeltaHeader.size
+            dfchanges = []
+            for ci in range( nofchanges):
+                (increment,typesize,valuesize) = LogDfChange.unpack_from( payload, ofs)
+                ofs += LogDfChange.size
+                type = payload[ ofs:ofs+typesize]
+                ofs += typesize
+                value = payload[ ofs:ofs+valuesize]
+                ofs += valuesize
+                dfchanges.append( (type, value, increment))
+            table.applyDfChanges( dfchanges)
+            table.collectionSize += nofdocs
+            validsize = f.tell()
+            nofrecords += 1
+    if (validsize < os.path.getsize( path)):
+        with open( path, "r+b") as f:
+            f.truncate( validsize)
+    return nofrecords
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.locks
 import optparse
 import os
 import sys
@@ -8,70 +10,263 @@ import binascii
 import struct
 import strus
 import collections
+import itertools
+import time
+import signal
 import strusMessage
+import strusMetrics
+import strusCodec
+import strusStatistics
+import strusTrace
 
 # [1] Globals:
-# Term df map:
-termDfMap = {}
-# Collection size (number of documents):
-collectionSize = 0
+# Term df table and collection size (number of documents):
+statistics = strusStatistics.TermDfTable()
 # Strus statistics message processor:
 strusctx = strus.Context()
+# Version of the statistics, increased with every change published. It
+# starts with the server start time in microseconds, so that it also
+# increases over restarts:
+version = int( time.time() * 1000000)
+# Directory for the snapshots and the log of the statistics (None = no persistence):
+datadir = None
+# Log of the statistics changes since the last snapshot, its generation
+# and if the changes are flushed to disk (configured in main):
+statslog = None
+loggeneration = 0
+logsync = False
+# Lock held while writing a snapshot:
+snapshotlock = tornado.locks.Lock()
+# Future of the shutdown started with the first signal, a second signal
+# waits for it instead of shutting down again:
+shutdownfuture = None
+# Partition of the terms served as pair (index,number of partitions):
+partition = (0,1)
+# Journal of the latest changes as triples (version,nofdocs,dfchanges) for
+# the storage servers replicating the statistics, holding at most
+# 'journalsize' df changes (configured in main):
+journal = collections.deque()
+journalsize = 100000
+journalterms = 0
+# Notified on every change, wakes up the requests waiting for changes:
+changed = tornado.locks.Condition()
+
+# Metrics reported by the status command:
+strusMetrics.registry.gauge( "statistics_terms", "Number of distinct terms",
+                             statistics.nofTerms)
+strusMetrics.registry.gauge( "statistics_memory_bytes",
+                             "Estimated memory used by the term df table",
+                             statistics.memoryUsage)
+strusMetrics.registry.gauge( "statistics_bytes_per_term",
+                             "Estimated memory per term of the term df table",
+                             lambda: float( statistics.memoryUsage()) / max( 1, statistics.nofTerms()))
+strusMetrics.registry.gauge( "statistics_collection_size", "Number of documents",
+                             lambda: statistics.collectionSize)
+strusMetrics.registry.gauge( "statistics_version", "Version of the statistics",
+                             lambda: version)
 
 # [2] Request handlers
-def packedMessage( msg):
-    return struct.pack( ">H%ds" % len(msg), len(msg), msg)
+# Apply a change of the collection size and a list of df changes as
+# triples (type,value,increment) and log them:
+def applyChanges( nofdocs, dfchanges):
+    global version
+    statistics.collectionSize += nofdocs
+    statistics.applyDfChanges( dfchanges)
+    if (statslog is not None):
+        statslog.append( nofdocs, dfchanges)
+    version += 1
+    journalChanges( nofdocs, dfchanges)
+
+# Add the changes of the current version to the journal:
+def journalChanges( nofdocs, dfchanges):
+    global journalterms
+    journal.append( (version, nofdocs, dfchanges))
+    journalterms += len( dfchanges)
+    while (journal and (journalterms > journalsize or len( journal) > journalsize)):
+        journalterms -= len( journal.popleft()[2])
+    changed.notify_all()
 
-def termDfMapKey( type, value):
-    return "%s~%s" % (type,value)
+# Get the changes since version 'since' as tuple (full,nofdocs,dfchanges),
+# all statistics if the journal does not contain all changes since then:
+def changesSince( since):
+    if (since == version):
+        return (False, 0, [])
+    if (since is None or since > version or not journal or journal[0][0] > since + 1):
+        dfchanges = [ (type, value, df)
+                      for type,table in statistics.types.items()
+                      for value,df in table.items() if df != 0 ]
+        return (True, statistics.collectionSize, dfchanges)
+    nofdocs = 0
+    dfmap = {}
+    for entry in itertools.islice( journal, since + 1 - journal[0][0], None):
+        nofdocs += entry[1]
+        for type,value,increment in entry[2]:
+            key = (type, value)
+            dfmap[ key] = dfmap.get( key, 0) + increment
+    return (False, nofdocs, [ (type, value, increment)
+                              for (type,value),increment in dfmap.items() if increment != 0 ])
 
 @tornado.gen.coroutine
 def processCommand( message):
     rt = b"Y"
     try:
-        global collectionSize
-        global termDfMap
-
+        global version
         if (message[0] == ord('P')):
             # PUBLISH:
             statview = strusctx.unpackStatisticBlob( message[1:])
-            collectionSize += statview[ "nofdocs"]
-            for dfchg in statview[ "dfchange"]:
-                key = termDfMapKey( dfchg['type'], dfchg['value'])
-                if key in termDfMap:
-                    termDfMap[ key ] += int( dfchg['increment'])
-                else:
-                    termDfMap[ key ] = int( dfchg['increment'])
+            dfchanges = strusStatistics.dfChangeTriples( statview[ "dfchange"])
+            if (partition[1] > 1):
+                # Published to all partitions, take the terms of this partition:
+                dfchanges = [ dfchange for dfchange in dfchanges
+                              if strusCodec.statisticsPartition(
+                                    dfchange[0], dfchange[1], partition[1]) == partition[0] ]
+            applyChanges( statview[ "nofdocs"], dfchanges)
+        elif (message[0] == ord('U')):
+            # UPDATE (statistics changes merged by the storage server):
+            nofdocs,dfchanges = strusCodec.decodeStatisticsUpdate( message)
+            applyChanges( nofdocs, dfchanges)
+        elif (message[0] == ord('G')):
+            # NEW GENERATION (documents inserted without publishing statistics):
+            version += 1
+            journalChanges( 0, [])
+        elif (message[0] == ord('C')):
+            # CHANGES (of the statistics for the replicas on the storage servers):
+            since,wait = strusCodec.decodeStatisticsChangesRequest( message)
+            if (since == version and wait > 0):
+                yield changed.wait( tornado.ioloop.IOLoop.current().time() + wait)
+            full,nofdocs,dfchanges = changesSince( since)
+            rt = strusCodec.encodeStatisticsChanges( version, full, nofdocs, dfchanges)
         elif (message[0] == ord('Q')):
             # QUERY:
-            messagesize = len(message)
-            messageofs = 1
-            while (messageofs < messagesize):
-                if (message[ messageofs] == ord('T')):
-                    # Fetch df of term, message format [T][typesize:16][valuesize:16][type string][value string]:
-                    (typesize,valuesize) = struct.unpack_from( ">HH", message, messageofs+1)
-                    messageofs += struct.calcsize( ">HH") + 1
-                    (type,value) = struct.unpack_from( "%ds%ds" % (typesize,valuesize), message, messageofs)
-                    messageofs += typesize + valuesize
-                    df = 0
-                    key = termDfMapKey( type, value)
-                    if key in termDfMap:
-                        df = termDfMap[ key]
-                    rt += struct.pack( ">q", df)
-                elif (message[ messageofs] == ord('N')):
-                    # Fetch N (nof documents), message format [N]:
-                    messageofs += 1
-                    rt += struct.pack( ">q", collectionSize)
+            values = []
+            for cmd,type,value in strusCodec.decodeStatisticsQuery( message):
+                if (cmd == 'T'):
+                    # Fetch df of term:
+                    values.append( statistics.df( type, value))
+                elif (cmd == 'N'):
+                    # Fetch N (nof documents):
+                    values.append( statistics.collectionSize)
                 else:
-                    raise Exception( "unknown statistics server sub command")
+                    # Fetch the version of the statistics:
+                    values.append( version)
+            rt = strusCodec.encodeStatisticsReply( values)
+        elif (message[0] == ord('V')):
+            # PROTOCOL VERSION:
+            rt = strusCodec.encodeVersionReply( strusCodec.decodeVersionRequest( message))
+        elif (message[0] == ord('S')):
+            # STATUS (metrics in text format):
+            rt += strusMetrics.registry.formatText().encode('utf-8')
         else:
             raise Exception( "unknown statistics server command")
     except Exception as e:
         raise tornado.gen.Return( b"E" + str(e).encode('utf-8'))
     raise tornado.gen.Return( rt)
 
+def snapshotPath():
+    return os.path.join( datadir, "statistics.snapshot")
+
+def logPath( generation):
+    return os.path.join( datadir, "statistics.%u.log" % generation)
+
+# Sorted list of the generations of the logs in the data directory:
+def logGenerations():
+    rt = []
+    for filename in os.listdir( datadir):
+        parts = filename.split( '.')
+        if (len( parts) == 3 and parts[0] == "statistics" and parts[1].isdigit() and parts[2] == "log"):
+            rt.append( int( parts[1]))
+    return sorted( rt)
+
+# Delete the logs of the generations before 'generation' (contained in the snapshot):
+def removeLogs( generation):
+    for gen in logGenerations():
+        if (gen < generation):
+            os.remove( logPath( gen))
+
+# Restore the statistics from the last snapshot and the logs of changes
+# since and continue to append to the last log (cut after the last record
+# complete by replayLog):
+def loadStatistics():
+    global statslog, loggeneration
+    generation = 0
+    if (os.path.exists( snapshotPath())):
+        generation = strusStatistics.loadSnapshot( statistics, snapshotPath())
+    removeLogs( generation)
+    nofrecords = 0
+    loggeneration = generation
+    for gen in logGenerations():
+        nofrecords += strusStatistics.replayLog( statistics, logPath( gen))
+        loggeneration = gen
+    statslog = strusStatistics.StatisticsLog( logPath( loggeneration), logsync)
+    print( "Loaded statistics of %d terms, %d documents (%d log records)"
+           % (statistics.nofTerms(), statistics.collectionSize, nofrecords))
+
+# Write a snapshot if there were changes since the last one (a log other
+# than the current one or a current one not empty). The changes
+# continue to be logged in a new generation of the log, the snapshot is
+# written from a copy of the statistics in a worker thread. The logs of the
+# older generations are deleted when the snapshot is complete, a crash
+# before leaves them to be skipped on restart by the generation of the
+# snapshot:
+@tornado.gen.coroutine
+def writeSnapshot():
+    global statslog, loggeneration
+    with (yield snapshotlock.acquire()):
+        if (statslog.size() == 0 and logGenerations() == [loggeneration]):
+            return
+        statslog.close()
+        loggeneration += 1
+        generation = loggeneration
+        statslog = strusStatistics.StatisticsLog( logPath( generation), logsync)
+        snapshot = statistics.copy()
+        try:
+            yield tornado.ioloop.IOLoop.current().run_in_executor(
+                        None, strusStatistics.writeSnapshot, snapshot, snapshotPath(), generation)
+            removeLogs( generation)
+        except Exception as e:
+            print( "Failed to write snapshot: %s" % e)
+
+@tornado.gen.coroutine
+def closeStatistics():
+    if (statslog is not None):
+        yield writeSnapshot()
+        statslog.close()
+
 def processShutdown():
-    pass
+    global shutdownfuture
+    if (shutdownfuture is None):
+        shutdownfuture = closeStatistics()
+    return shutdownfuture
+
+# Start a process for every partition of the statistics with the partition
+# index added to the port and wait for them. Returns the pair (partition,port)
+# in a started process and None in the calling process when all have terminated:
+def startPartitionProcesses( nofpartitions, port):
+    children = []
+    for pi in range( nofpartitions):
+        pid = os.fork()
+        if (pid == 0):
+            return ((pi, nofpartitions), port + pi)
+        children.append( pid)
+    # Forward the first signal to the children, further ones are ignored, so
+    # that the children are not interrupted while shutting down:
+    def forwardSignal( sig, frame):
+        signal.signal( signal.SIGINT, signal.SIG_IGN)
+        signal.signal( signal.SIGTERM, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill( pid, sig)
+            except ProcessLookupError:
+                pass
+    signal.signal( signal.SIGINT, forwardSignal)
+    signal.signal( signal.SIGTERM, forwardSignal)
+    for pid in children:
+        try:
+            os.waitpid( pid, 0)
+        except ChildProcessError:
+            # Already terminated and reaped:
+            pass
+    return None
 
 # [5] Server main:
 if __name__ == "__main__":
@@ -81,12 +276,64 @@ if __name__ == "__main__":
         parser.add_option("-p", "--port", dest="port", default=7183,
                           help="Specify the port of this server as PORT (default %u)" % 7183,
                           metavar="PORT")
+        parser.add_option("-d", "--datadir", dest="datadir", default=None,
+                          help="Persist the statistics with snapshots and a log "
+                               "of changes in the directory DIR",
+                          metavar="DIR")
+        parser.add_option("-i", "--snapshot-interval", dest="snapshotinterval", default=300,
+                          help="Write a snapshot of the statistics every SEC seconds "
+                               "(default %u)" % 300,
+                          metavar="SEC")
+        parser.add_option("-f", "--fsync", action="store_true", dest="fsync", default=False,
+                          help="Flush every change written to the log to disk")
+        parser.add_option("-P", "--partition", dest="partition", default=None,
+                          help="Serve the partition IDX of NUM partitions of the terms, "
+                               "specified as IDX/NUM with IDX starting from 0",
+                          metavar="IDX/NUM")
+        parser.add_option("-n", "--processes", dest="processes", default=1,
+                          help="Serve NUM partitions of the terms in NUM processes "
+                               "listening on the port of this server plus the partition index",
+                          metavar="NUM")
+        parser.add_option("-j", "--journal-size", dest="journalsize", default=journalsize,
+                          help="Keep the latest NUM df changes for the storage servers replicating "
+                               "the statistics, older replicas get all statistics (default %u)"
+                               % journalsize,
+                          metavar="NUM")
+        parser.add_option("-t", "--trace-file", dest="tracefile", default=None,
+                          help="Write the spans of traced requests to FILE "
+                               "(one span per line in Zipkin JSON format)",
+                          metavar="FILE")
 
         (options, args) = parser.parse_args()
         if len(args) > 0:
             parser.error("no arguments expected")
             parser.print_help()
         myport = int(options.port)
+        journalsize = int( options.journalsize)
+        if (options.partition):
+            idx,num = options.partition.split('/')
+            partition = (int( idx), int( num))
+            if (partition[0] < 0 or partition[0] >= partition[1]):
+                raise Exception( "partition index out of range")
+        nofprocesses = int( options.processes)
+        if (nofprocesses > 1):
+            started = startPartitionProcesses( nofprocesses, myport)
+            if (started is None):
+                sys.exit( 0)
+            partition,myport = started
+        if (options.tracefile):
+            strusTrace.tracer = strusTrace.Tracer( "statistics:%u" % myport, options.tracefile)
+
+        if (options.datadir):
+            datadir = options.datadir
+            if (partition[1] > 1):
+                datadir = os.path.join( datadir, "partition%u" % partition[0])
+            if (not os.path.isdir( datadir)):
+                os.makedirs( datadir)
+            logsync = options.fsync
+            loadStatistics()
+            tornado.ioloop.PeriodicCallback(
+                    writeSnapshot, float( options.snapshotinterval) * 1000).start()
 
         # Start server:
         print( "Starting server ...")
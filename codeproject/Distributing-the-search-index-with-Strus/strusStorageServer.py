@@ -3,48 +3,449 @@ import tornado.ioloop
 import tornado.web
 import tornado.gen
 import tornado.iostream
+import tornado.locks
 import os
 import sys
 import struct
 import collections
+import time
 import optparse
 import strusMessage
 import binascii
-import strusIR
+import concurrent.futures
+import multiprocessing
+import strusStandIn
+import strusMetrics
+import strusCodec
+import strusStatistics
+import strusTrace
+import strusBloom
 
 # Information retrieval engine:
 backend = None
-# Port of the global statistics server:
-statserver = "localhost:7183"
+# Addresses of the global statistics servers, one per partition of the terms:
+statservers = [ "localhost:7183" ]
 # IO loop:
 pubstats = False
-# Strus client connection factory:
+# Strus client connection pool:
 msgclient = strusMessage.RequestClient()
+# Workers executing the blocking calls of the backend:
+workers = None
+# Publisher of the statistics changes of inserts (created in main):
+publisher = None
+# Local replica of the global statistics (None if not replicated, created in main):
+statsreplica = None
+# Bloom filter of the terms of this storage (None if disabled, created in main):
+termfilter = None
+insertDocumentsCounter = strusMetrics.registry.counter(
+                            "insert_documents", "Number of documents inserted")
+# Time spent in the stages of the commands (the backend calls measured in the workers):
+decodeHistogram = strusMetrics.registry.histogram(
+                            "query_decode_seconds", "Time to decode query messages in seconds")
+evaluateHistogram = strusMetrics.registry.histogram(
+                            "query_evaluate_seconds", "Time of the query evaluation in the backend in seconds")
+rankHistogram = strusMetrics.registry.histogram(
+                            "query_rank_seconds", "Time of the ranking queries in the backend in seconds")
+summarizeHistogram = strusMetrics.registry.histogram(
+                            "query_summarize_seconds", "Time of the summarization in the backend in seconds")
+encodeHistogram = strusMetrics.registry.histogram(
+                            "query_encode_seconds", "Time to encode the query results in seconds")
+insertHistogram = strusMetrics.registry.histogram(
+                            "insert_seconds", "Time of the document inserts in the backend in seconds")
 
-# Call of the statustics server to publish the statistics of this storage on insert:
+# Observe the time since 'start' of a stage of a command and record it in the trace:
+def stageDone( histogram, stage, start):
+    end = time.time()
+    histogram.observe( end - start)
+    strusTrace.record( stage, start, end)
+
+# Executor of the blocking strus calls off the IO loop. In mode 'thread'
+# query evaluation and document insert run in a thread pool. In mode
+# 'process' the document analysis runs in addition in a pool of processes,
+# the storage is opened by this process only, so query evaluation and
+# the transaction commit stay in the thread pool. In mode 'none' all
+# calls are executed in the IO loop:
+class WorkerPool( object):
+    def __init__(self, mode, nofworkers, analyzer):
+        self.mode = mode
+        self.analyzer = analyzer
+        self.threads = None
+        self.processes = None
+        if (mode == "process" and not (hasattr( analyzer, "initAnalyzerWorker")
+                                       and hasattr( analyzer, "analyzeDocumentsWorker"))):
+            # The backend has no document analysis to run in worker processes:
+            print( "executor mode 'process' not supported by backend %s, using 'thread'"
+                   % analyzer.__name__)
+            mode = "thread"
+            self.mode = mode
+        if (mode == "thread" or mode == "process"):
+            self.threads = concurrent.futures.ThreadPoolExecutor( nofworkers)
+        elif (mode != "none"):
+            raise Exception( "unknown executor mode '%s'" % mode)
+        if (mode == "process"):
+            self.processes = concurrent.futures.ProcessPoolExecutor(
+                                nofworkers, mp_context=multiprocessing.get_context( "spawn"),
+                                initializer=analyzer.initAnalyzerWorker)
+        self.threadPending = self.defineQueueMetrics( "thread", self.threads, nofworkers)
+        self.processPending = self.defineQueueMetrics( "process", self.processes, nofworkers)
+
+    def defineQueueMetrics( self, name, executor, nofworkers):
+        if (executor is None):
+            return None
+        pending = strusMetrics.registry.gauge( "worker_%s_pending" % name,
+                        "Number of tasks submitted to the %s pool and not completed" % name)
+        strusMetrics.registry.gauge( "worker_%s_workers" % name,
+                        "Number of workers in the %s pool" % name).set( nofworkers)
+        strusMetrics.registry.gauge( "worker_%s_queued" % name,
+                        "Number of tasks waiting for a worker of the %s pool" % name,
+                        lambda: max( 0, pending.get() - nofworkers))
+        return pending
+
+    @tornado.gen.coroutine
+    def run( self, executor, pending, function, *args):
+        if (executor is None):
+            raise tornado.gen.Return( function( *args))
+        submitted = time.time()
+        started = []
+        if (executor is self.threads and strusTrace.current.get() is not None):
+            # Note the time a worker starts the call for the trace:
+            call = function
+            def function( *args):
+                started.append( time.time())
+                return call( *args)
+        pending.inc()
+        try:
+            rt = yield executor.submit( function, *args)
+        finally:
+            pending.dec()
+        if (started):
+            strusTrace.record( "queue", submitted, started[0])
+            strusTrace.record( call.__name__, started[0])
+        raise tornado.gen.Return( rt)
+
+    @tornado.gen.coroutine
+    def evaluateQuery( self, terms, collectionsize, firstrank, nofranks, daterange):
+        rt = yield self.run( self.threads, self.threadPending,
+                             evaluateHistogram.timed( backend.evaluateQuery), terms, collectionsize, firstrank, nofranks,
+                             daterange)
+        raise tornado.gen.Return( rt)
+
+    @tornado.gen.coroutine
+    def rankQuery( self, terms, collectionsize, firstrank, nofranks, daterange):
+        rt = yield self.run( self.threads, self.threadPending,
+                             rankHistogram.timed( backend.rankQuery), terms, collectionsize, firstrank, nofranks,
+                             daterange)
+        raise tornado.gen.Return( rt)
+
+    @tornado.gen.coroutine
+    def summarizeDocuments( self, terms, collectionsize, docnos):
+        rt = yield self.run( self.threads, self.threadPending,
+                             summarizeHistogram.timed( backend.summarizeDocuments), terms, collectionsize, docnos)
+        raise tornado.gen.Return( rt)
+
+    @tornado.gen.coroutine
+    def insertDocuments( self, content):
+        if (self.processes is None):
+            rt = yield self.run( self.threads, self.threadPending,
+                                 insertHistogram.timed( backend.insertDocuments), content)
+        else:
+            docs = yield self.run( self.processes, self.processPending,
+                                   self.analyzer.analyzeDocumentsWorker, content)
+            rt = yield self.run( self.threads, self.threadPending,
+                                 insertHistogram.timed( backend.insertAnalyzedDocuments), docs)
+        raise tornado.gen.Return( rt)
+
+    def shutdown( self):
+        if (self.threads is not None):
+            self.threads.shutdown()
+        if (self.processes is not None):
+            self.processes.shutdown()
+
+# Call of the statustics server to publish the statistics of this storage
+# (at startup and shutdown). The statistics are decoded by the backend and
+# sent as updates, with partitioned statistics the terms to their partition:
 @tornado.gen.coroutine
 def publishStatistics( itr):
-    # Open connection to statistics server:
-    try:
-        ri = statserver.rindex(':')
-        host,port = statserver[:ri],int( statserver[ri+1:])
-        conn = yield msgclient.connect( host, port)
-    except IOError as e:
-        raise Exception( "connection to statistics server %s failed (%s)" % (statserver, e))
-
-    for msg in itr:
+    nofpartitions = len( statservers)
+    for blob in itr:
+        statview = backend.decodeStatistics( blob)
+        partitions = [ [] for statserver in statservers ]
+        for dfchange in strusStatistics.dfChangeTriples( statview[ "dfchange"]):
+            partitions[ strusCodec.statisticsPartition( dfchange[0], dfchange[1], nofpartitions)].append( dfchange)
         try:
-            reply = yield msgclient.issueRequest( conn, b"P" + msg)
-            if (reply[0] == ord('E')):
-                raise Exception( "error in statistics server: %s" % reply[ 1:].decode('utf-8'))
-            elif (reply[0] != ord('Y')):
-                raise Exception( "protocol error publishing statistics")
+            replies = yield [ msgclient.issueRequest( statservers[ pi], strusCodec.encodeStatisticsUpdate(
+                                                        statview[ "nofdocs"], partitions[ pi]))
+                              for pi in range( nofpartitions) ]
+            for reply in replies:
+                strusCodec.checkReply( reply, "publish statistics")
         except tornado.iostream.StreamClosedError:
             raise Exception( "unexpected close of statistics server")
+        except IOError as e:
+            raise Exception( "connection to statistics server %s failed (%s)"
+                             % (",".join( statservers), e))
+
+# Local replica of the global statistics for queries evaluated without the
+# df lookup of the HTTP server. The changes are fetched from every partition
+# of the statistics server with requests waiting at most 'pollwait' seconds
+# for a change. The version of the replica is the tuple of the versions of
+# the partitions, as reported by the statistics servers to the HTTP server:
+class StatisticsReplica( object):
+    def __init__(self, servers, pollwait):
+        self.servers = servers
+        self.pollwait = pollwait
+        self.tables = [ strusStatistics.TermDfTable() for server in servers ]
+        self.versions = [ None for server in servers ]
+        self.errors = strusMetrics.registry.counter(
+                            "statistics_replica_errors", "Failed requests for statistics changes")
+        strusMetrics.registry.gauge( "statistics_replica_version",
+                                     "Version of the first partition of the statistics replica",
+                                     lambda: self.versions[0] or 0)
+        strusMetrics.registry.gauge( "statistics_replica_terms", "Number of terms in the statistics replica",
+                                     lambda: sum( table.nofTerms() for table in self.tables))
+
+    def start( self):
+        for pi in range( len( self.servers)):
+            tornado.ioloop.IOLoop.current().spawn_callback( self.follow, pi)
+
+    def ready( self):
+        return None not in self.versions
+
+    def version( self):
+        return tuple( self.versions)
+
+    def collectionSize( self):
+        return self.tables[0].collectionSize
+
+    def df( self, type, value):
+        pi = strusCodec.statisticsPartition( type, value, len( self.tables))
+        return self.tables[ pi].df( type, value)
+
+    # Keep the partition 'pi' up to date:
+    @tornado.gen.coroutine
+    def follow( self, pi):
+        while (True):
+            try:
+                reply = yield msgclient.issueRequest( self.servers[ pi],
+                            strusCodec.encodeStatisticsChangesRequest( self.versions[ pi], self.pollwait))
+                version,full,nofdocs,dfchanges = strusCodec.decodeStatisticsChanges( reply)
+                if (full):
+                    table = strusStatistics.TermDfTable()
+                    table.applyDfChanges( dfchanges)
+                    table.collectionSize = nofdocs
+                    self.tables[ pi] = table
+                else:
+                    self.tables[ pi].applyDfChanges( dfchanges)
+                    self.tables[ pi].collectionSize += nofdocs
+                self.versions[ pi] = version
+            except Exception as e:
+                self.errors.inc()
+                print( "failed to get statistics changes from %s: %s" % (self.servers[ pi], e))
+                yield tornado.gen.sleep( 1.0)
+
+# Fill in the global statistics of a query asking for the local replica
+# ([L]), returns a pair (query,version of the statistics used), the version
+# is None if the statistics are passed with the query:
+def localStatistics( query):
+    if (not query.localstats):
+        return (query, None)
+    if (statsreplica is None or not statsreplica.ready()):
+        raise Exception( "no local replica of the global statistics")
+    terms = [ strusCodec.QueryTerm( term.type, term.value, statsreplica.df( term.type, term.value))
+              for term in query.terms ]
+    return (query._replace( terms=terms, collectionsize=statsreplica.collectionSize()),
+            statsreplica.version())
+
+# Publisher of the statistics changes of inserts in the background. The
+# changes are merged per term and sent in one message per partition of the
+# statistics after 'interval' seconds or as soon as 'maxterms' terms are
+# buffered, so that inserts do not wait for the statistics server. If a
+# statistics server is not available, the changes for it stay buffered and
+# are sent with the next attempt. Inserts wait before they are executed
+# while more than 'maxbuffered' terms are buffered, an insert committed is
+# answered without delay (a client retrying would insert it twice):
+class StatisticsPublisher( object):
+    def __init__(self, interval, maxterms, maxbuffered):
+        self.maxterms = maxterms
+        self.maxbuffered = maxbuffered
+        self.nofdocs = [ 0 for statserver in statservers ]
+        self.dfchanges = [ {} for statserver in statservers ]
+        self.flushing = False
+        self.flushed = tornado.locks.Condition()
+        self.timer = tornado.ioloop.PeriodicCallback( self.flush, interval * 1000)
+        self.timer.start()
+        strusMetrics.registry.gauge( "statistics_buffered_terms",
+                        "Number of term df changes not yet published", self.nofTerms)
+        self.errors = strusMetrics.registry.counter(
+                        "statistics_publish_errors", "Failed attempts to publish statistics")
+
+    def nofTerms( self):
+        return sum( len( dfchanges) for dfchanges in self.dfchanges)
+
+    # Merge changes into the buffer of the partition 'pi':
+    def mergePartition( self, pi, nofdocs, dfchanges):
+        self.nofdocs[ pi] += nofdocs
+        buffer = self.dfchanges[ pi]
+        for type,value,increment in dfchanges:
+            key = (type, value)
+            buffer[ key] = buffer.get( key, 0) + increment
+
+    def merge( self, nofdocs, dfchanges):
+        nofpartitions = len( statservers)
+        partitions = [ [] for statserver in statservers ]
+        for dfchange in dfchanges:
+            partitions[ strusCodec.statisticsPartition( dfchange[0], dfchange[1], nofpartitions)].append( dfchange)
+        for pi in range( nofpartitions):
+            self.mergePartition( pi, nofdocs, partitions[ pi])
 
-# Pack a message with its length (processCommand protocol)
-def packedMessage( msg):
-    return struct.pack( ">H%ds" % len(msg), len(msg), msg.encode('utf-8'))
+    # Wait until there is space in the buffer for the changes of an insert:
+    @tornado.gen.coroutine
+    def reserve( self):
+        while (self.nofTerms() > self.maxbuffered):
+            yield self.flushed.wait()
+
+    # Add the changes of the statistics blobs decoded by the backend:
+    def add( self, statviews):
+        for statview in statviews:
+            self.merge( statview[ "nofdocs"],
+                        strusStatistics.dfChangeTriples( statview[ "dfchange"]))
+        if (self.nofTerms() >= self.maxterms):
+            tornado.ioloop.IOLoop.current().add_callback( self.flush)
+
+    # Send the changes of one partition, keep them for the next attempt on failure:
+    @tornado.gen.coroutine
+    def publish( self, pi, nofdocs, dfchanges):
+        try:
+            msg = strusCodec.encodeStatisticsUpdate( nofdocs,
+                        [ (type, value, increment) for (type,value),increment in dfchanges.items()
+                          if increment != 0 ])
+            reply = yield msgclient.issueRequest( statservers[ pi], msg)
+            strusCodec.checkReply( reply, "publish statistics")
+        except Exception as e:
+            self.errors.inc()
+            self.mergePartition( pi, nofdocs, [ (type, value, increment)
+                                                for (type,value),increment in dfchanges.items() ])
+            print( "failed to publish statistics to %s: %s" % (statservers[ pi], e))
+
+    # Send the changes buffered to all partitions (all partitions get the
+    # change of the collection size and increase their version):
+    @tornado.gen.coroutine
+    def flush( self):
+        if (self.flushing or (not any( self.nofdocs) and self.nofTerms() == 0)):
+            return
+        self.flushing = True
+        nofdocs = self.nofdocs
+        dfchanges = self.dfchanges
+        self.nofdocs = [ 0 for statserver in statservers ]
+        self.dfchanges = [ {} for statserver in statservers ]
+        try:
+            yield [ self.publish( pi, nofdocs[ pi], dfchanges[ pi]) for pi in range( len( statservers)) ]
+        finally:
+            self.flushing = False
+            self.flushed.notify_all()
+
+    def stop( self):
+        self.timer.stop()
+
+# Bloom filter of the terms of this storage for the HTTP servers, fetched
+# with the command 'F'. The filter is updated with the statistics changes
+# of the inserts before they are published, so a filter fetched after a
+# change of the statistics version contains all terms counted in it. The
+# version of the filter increases with every change. The bytes changed by
+# the latest versions are kept in a journal, so that an HTTP server knowing
+# one of these versions only gets the changes. A filter getting too full is
+# rebuilt with twice the capacity from all statistics of the storage in a
+# worker thread:
+class TermFilter( object):
+    def __init__(self):
+        self.filter = self.build( 0)
+        self.version = int( time.time() * 1000000)
+        # Terms added while a rebuild is in progress, None if not rebuilding:
+        self.pending = None
+        # Journal of the changes as pairs (version,byte positions changed) and
+        # the number of byte positions in it, limited to the number of changes
+        # that are smaller than the whole filter:
+        self.journal = collections.deque()
+        self.journalsize = 0
+        strusMetrics.registry.gauge( "term_filter_terms", "Number of terms in the term filter",
+                                     lambda: self.filter.nofterms)
+        strusMetrics.registry.gauge( "term_filter_bytes", "Size of the term filter in bytes",
+                                     lambda: len( self.filter.bits))
+
+    # Build a filter of all terms of the storage for at least 'capacity' terms:
+    def build( self, capacity):
+        terms = []
+        for blob in backend.getInitStatisticsIterator():
+            statview = backend.decodeStatistics( blob)
+            terms.extend( (type, value)
+                          for type,value,df in strusStatistics.dfChangeTriples( statview[ "dfchange"])
+                          if df > 0)
+        rt = strusBloom.BloomFilter( max( capacity, 2 * len( terms)))
+        for type,value in terms:
+            rt.add( type, value)
+        return rt
+
+    # Add the terms of the statistics changes decoded by the backend:
+    def add( self, statviews):
+        changed = []
+        for statview in statviews:
+            for type,value,increment in strusStatistics.dfChangeTriples( statview[ "dfchange"]):
+                if (increment > 0):
+                    positions = self.filter.add( type, value)
+                    if (positions):
+                        changed.extend( positions)
+                        if (self.pending is not None):
+                            self.pending.append( (type, value))
+        if (changed):
+            self.version += 1
+            self.journal.append( (self.version, changed))
+            self.journalsize += len( changed)
+            maxsize = len( self.filter.bits) // strusCodec.FilterChange.size
+            while (self.journal and self.journalsize > maxsize):
+                self.journalsize -= len( self.journal.popleft()[1])
+        if (self.filter.isFull() and self.pending is None):
+            tornado.ioloop.IOLoop.current().spawn_callback( self.rebuild)
+
+    @tornado.gen.coroutine
+    def rebuild( self):
+        self.pending = []
+        try:
+            filter = yield workers.run( workers.threads, workers.threadPending,
+                                        self.build, 2 * self.filter.capacity)
+            # Terms inserted after the statistics were read by the rebuild:
+            for type,value in self.pending:
+                filter.add( type, value)
+            self.filter = filter
+            self.version += 1
+            self.journal.clear()
+            self.journalsize = 0
+        except Exception as e:
+            print( "failed to rebuild the term filter: %s" % e)
+        finally:
+            self.pending = None
+
+    # Changes of the filter since 'version' as list of pairs (byte position,
+    # byte), None if they are not in the journal:
+    def changesSince( self, version):
+        if (version is None or version > self.version or not self.journal
+            or self.journal[0][0] > version + 1):
+            return None
+        positions = set()
+        for entryversion,changed in self.journal:
+            if (entryversion > version):
+                positions.update( changed)
+        return [ (pos, self.filter.bits[ pos]) for pos in sorted( positions) ]
+
+# Tell the statistics server of a partition that documents were inserted,
+# so that caches of query results depending on the version of the statistics
+# are invalidated (done by publishing the statistics if enabled):
+@tornado.gen.coroutine
+def notifyInsert( statserver):
+    try:
+        reply = yield msgclient.issueRequest( statserver, b"G")
+        if (reply[0] != ord('Y')):
+            raise Exception( "protocol error notifying insert")
+    except Exception as e:
+        print( "failed to notify statistics server %s about insert: %s" % (statserver, e))
 
 # Server callback function that intepretes the client message sent,
 # executes the command and packs the result for the client
@@ -52,70 +453,125 @@ def packedMessage( msg):
 def processCommand( message):
     rt = b"Y"
     try:
-        messagesize = len(message)
-        messageofs = 1
         if (message[0] == ord('I')):
             # INSERT:
             # Insert documents:
             docblob = message[ 1:]
-            nofDocuments = backend.insertDocuments( docblob)
-            # Publish statistic updates:
             if (pubstats):
-                itr = backend.getUpdateStatisticsIterator()
-                yield publishStatistics( itr)
-            rt += struct.pack( ">I", nofDocuments)
+                yield publisher.reserve()
+            nofDocuments = yield workers.insertDocuments( docblob)
+            insertDocumentsCounter.inc( nofDocuments)
+            # Update the term filter and publish statistic updates:
+            statviews = []
+            if (pubstats or termfilter is not None):
+                statviews = [ backend.decodeStatistics( blob)
+                              for blob in backend.getUpdateStatisticsIterator() ]
+            if (termfilter is not None):
+                termfilter.add( statviews)
+            if (pubstats):
+                publisher.add( statviews)
+            else:
+                # Notify all partitions without delaying the reply:
+                for statserver in statservers:
+                    tornado.ioloop.IOLoop.current().spawn_callback( notifyInsert, statserver)
+            rt = strusCodec.encodeInsertReply( nofDocuments)
         elif (message[0] == ord('Q')):
             # QUERY:
-            Term = collections.namedtuple('Term', ['type', 'value', 'df'])
-            nofranks = 20
-            collectionsize = 0
-            firstrank = 0
-            terms = []
-            # Build query to evaluate from the request:
-            messagesize = len(message)
-            messageofs = 1
-            while (messageofs < messagesize):
-                if (message[ messageofs] == ord('I')):
-                    (firstrank,) = struct.unpack_from( ">H", message, messageofs+1)
-                    messageofs += struct.calcsize( ">H") + 1
-                elif (message[ messageofs] == ord('N')):
-                    (nofranks,) = struct.unpack_from( ">H", message, messageofs+1)
-                    messageofs += struct.calcsize( ">H") + 1
-                elif (message[ messageofs] == ord('S')):
-                    (collectionsize,) = struct.unpack_from( ">q", message, messageofs+1)
-                    messageofs += struct.calcsize( ">q") + 1
-                elif (message[ messageofs] == ord('T')):
-                    (df,typesize,valuesize) = struct.unpack_from( ">qHH", message, messageofs+1)
-                    messageofs += struct.calcsize( ">qHH") + 1
-                    (type,value) = struct.unpack_from( "%ds%ds" % (typesize,valuesize), message, messageofs)
-                    messageofs += typesize + valuesize
-                    terms.append( Term( type, value, df))
-                else:
-                    raise tornado.gen.Return( b"Eunknown parameter")
+            start = time.time()
+            query,version = localStatistics( strusCodec.decodeQuery( message))
+            stageDone( decodeHistogram, "decode", start)
             # Evaluate query with BM25 (Okapi):
-            results = backend.evaluateQuery( terms, collectionsize, firstrank, nofranks)
+            results = yield workers.evaluateQuery(
+                                query.terms, query.collectionsize, query.firstrank, query.nofranks,
+                                query.daterange)
             # Build the result and pack it into the reply message for the client:
-            for result in results:
-                rt += b'_D'
-                rt += struct.pack( ">I", result['docno'])
-                rt += b'W'
-                rt += struct.pack( ">f", result['weight'])
-                rt += b'I'
-                rt += packedMessage( result['docid'])
-                rt += b'T'
-                rt += packedMessage( result['title'])
-                rt += b'A'
-                rt += packedMessage( result['abstract'])
+            start = time.time()
+            rt = strusCodec.encodeQueryResults( results, version)
+            stageDone( encodeHistogram, "encode", start)
+        elif (message[0] == ord('R')):
+            # RANKING QUERY (first phase of a two phase query, no summaries):
+            start = time.time()
+            query,version = localStatistics( strusCodec.decodeQuery( message))
+            stageDone( decodeHistogram, "decode", start)
+            results = yield workers.rankQuery(
+                                query.terms, query.collectionsize, query.firstrank, query.nofranks,
+                                query.daterange)
+            start = time.time()
+            rt = strusCodec.encodeRankResults( results, version)
+            stageDone( encodeHistogram, "encode", start)
+        elif (message[0] == ord('D')):
+            # SUMMARIZE DOCUMENTS (second phase of a two phase query):
+            start = time.time()
+            query,version = localStatistics( strusCodec.decodeQuery( message))
+            stageDone( decodeHistogram, "decode", start)
+            results = yield workers.summarizeDocuments(
+                                query.terms, query.collectionsize, query.docnos)
+            start = time.time()
+            rt = strusCodec.encodeQueryResults( results, version)
+            stageDone( encodeHistogram, "encode", start)
+        elif (message[0] == ord('N')):
+            # NUMBER OF DOCUMENTS:
+            nofDocuments = yield workers.run( workers.threads, workers.threadPending,
+                                              backend.nofDocuments)
+            rt = strusCodec.encodeNofDocumentsReply( nofDocuments)
+        elif (message[0] == ord('F')):
+            # TERM FILTER (only sent if it changed since the version requested,
+            # as the changes if they are known):
+            if (termfilter is None):
+                raise Exception( "no term filter (start the server with --term-filter)")
+            version = strusCodec.decodeTermFilterRequest( message)
+            if (version == termfilter.version):
+                rt = strusCodec.encodeTermFilterReply( termfilter.version)
+            else:
+                changes = termfilter.changesSince( version)
+                if (changes is None):
+                    rt = strusCodec.encodeTermFilterReply( termfilter.version, termfilter.filter)
+                else:
+                    rt = strusCodec.encodeTermFilterReply( termfilter.version, changes=changes)
+        elif (message[0] == ord('M')):
+            # DATE HISTOGRAM (dates of the documents of the storage):
+            rt = strusCodec.encodeDateHistogramReply( backend.dateSummary())
+        elif (message[0] == ord('V')):
+            # PROTOCOL VERSION:
+            rt = strusCodec.encodeVersionReply( strusCodec.decodeVersionRequest( message))
+        elif (message[0] == ord('S')):
+            # STATUS (metrics in text format):
+            rt += strusMetrics.registry.formatText().encode('utf-8')
         else:
             raise Exception( "unknown command")
     except Exception as e:
         raise tornado.gen.Return( b"E" + str(e).encode('utf-8'))
     raise tornado.gen.Return( rt)
 
-# Shutdown function that sends the negative statistics to the statistics server (unsubscribe):
+# Shutdown function that sends the negative statistics to the statistics
+# server (unsubscribe), the server waits for it to complete before it stops:
+@tornado.gen.coroutine
 def processShutdown():
-    if (pubstats):
-        publishStatistics( backend.getDoneStatisticsIterator())
+    try:
+        if (pubstats):
+            publisher.stop()
+            while (publisher.flushing):
+                yield publisher.flushed.wait()
+            yield publisher.flush()
+            yield publishStatistics( backend.getDoneStatisticsIterator())
+    except Exception as e:
+        print( "failed to unsubscribe from the statistics server: %s" % e)
+    finally:
+        workers.shutdown()
+
+# Module of the backend, the configuration "backend=standin; ..." selects the
+# stand-in backend for benchmarks without a strus storage, "backend=memory"
+# the in-memory backend without the strus bindings. The modules are imported
+# on demand, so only the strus backend needs the strus bindings:
+def backendModule( config):
+    name = strusStandIn.parseConfig( config).get( "backend")
+    if (name == "standin"):
+        return strusStandIn
+    elif (name == "memory"):
+        import strusMemIR
+        return strusMemIR
+    import strusIR
+    return strusIR
 
 # Server main:
 if __name__ == "__main__":
@@ -127,14 +583,50 @@ if __name__ == "__main__":
                           help="Specify the port of this server as PORT (default %u)" % 7184,
                           metavar="PORT")
         parser.add_option("-c", "--config", dest="config", default=defaultconfig,
-                          help="Specify the storage path as CONF (default '%s')" % defaultconfig,
+                          help="Specify the storage path as CONF, 'backend=standin; docs=NUM' "
+                               "for an in-memory stand-in of NUM generated documents, "
+                               "'backend=memory' for an in-memory storage without strus "
+                               "(default '%s')" % defaultconfig,
                           metavar="CONF")
-        parser.add_option("-s", "--statserver", dest="statserver", default=statserver,
-                          help="Specify the address of the statistics server as ADDR (default %s" % statserver,
+        parser.add_option("-s", "--statserver", dest="statserver", default=statservers[0],
+                          help="Specify the address of the statistics server as ADDR, the "
+                               "addresses of the partitions separated by commas if the "
+                               "statistics are partitioned (default %s)" % statservers[0],
                           metavar="ADDR")
         parser.add_option("-P", "--publish-stats", action="store_true", dest="do_publish_stats", default=False,
                           help="Tell the node to publish the own storage statistics "
                                "to the statistics server at startup")
+        parser.add_option("-x", "--executor", dest="executor", default="thread",
+                          help="Specify where blocking strus calls are executed as MODE, "
+                               "one of 'none', 'thread' or 'process' (default %s)" % "thread",
+                          metavar="MODE")
+        parser.add_option("-w", "--workers", dest="workers", default=multiprocessing.cpu_count(),
+                          help="Specify the number of workers of the executor as NUM "
+                               "(default %u)" % multiprocessing.cpu_count(),
+                          metavar="NUM")
+        parser.add_option("-i", "--publish-interval", dest="publishinterval", default=0.2,
+                          help="Publish the statistics changes of inserts every SEC seconds "
+                               "(default %.1f)" % 0.2,
+                          metavar="SEC")
+        parser.add_option("-b", "--publish-batch", dest="publishbatch", default=100000,
+                          help="Publish the statistics changes as soon as NUM terms are "
+                               "buffered (default %u)" % 100000,
+                          metavar="NUM")
+        parser.add_option("-r", "--replicate-stats", action="store_true", dest="replicatestats",
+                          default=False,
+                          help="Keep a local replica of the global statistics for queries "
+                               "evaluated without the df lookup of the HTTP server")
+        parser.add_option("-f", "--term-filter", action="store_true", dest="termfilter", default=False,
+                          help="Keep a Bloom filter of the terms of the storage for the HTTP "
+                               "servers to skip this server for queries with terms it does not contain")
+        parser.add_option("-t", "--trace-file", dest="tracefile", default=None,
+                          help="Write the spans of traced requests to FILE "
+                               "(one span per line in Zipkin JSON format)",
+                          metavar="FILE")
+        parser.add_option("-B", "--publish-buffer", dest="publishbuffer", default=1000000,
+                          help="Delay inserts while more than NUM term changes are not "
+                               "published (default %u)" % 1000000,
+                          metavar="NUM")
 
         (options, args) = parser.parse_args()
         if len(args) > 0:
@@ -143,11 +635,26 @@ if __name__ == "__main__":
 
         myport = int(options.port)
         pubstats = options.do_publish_stats
-        statserver = options.statserver
-        backend = strusIR.Backend( options.config)
+        statservers = []
+        for addr in options.statserver.split(','):
+            if (addr[0:].isdigit()):
+                statservers.append( '{}:{}'.format( 'localhost', addr))
+            else:
+                statservers.append( addr)
+        if (options.tracefile):
+            strusTrace.tracer = strusTrace.Tracer( "storage:%u" % myport, options.tracefile)
+        module = backendModule( options.config)
+        workers = WorkerPool( options.executor, int( options.workers), module)
+        backend = module.Backend( options.config)
+        publisher = StatisticsPublisher( float( options.publishinterval),
+                                         int( options.publishbatch), int( options.publishbuffer))
+
+        if (options.termfilter):
+            termfilter = TermFilter()
 
-        if (statserver[0:].isdigit()):
-            statserver = '{}:{}'.format( 'localhost', statserver)
+        if (options.replicatestats):
+            statsreplica = StatisticsReplica( statservers, 1.0)
+            statsreplica.start()
 
         if (pubstats):
             # Start publish local statistics:
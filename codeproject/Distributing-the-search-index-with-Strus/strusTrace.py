@@ -0,0 +1,104 @@
+import contextvars
+import json
+import random
+import time
+
+# Tracing of requests across the servers: the HTTP server starts a trace
+# for a sample of the queries. The trace context (trace id and id of the
+# span of the caller) is carried to the storage and statistics servers in
+# an optional field of the strusMessage frame. Every server writes the
+# spans of the traced requests it processed to a local file, one span per
+# line in the JSON format of Zipkin (v2). The spans of a client request
+# and of the server processing it give the network time as difference.
+
+# Context of the traced request in process as pair (trace id, span id),
+# None if the request is not traced. Tornado coroutines inherit it from
+# their caller:
+current = contextvars.ContextVar( "strusTrace.current", default=None)
+
+# Writer of the spans of this process:
+class Tracer( object):
+    def __init__(self, service, filename, samplerate=0.0):
+        self.service = service
+        self.samplerate = samplerate
+        self.file = open( filename, "a", buffering=1)
+
+    # Decide if a new request is traced:
+    def sample( self):
+        return self.samplerate > 0.0 and random.random() < self.samplerate
+
+    def write( self, span):
+        self.file.write( json.dumps( span, sort_keys=True) + "\n")
+
+# Tracer of this process, None if tracing is disabled (configured in main):
+tracer = None
+
+def newId():
+    return random.getrandbits( 64) or 1
+
+# Span of a trace, written when finished. 'start' and 'end' are in seconds
+# since the epoch as returned by time.time():
+class Span( object):
+    def __init__(self, name, traceid, parentid, kind=None, start=None, tags=None):
+        self.name = name
+        self.traceid = traceid
+        self.id = newId()
+        self.parentid = parentid
+        self.kind = kind
+        self.start = time.time() if start is None else start
+        self.tags = dict( tags or {})
+
+    def context( self):
+        return (self.traceid, self.id)
+
+    def finish( self, end=None):
+        if (tracer is None):
+            return
+        end = time.time() if end is None else end
+        span = {
+            "traceId": "%016x" % self.traceid,
+            "id": "%016x" % self.id,
+            "name": self.name,
+            "timestamp": int( self.start * 1000000),
+            "duration": max( 1, int( (end - self.start) * 1000000)),
+            "localEndpoint": { "serviceName": tracer.service }
+        }
+        if (self.parentid):
+            span[ "parentId"] = "%016x" % self.parentid
+        if (self.kind):
+            span[ "kind"] = self.kind
+        if (self.tags):
+            span[ "tags"] = dict( (key, str( value)) for key,value in self.tags.items())
+        tracer.write( span)
+
+# Start the root span of a new trace if this request is sampled and make
+# it the current context, returns the span or None if not traced:
+def startTrace( name, kind="SERVER"):
+    if (tracer is None or not tracer.sample()):
+        return None
+    span = Span( name, newId(), None, kind)
+    current.set( span.context())
+    return span
+
+# Start the span of a request traced by the caller with the context
+# 'context' (pair trace id, parent span id) and make it the current
+# context, returns the span or None if tracing is disabled:
+def continueTrace( name, context, kind="SERVER"):
+    if (tracer is None or context is None):
+        return None
+    span = Span( name, context[0], context[1], kind)
+    current.set( span.context())
+    return span
+
+# Start a child span of the current context, None if not traced:
+def startSpan( name, kind=None, tags=None):
+    context = current.get()
+    if (context is None):
+        return None
+    return Span( name, context[0], context[1], kind, tags=tags)
+
+# Record a finished child span of the current context, if traced:
+def record( name, start, end=None, tags=None):
+    context = current.get()
+    if (context is not None and tracer is not None):
+        Span( name, context[0], context[1], start=start, tags=tags).finish( end)